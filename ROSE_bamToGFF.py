@@ -7,11 +7,18 @@ import re
 
 import ROSE_utils
 
+import numpy
 
 from collections import defaultdict
 
 import os
 
+import multiprocessing
+
+import time
+
+import bisect
+
 from string import join,upper,maketrans
 
 
@@ -21,22 +28,286 @@ from string import join,upper,maketrans
 #=====================================================================
 
 
-def mapBamToGFF(bamFile,gff,sense = 'both',extension = 200,floor = 0,rpm = False,matrix = None):
+def makeClusterLine(gffLocus,coverage,matrix,floor,MMR):
+
+    '''
+    bins the coverage of the counted reads across a gff locus and returns the
+    output line for that locus at full precision. coverage starts at the first
+    base of the locus
+    '''
+    #setting up the output table
+    clusterLine = [gffLocus.ID(),gffLocus.__str__()]
+
+    #getting the bin densities, flooring and binning happen on the coverage array
+    binDenList = ROSE_utils.binCoverage(coverage,gffLocus.start(),gffLocus,matrix,floor)
+    if binDenList == None:
+        clusterLine+=['NA']*matrix
+    else:
+        clusterLine+=[binDen/MMR for binDen in binDenList]
+    return clusterLine
+
+
+def mapLocus(bam,gffLocus,refID,sense,extension,floor,MMR,matrix,telemetry):
+
+    '''
+    queries the bam for the reads around one gff locus and returns its output line.
+    refID is the bam reference ID of the locus chromosome
+    '''
+    searchLocus = ROSE_utils.makeSearchLocus(gffLocus,extension,extension)
+    searchLocus = ROSE_utils.Locus(refID,searchLocus.start(),searchLocus.end(),searchLocus.sense(),searchLocus.ID())
+    
+    fetchStart = time.time()
+    reads = bam.getReadBatch(searchLocus,'both',False)
+    binStart = time.time()
+    #now extend the reads
+    extendedReads = reads.extend(extension)
+
+    #building the read coverage of the counted strands across the locus
+    countPlus,countMinus = ROSE_utils.countedStrands(gffLocus.sense(),sense)
+    countedReads = extendedReads.select(extendedReads.strandMask(countPlus,countMinus))
+    readStarts = countedReads.starts()
+    readEnds = countedReads.ends()
+    coverage = ROSE_utils.readCoverage(readStarts,readEnds,gffLocus.start(),gffLocus.end())
+    clusterLine = makeClusterLine(gffLocus,coverage,matrix,floor,MMR)
+
+    telemetry.addTime('fetch',binStart-fetchStart)
+    telemetry.addTime('bin',time.time()-binStart)
+    telemetry.addReads(len(reads))
+    return clusterLine
+
+
+def sweepBamToGFF(bam,gffLoci,refIDs,sense,extension,floor,MMR,matrix,mergeDistance,telemetry):
+
+    '''
+    maps every gff locus with one forward pass over the reads of each chromosome.
+    search windows are sorted by chromosome and start and windows closer than
+    mergeDistance are merged into a single bam query. a sweep line then hands
+    each read to every locus whose search window it overlaps, which gives the
+    same reads as querying each locus on its own.
+    refIDs maps each gff chromosome to its bam reference ID.
+    yields (index,line) pairs query by query, where index is the position in gffLoci
+    '''
+
+    #sorting the search windows
+    searchList = []
+    for i in range(len(gffLoci)):
+        searchLocus = ROSE_utils.makeSearchLocus(gffLoci[i],extension,extension)
+        searchList.append((refIDs[searchLocus.chr()],searchLocus.start(),searchLocus.end(),i))
+    searchList.sort()
+
+    #merging nearby windows into bam queries
+    queryList = []
+    for chrom,start,end,i in searchList:
+        if len(queryList) > 0 and queryList[-1][0] == chrom and start - queryList[-1][2] <= mergeDistance:
+            queryList[-1][2] = max(queryList[-1][2],end)
+            queryList[-1][3].append((start,end,i))
+        else:
+            queryList.append([chrom,start,end,[(start,end,i)]])
+    print('merged %s search windows into %s bam queries' % (len(searchList),len(queryList)))
+
+    reader = bam.getReader()
+    for chrom,queryStart,queryEnd,windowList in queryList:
+
+        fetchStart = time.time()
+        #junction reads are skipped just like in getReadsLocus
+        reads = [read for read in reader.fetchPositions(chrom,queryStart,queryEnd) if not [op for op in read[4] if op & 15 == 3]]
+        readStarts = numpy.array([read[0] for read in reads],dtype=numpy.int64)
+        readEnds = numpy.array([read[1] for read in reads],dtype=numpy.int64)
+        readMinus = numpy.array([read[2] & 16 != 0 for read in reads],dtype=bool)
+        readLengths = numpy.array([max(read[3],1) for read in reads],dtype=numpy.int64)
+
+        #extending the reads
+        extStarts = numpy.where(readMinus,readStarts-extension,readStarts)
+        extEnds = numpy.where(readMinus,readStarts+readLengths,readStarts+readLengths+extension)
+
+        #reads come sorted by start, so the running max of their ends
+        #bounds the first read that can reach a window
+        reach = numpy.maximum.accumulate(readEnds)
+        telemetry.addTime('fetch',time.time()-fetchStart)
+        telemetry.addReads(len(reads))
+
+        for start,end,i in windowList:
+            binStart = time.time()
+            gffLocus = gffLoci[i]
+            beg = max(start-1,0)
+            first = numpy.searchsorted(reach,beg,'right')
+            last = numpy.searchsorted(readStarts,end,'right')
+            hits = numpy.arange(first,last)[readEnds[first:last] > beg]
+
+            #same strand choice as the per line mapping
+            countPlus,countMinus = ROSE_utils.countedStrands(gffLocus.sense(),sense)
+            countMask = numpy.zeros(len(hits),dtype=bool)
+            if countPlus:
+                countMask |= ~readMinus[hits]
+            if countMinus:
+                countMask |= readMinus[hits]
+            hits = hits[countMask]
+            coverage = ROSE_utils.readCoverage(extStarts[hits],extEnds[hits],gffLocus.start(),gffLocus.end())
+            clusterLine = makeClusterLine(gffLocus,coverage,matrix,floor,MMR)
+            telemetry.addTime('bin',time.time()-binStart)
+            yield i,clusterLine
+
+
+def cacheBamToGFF(cache,gffLoci,refIDs,sense,floor,MMR,matrix,telemetry):
+
+    '''
+    maps every gff locus from a CoverageCache without reading the bam and
+    yields the lines in order. the chromosomes of gffLoci must already be built in the cache
+    '''
+    references = cache.references()
+    for gffLocus in gffLoci:
+        fetchStart = time.time()
+        countPlus,countMinus = ROSE_utils.countedStrands(gffLocus.sense(),sense)
+        coverage = numpy.zeros(gffLocus.len(),dtype=numpy.int64)
+        refID = refIDs[gffLocus.chr()]
+        if refID >= 0 and countPlus:
+            coverage += cache.getCoverage(references[refID],gffLocus.start(),gffLocus.end(),'+')
+        if refID >= 0 and countMinus:
+            coverage += cache.getCoverage(references[refID],gffLocus.start(),gffLocus.end(),'-')
+        binStart = time.time()
+        clusterLine = makeClusterLine(gffLocus,coverage,matrix,floor,MMR)
+        telemetry.addTime('fetch',binStart-fetchStart)
+        telemetry.addTime('bin',time.time()-binStart)
+        yield clusterLine
+
+
+def serialBamToGFF(bam,gffLoci,refIDs,sense,extension,floor,MMR,matrix,telemetry):
+
+    '''
+    maps the gff loci one bam query at a time and yields the lines in order
+    '''
+    for gffLocus in gffLoci:
+        yield mapLocus(bam,gffLocus,refIDs[gffLocus.chr()],sense,extension,floor,MMR,matrix,telemetry)
+
+
+def orderLines(indexedLines,setStarts,telemetry):
+
+    '''
+    yields (gffIndex,line) pairs with the lines of each gff in index order.
+    setStarts holds the first index of each gff and the total. each gff has
+    its own next index, so a line is only held back until the earlier lines
+    of its own gff come in, never for another gff. the most lines held at
+    once goes to telemetry
+    '''
+    pending = {}
+    nextIndex = list(setStarts[0:-1])
+    for i,clusterLine in indexedLines:
+        gffIndex = bisect.bisect_right(setStarts,i) - 1
+        pending[i] = clusterLine
+        telemetry.holdLines(len(pending))
+        while nextIndex[gffIndex] < setStarts[gffIndex+1] and pending.has_key(nextIndex[gffIndex]):
+            yield gffIndex,pending.pop(nextIndex[gffIndex])
+            nextIndex[gffIndex] += 1
+
+
+def mapShard(shard):
+
+    '''
+    worker for poolBamToGFF. maps one shard of gff loci, profiling it when
+    given a profile folder, and returns the (index,line) pairs and the telemetry counts of the shard
+    '''
+    (bamFile,indexList,gffLoci,refIDs,sense,extension,floor,MMR,matrix,sweep,mergeDistance,cacheFolder,profileFolder) = shard
+    stage = 'bamToGFF_%s_shard%s' % (bamFile.split('/')[-1],indexList[0])
+    return ROSE_utils.profileCall(profileFolder,stage,mapShardLines,bamFile,indexList,gffLoci,refIDs,sense,extension,floor,MMR,matrix,sweep,mergeDistance,cacheFolder)
+
+
+def mapShardLines(bamFile,indexList,gffLoci,refIDs,sense,extension,floor,MMR,matrix,sweep,mergeDistance,cacheFolder):
+
+    '''
+    opens its own handle on the bam and maps one shard of gff loci
+    '''
+    bam = ROSE_utils.Bam(bamFile)
+    telemetry = ROSE_utils.Telemetry()
+    if len(cacheFolder) > 0:
+        cache = ROSE_utils.CoverageCache(cacheFolder,bamFile,extension)
+        shardLines = zip(indexList,cacheBamToGFF(cache,gffLoci,refIDs,sense,floor,MMR,matrix,telemetry))
+    elif sweep:
+        shardLines = [(indexList[i],clusterLine) for i,clusterLine in sweepBamToGFF(bam,gffLoci,refIDs,sense,extension,floor,MMR,matrix,mergeDistance,telemetry)]
+    else:
+        shardLines = zip(indexList,serialBamToGFF(bam,gffLoci,refIDs,sense,extension,floor,MMR,matrix,telemetry))
+    return shardLines,telemetry.counts()
+
+
+def poolBamToGFF(bamFile,gffLoci,refIDs,sense,extension,floor,MMR,matrix,sweep,mergeDistance,processes,cacheFolder,telemetry,profileFolder = ''):
+
+    '''
+    maps gff loci across a pool of processes. loci are sharded by chromosome,
+    and large chromosomes are cut into runs of neighboring loci so the shards
+    stay balanced. yields (index,line) pairs as shards finish, where index is
+    the position in gffLoci
+    '''
+    #grouping loci by bam reference in start order
+    chromDict = defaultdict(list)
+    for i in range(len(gffLoci)):
+        chromDict[refIDs[gffLoci[i].chr()]].append(i)
+
+    #a few shards per process keeps the pool busy when chromosomes differ in size
+    shardSize = max(1,len(gffLoci)/(processes*4) + 1)
+    shardList = []
+    for chrom in sorted(chromDict.keys()):
+        indexList = sorted(chromDict[chrom],key=lambda i: gffLoci[i].start())
+        for j in range(0,len(indexList),shardSize):
+            shardIndexList = indexList[j:j+shardSize]
+            shardLoci = [gffLoci[i] for i in shardIndexList]
+            shardList.append((bamFile,shardIndexList,shardLoci,refIDs,sense,extension,floor,MMR,matrix,sweep,mergeDistance,cacheFolder,profileFolder))
+    print('split %s lines into %s shards' % (len(gffLoci),len(shardList)))
+
+    pool = multiprocessing.Pool(processes)
+    telemetry.addSubprocesses(processes)
+    try:
+        for shardLines,shardCounts in pool.imap_unordered(mapShard,shardList):
+            telemetry.addCounts(shardCounts)
+            for i,clusterLine in shardLines:
+                yield i,clusterLine
+    finally:
+        pool.close()
+        pool.join()
+
+
+def mapBamToGFF(bamFile,gff,sense = 'both',extension = 200,floor = 0,rpm = False,matrix = None,sweep = False,mergeDistance = 10000,processes = 1,cacheFolder = '',fullPrecision = False,telemetryFile = '',profileFolder = ''):
 
 #def mapBamToGFF(bamFile,gff,sense = 'both',unique = 0,extension = 200,floor = 0,density = False,rpm = False,binSize = 25,clusterGram = None,matrix = None,raw = False,includeJxnReads = False):
-    '''maps reads from a bam to a gff'''
+    '''
+    maps reads from a bam to a gff and yields the output rows, header first
+    if sweep, maps the whole gff in one sorted pass per chromosome instead of one bam query per line
+    if processes > 1, spreads the gff across a pool of processes
+    if cacheFolder is given, densities come from a persistent coverage cache of the bam
+    if fullPrecision, densities are not rounded to 4 decimal places
+    if telemetryFile is given, progress records are appended to it as JSON lines
+    if profileFolder is given, the pool processes write their profiles to it
+    '''
+    return (row for i,row in mapBamToGFFs(bamFile,[gff],sense,extension,floor,rpm,matrix,sweep,mergeDistance,processes,cacheFolder,fullPrecision,telemetryFile,profileFolder))
+
+
+def mapBamToGFFs(bamFile,gffList,sense = 'both',extension = 200,floor = 0,rpm = False,matrix = None,sweep = False,mergeDistance = 10000,processes = 1,cacheFolder = '',fullPrecision = False,telemetryFile = '',profileFolder = ''):
+
+    '''
+    maps reads from a bam to several gffs in one go and yields (gffIndex,row)
+    pairs as the rows are mapped. every gff's header comes first, then the
+    rows of each gff in its own order, interleaved with the rows of the others.
+    the regions of every gff are mapped together, so with sweep each read
+    is decoded once no matter how many gffs it falls in.
+    a sweep or pool maps regions in bam order, so the rows of a gff that is not
+    sorted by bam reference and start are held in memory until the rows before them are mapped
+    '''
     floor = int(floor)
     
     #USING BAM CLASS
     bam = ROSE_utils.Bam(bamFile)
 
+    #a coverage cache answers for the bam once it has been built
+    if len(cacheFolder) > 0:
+        cache = ROSE_utils.CoverageCache(cacheFolder,bamFile,int(extension))
+        print('using coverage cache %s' % (cache.key()))
+    else:
+        cache = None
 
-    #new GFF to write to
-    newGFF = []
     #millionMappedReads
 
 
-    if rpm:    
+    if rpm and cache:
+        MMR= round(float(cache.getTotalReads('mapped'))/1000000,4)
+    elif rpm:    
         MMR= round(float(bam.getTotalReads('mapped'))/1000000,4)
     else:
         MMR = 1
@@ -45,108 +316,62 @@ def mapBamToGFF(bamFile,gff,sense = 'both',extension = 200,floor = 0,rpm = False
     
     senseTrans = maketrans('-+.','+-+')
 
-    if ROSE_utils.checkChrStatus(bamFile) == 1:
-      print "has chr"
-      hasChrFlag = 1
-      #sys.exit();
+    #pooling the loci of every gff, remembering where each gff starts
+    gffLoci = []
+    setStarts = []
+    for gff in gffList:
+        if type(gff) == str:
+            gff = ROSE_utils.parseTable(gff,'\t')
+        setStarts.append(len(gffLoci))
+        for line in gff:
+            line = line[0:9]
+            gffLoci.append(ROSE_utils.Locus(line[0],int(line[3]),int(line[4]),line[6],line[1]))
+    setStarts.append(len(gffLoci))
+
+    #resolving each gff chromosome to a bam reference once, from the bam header
+    reader = bam.getReader()
+    refIDs = {}
+    for gffLocus in gffLoci:
+        if not refIDs.has_key(gffLocus.chr()):
+            refIDs[gffLocus.chr()] = reader.resolveChrom(gffLocus.chr())
+            if refIDs[gffLocus.chr()] < 0:
+                print('WARNING: %s is not a reference in %s' % (gffLocus.chr(),bamFile))
+
+    if cache:
+        references = reader.references()
+        cache.build([references[refID] for refID in refIDs.values() if refID >= 0])
+
+    #progress records in place of a line counter
+    telemetry = ROSE_utils.Telemetry(telemetryFile,'bamToGFF',len(gffLoci),label = bamFile)
+
+    if processes > 1:
+        print('mapping %s lines with %s processes' % (len(gffLoci),processes))
+        indexedLines = poolBamToGFF(bamFile,gffLoci,refIDs,sense,int(extension),floor,MMR,int(matrix),sweep,int(mergeDistance),processes,cacheFolder,telemetry,profileFolder)
+    elif cache:
+        print('mapping %s lines from the coverage cache' % (len(gffLoci)))
+        indexedLines = enumerate(cacheBamToGFF(cache,gffLoci,refIDs,sense,floor,MMR,int(matrix),telemetry))
+    elif sweep:
+        print('mapping %s lines with a chromosome sweep' % (len(gffLoci)))
+        indexedLines = sweepBamToGFF(bam,gffLoci,refIDs,sense,int(extension),floor,MMR,int(matrix),int(mergeDistance),telemetry)
     else:
-      print "does not have chr"
-      hasChrFlag = 0
-      #sys.exit()
-      
-    if type(gff) == str:
-        gff = ROSE_utils.parseTable(gff,'\t')
-        
-    #setting up a maxtrix table
-
-    newGFF.append(['GENE_ID','locusLine'] + ['bin_'+str(n)+'_'+bamFile.split('/')[-1] for n in range(1,int(matrix)+1,1)])        
-
-    #getting and processing reads for gff lines
-    ticker = 0
-    print('Number lines processed')
-    for line in gff:
-        line = line[0:9]
-        if ticker%100 == 0:
-            print ticker
-        ticker+=1
-        if not hasChrFlag:
-	  line[0] = re.sub(r"chr",r"",line[0])
-        gffLocus = ROSE_utils.Locus(line[0],int(line[3]),int(line[4]),line[6],line[1])
-        #print line[0]
-        #sys.exit()
-        searchLocus = ROSE_utils.makeSearchLocus(gffLocus,int(extension),int(extension))
-        
-        reads = bam.getReadsLocus(searchLocus,'both',False,'none')
-        #now extend the reads and make a list of extended reads
-        extendedReads = []
-        for locus in reads:
-            if locus.sense() == '+' or locus.sense() == '.':
-                locus = ROSE_utils.Locus(locus.chr(),locus.start(),locus.end()+extension,locus.sense(), locus.ID())
-            if locus.sense() == '-':
-                locus = ROSE_utils.Locus(locus.chr(),locus.start()-extension,locus.end(),locus.sense(),locus.ID())
-            extendedReads.append(locus)
-        if gffLocus.sense() == '+' or gffLocus.sense == '.':
-            senseReads = filter(lambda x:x.sense() == '+' or x.sense() == '.',extendedReads)
-            antiReads = filter(lambda x:x.sense() == '-',extendedReads)
-        else:
-            senseReads = filter(lambda x:x.sense() == '-' or x.sense() == '.',extendedReads)
-            antiReads = filter(lambda x:x.sense() == '+',extendedReads)
-
-        senseHash = defaultdict(int)
-        antiHash = defaultdict(int)
-
-        #filling in the readHashes             
-        if sense == '+' or sense == 'both' or sense =='.':
-            for read in senseReads:
-                for x in range(read.start(),read.end()+1,1):
-                    senseHash[x]+=1
-        if sense == '-' or sense == 'both' or sense == '.':
-            #print('foo')
-            for read in antiReads:
-                for x in range(read.start(),read.end()+1,1):
-                    antiHash[x]+=1
-
-        #now apply flooring and filtering for coordinates
-        keys = ROSE_utils.uniquify(senseHash.keys()+antiHash.keys())
-        if floor > 0:
-
-            keys = filter(lambda x: (senseHash[x]+antiHash[x]) > floor,keys)
-        #coordinate filtering
-        keys = filter(lambda x: gffLocus.start() < x < gffLocus.end(),keys)
-
-
-        #setting up the output table
-        clusterLine = [gffLocus.ID(),gffLocus.__str__()]
-
-        #getting the binsize
-        binSize = (gffLocus.len()-1)/int(matrix)
-        nBins = int(matrix)
-        if binSize == 0:
-            clusterLine+=['NA']*int(matrix)
-            newGFF.append(clusterLine)
-            continue
-        n=0
-        if gffLocus.sense() == '+' or gffLocus.sense() =='.' or gffLocus.sense() == 'both':
-            i = gffLocus.start()
-
-            while n <nBins:
-                n+=1
-                binKeys = filter(lambda x: i < x < i+binSize,keys)
-                binDen = float(sum([senseHash[x]+antiHash[x] for x in binKeys]))/binSize
-                clusterLine+=[round(binDen/MMR,4)]
-                i = i+binSize
-        else:
-            i = gffLocus.end()
-            while n < nBins:
-                n+=1
-                binKeys = filter(lambda x: i-binSize < x < i,keys)
-                binDen = float(sum([senseHash[x]+antiHash[x] for x in binKeys]))/binSize
-                clusterLine+=[round(binDen/MMR,4)]
-                i = i-binSize
-        newGFF.append(clusterLine)
-        
-            
-    return newGFF
+        #getting and processing reads for gff lines
+        print('mapping %s lines' % (len(gffLoci)))
+        indexedLines = enumerate(serialBamToGFF(bam,gffLoci,refIDs,sense,int(extension),floor,MMR,int(matrix),telemetry))
+
+    #splitting the lines back out into one maxtrix table per gff
+    #every gff gets its header before any line, as lines of different gffs interleave
+    header = ['GENE_ID','locusLine'] + ['bin_'+str(n)+'_'+bamFile.split('/')[-1] for n in range(1,int(matrix)+1,1)]
+    for gffIndex in range(len(gffList)):
+        yield gffIndex,list(header)
+    for gffIndex,clusterLine in orderLines(indexedLines,setStarts,telemetry):
+        if not fullPrecision:
+            clusterLine = clusterLine[0:2] + [x if x == 'NA' else round(x,4) for x in clusterLine[2:]]
+        #time spent while the row is out is time spent writing it
+        outputStart = time.time()
+        yield gffIndex,clusterLine
+        telemetry.addTime('output',time.time()-outputStart)
+        telemetry.tick()
+    telemetry.close()
         
                 
                 
@@ -163,10 +388,10 @@ def main():
     parser.add_option("-b","--bam", dest="bam",nargs = 1, default=None,
                       help = "Enter .bam file to be processed.")
     parser.add_option("-i","--input", dest="input",nargs = 1, default=None,
-                      help = "Enter .gff or ENRICHED REGION file to be processed.")
+                      help = "Enter .gff or ENRICHED REGION file to be processed. Enter a comma separated list to map several files in one pass")
     #output flag
     parser.add_option("-o","--output", dest="output",nargs = 1, default=None,
-                      help = "Enter the output filename.")
+                      help = "Enter the output filename. Enter a comma separated list with one output per input file")
     #additional options
     parser.add_option("-s","--sense", dest="sense",nargs = 1, default='both',
                       help = "Map to '+','-' or 'both' strands. Default maps to both.")
@@ -182,6 +407,22 @@ def main():
 
     parser.add_option("-m","--matrix", dest="matrix",nargs = 1, default=None,
                       help = "Outputs a variable bin sized matrix. User must specify number of bins.")
+    parser.add_option("--sweep", dest="sweep",action = 'store_true', default=False,
+                      help = "Maps all regions in one sorted pass over the reads of each chromosome")
+    parser.add_option("--merge", dest="merge",nargs = 1, default=10000,
+                      help = "With --sweep, merges search windows closer than n bp into one bam query. Default value is 10000bp")
+    parser.add_option("-p","--processes", dest="processes",nargs = 1, default=1,
+                      help = "Number of processes to map with. Default value is 1")
+    parser.add_option("--cache", dest="cache",nargs = 1, default='',
+                      help = "Enter a folder for a persistent coverage cache of the bam. Reruns on the same bam and extension read the same densities from the cache")
+    parser.add_option("--telemetry", dest="telemetry",nargs = 1, default='',
+                      help = "Enter a file to append JSON lines progress records to while mapping")
+    parser.add_option("--binary", dest="binary",action = 'store_true', default=False,
+                      help = "Writes each output as a full precision .npy density matrix and a .regions.txt index instead of a text table")
+    parser.add_option("--profile", dest="profile",nargs = 1, default='',
+                      help = "Enter a folder to write profiles of the mapping run and of each pool process to")
+    parser.add_option("--metrics", dest="metrics",nargs = 1, default='',
+                      help = "Enter the run metrics report of a ROSE run to record the resources of the mapping run in")
 
     (options,args) = parser.parse_args()
 
@@ -223,22 +464,31 @@ def main():
     
     
     if options.input and options.bam:
-        inputFile = options.input
-        gffFile = inputFile
+        inputFileList = options.input.split(',')
+        gffFileList = inputFileList
 
         bamFile = options.bam
         
         if options.output == None:
-            output = os.getcwd() + inputFile.split('/')[-1]+'.mapped'
+            outputList = [os.getcwd() + inputFile.split('/')[-1]+'.mapped' for inputFile in inputFileList]
         else:
-            output = options.output
+            outputList = options.output.split(',')
+        if len(outputList) != len(inputFileList):
+            print('ERROR: number of output files must match the number of input files')
+            parser.print_help()
+            exit()
         if options.matrix:
             print('mapping to GFF and making a matrix with fixed bin number')
 
-            newGFF = mapBamToGFF(bamFile,gffFile,options.sense,int(options.extension),options.floor,options.rpm,options.matrix)
+            newGFFRows = mapBamToGFFs(bamFile,gffFileList,options.sense,int(options.extension),options.floor,options.rpm,options.matrix,options.sweep,int(options.merge),int(options.processes),options.cache,options.binary,options.telemetry,options.profile)
 
-            
-        ROSE_utils.unParseTable(newGFF,output,'\t')
+            #rows are written as they are mapped, so the mapping is measured with the writing
+            stage = 'bamToGFF_%s' % (outputList[0].split('/')[-1])
+            metrics = ROSE_utils.StageMetrics(options.metrics)
+            if options.binary:
+                metrics.measure('mapBamToGFF',bamFile,ROSE_utils.profileCall,options.profile,stage,ROSE_utils.unParseMatrices,newGFFRows,outputList,int(options.matrix))
+            else:
+                metrics.measure('mapBamToGFF',bamFile,ROSE_utils.profileCall,options.profile,stage,ROSE_utils.unParseTables,newGFFRows,outputList,'\t')
     else:
         parser.print_help()
                 
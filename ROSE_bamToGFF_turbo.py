@@ -16,22 +16,111 @@ from collections import defaultdict
 import os
 import string
 import subprocess
+import threading
+import pipes
+import time
+
+import numpy
 
         
-        
+#path to the bamliquidator binary. without it, or with native, the pure python liquidator is used
+bamliquidatorString = '/usr/bin/bamliquidator'
 
+#line printed by the worker shell after the output of each region
+LIQUIDATOR_DONE = 'LIQUIDATOR_DONE'
 
 
-def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram = None,matrix = None):
-    '''maps reads from a bam to a gff'''
+class LiquidatorWorker:
+    '''
+    a long lived shell that runs bamliquidator for a stream of regions.
+    regions go in over a pipe and their bin densities are read back as they
+    finish. the shell is started once, but it still starts one bamliquidator
+    process per region. pythonLiquidate maps in process instead
+    '''
+    def __init__(self,liquidator = None):
+        if liquidator == None:
+            liquidator = bamliquidatorString
+        self._liquidator = liquidator
+        self._shell = subprocess.Popen('/bin/sh',stdin = subprocess.PIPE,stdout = subprocess.PIPE,stderr = open(os.devnull,'w'))
+
+    def __feed(self,bamFile,regionList):
+        for chrom,start,end,bamSense,nBin,extension in regionList:
+            bamCommand = "%s %s %s %s %s %s %s %s 2>/dev/null; echo %s\n" % (self._liquidator,pipes.quote(bamFile),pipes.quote(chrom),start,end,bamSense,nBin,extension,LIQUIDATOR_DONE)
+            self._shell.stdin.write(bamCommand)
+        self._shell.stdin.flush()
+
+    def liquidate(self,bamFile,regionList):
+        '''
+        yields the list of bin densities of each region in order.
+        regions are (chrom,start,end,bamSense,nBin,extension) tuples
+        '''
+        #regions are written from a thread so that a full output pipe can never block the input
+        feeder = threading.Thread(target = self.__feed,args = (bamFile,regionList))
+        feeder.daemon = True
+        feeder.start()
+        denList = []
+        for i in range(len(regionList)):
+            line = self._shell.stdout.readline()
+            while line.rstrip('\n') != LIQUIDATOR_DONE:
+                if len(line) == 0:
+                    raise IOError('bamliquidator worker exited early')
+                denList.append(line.rstrip('\n'))
+                line = self._shell.stdout.readline()
+            yield denList
+            denList = []
+        feeder.join()
+
+    def close(self):
+        self._shell.stdin.close()
+        self._shell.wait()
+
+
+def pythonLiquidate(bamFile,regionList):
+    '''
+    pure python stand in for LiquidatorWorker.liquidate, used on hosts without
+    bamliquidator or with native. maps in process without starting any processes.
+    counts the bp of extended reads on the bamSense strand ('.' for both) in
+    nBin bins of (end-start+1)/nBin bp across each region, the last bin taking
+    any remainder, and yields the list of counts of each region in order
+    '''
+    reader = BamReader(bamFile)
+    for chrom,start,end,bamSense,nBin,extension in regionList:
+        reads = reader.fetchPositions(reader.resolveChrom(chrom),start-extension,end+extension)
+        readStarts = numpy.array([read[0] for read in reads],dtype=numpy.int64)
+        readEnds = numpy.array([read[1] for read in reads],dtype=numpy.int64)
+        readMinus = numpy.array([read[2] & 16 != 0 for read in reads],dtype=bool)
+        if bamSense == '+':
+            keep = ~readMinus
+        elif bamSense == '-':
+            keep = readMinus
+        else:
+            keep = numpy.ones(len(reads),dtype=bool)
+        extStarts = numpy.where(readMinus,readStarts-extension,readStarts)[keep]
+        extEnds = numpy.where(readMinus,readEnds,readEnds+extension)[keep]
+        coverage = readCoverage(extStarts,extEnds,start,end)
+        binSize = (end-start+1)/nBin
+        binEdges = [i*binSize for i in range(nBin)] + [end-start+1]
+        cumulative = numpy.concatenate(([0],numpy.cumsum(coverage)))
+        yield [str(cumulative[binEdges[i+1]]-cumulative[binEdges[i]]) for i in range(nBin)]
+    reader.close()
+
+
+def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram = None,matrix = None,MMR = None,worker = None,telemetryFile = '',native = False):
+    '''
+    maps reads from a bam to a gff and yields the output rows, header first
+    a precomputed MMR can be passed in to skip counting the bam reads again.
+    regions go through a LiquidatorWorker, which can be shared between calls,
+    or through pythonLiquidate if native is set or the bamliquidator binary is not installed.
+    if telemetryFile is given, progress records are appended to it as JSON lines
+    '''
 
-    #creating a new gff to output
-    newGFF = []
     #reading in the bam
     bam = Bam(bamFile)
 
     #getting RPM normalization
-    if rpm:    
+    if MMR != None:
+        pass
+    elif rpm:    
         MMR= round(float(bam.getTotalReads('mapped'))/1000000,4)
     else:
         MMR = 1
@@ -57,21 +146,19 @@ def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram
         binSizeList = uniquify(binSizeList)
         if len(binSizeList) > 1: 
             print('WARNING: lines in gff are of different length. Output clustergram will have variable row length')
-        newGFF.append(['GENE_ID','locusLine'] + [str(x*binSize)+'_'+bamFile.split('/')[-1] for x in range(1,max(binSizeList)+1,1)])        
+        yield ['GENE_ID','locusLine'] + [str(x*binSize)+'_'+bamFile.split('/')[-1] for x in range(1,max(binSizeList)+1,1)]
         
     #setting up a maxtrix table
     if matrix:
-        newGFF.append(['GENE_ID','locusLine'] + ['bin_'+str(n)+'_'+bamFile.split('/')[-1] for n in range(1,int(matrix)+1,1)])
+        yield ['GENE_ID','locusLine'] + ['bin_'+str(n)+'_'+bamFile.split('/')[-1] for n in range(1,int(matrix)+1,1)]
         nBin = int(matrix)
 
-    #getting and processing reads for gff lines
-    ticker = 0
-    print('Number lines processed')
+    #getting the regions to liquidate for gff lines
+    gffLoci = []
+    lineBinSizes = []
+    regionList = []
     for line in gff:
         line = line[0:9]
-        if ticker%100 == 0:
-            print ticker
-        ticker+=1
         gffLocus = Locus(line[0],int(line[3]),int(line[4]),line[6],line[1])
         
         #get the nBin and binSize
@@ -89,15 +176,36 @@ def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram
             bamSense = gffLocus.sense()
         else:
             bamSense = '.'
-        #using the bamLiquidator to get the readstring            
-        #print('using nBin of %s' % nBin)
-        bamliquidatorString = '/usr/bin/bamliquidator'
-        bamCommand = "%s %s %s %s %s %s %s %s" % (bamliquidatorString,bamFile,line[0],gffLocus.start(),gffLocus.end(),bamSense,nBin,extension)
-        #print(bamCommand)
-        getReads = subprocess.Popen(bamCommand,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
-        readString = getReads.communicate()
-        denList = readString[0].split('\n')[:-1]
-        
+        gffLoci.append(gffLocus)
+        lineBinSizes.append(binSize)
+        regionList.append((line[0],gffLocus.start(),gffLocus.end(),bamSense,nBin,extension))
+
+    #using the bamLiquidator to get the readstrings, parsing each as it comes back
+    ownWorker = False
+    if native:
+        worker = None
+    elif worker == None and os.access(bamliquidatorString,os.X_OK):
+        worker = LiquidatorWorker()
+        ownWorker = True
+    if worker:
+        denLists = worker.liquidate(bamFile,regionList)
+    else:
+        if not native:
+            print('%s not found, using the python liquidator' % (bamliquidatorString))
+        denLists = pythonLiquidate(bamFile,regionList)
+
+    #progress records in place of a line counter
+    telemetry = Telemetry(telemetryFile,'bamToGFF_turbo',len(regionList),label = bamFile)
+    for i in range(len(regionList)):
+        fetchStart = time.time()
+        denList = denLists.next()
+        binStart = time.time()
+        telemetry.addTime('fetch',binStart-fetchStart)
+        if worker:
+            telemetry.addSubprocesses(1)
+        gffLocus = gffLoci[i]
+        binSize = lineBinSizes[i]
+
         #flip the denList if the actual gff region is -
         if gffLocus.sense() == '-':
             denList = denList[::-1]
@@ -108,9 +216,16 @@ def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram
         #if the gff region is - strand, flip the
 
         clusterLine = [gffLocus.ID(),gffLocus.__str__()] + denList
-        newGFF.append(clusterLine)
-            
-    return newGFF
+        telemetry.addTime('bin',time.time()-binStart)
+        #time spent while the row is out is time spent writing it
+        outputStart = time.time()
+        yield clusterLine
+        telemetry.addTime('output',time.time()-outputStart)
+        telemetry.tick()
+    telemetry.close()
+
+    if ownWorker:
+        worker.close()
         
                 
                 
@@ -120,6 +235,28 @@ def mapBamToGFF(bamFile,gff,sense = '.',extension = 200,rpm = False,clusterGram
             
                 
     
+def mapBamToGFFs(bamFile,gffList,sense = '.',extension = 200,rpm = False,clusterGram = None,matrix = None,telemetryFile = '',native = False):
+    '''
+    maps reads from a bam to several gffs in one process and yields (gffIndex,row)
+    pairs in gff order as the rows are mapped.
+    the bam reads are only counted once for the rpm normalization.
+    with native every gff is mapped in process by pythonLiquidate
+    '''
+    if rpm:
+        MMR= round(float(Bam(bamFile).getTotalReads('mapped'))/1000000,4)
+    else:
+        MMR = 1
+    if not native and os.access(bamliquidatorString,os.X_OK):
+        worker = LiquidatorWorker()
+    else:
+        worker = None
+    for i in range(len(gffList)):
+        for row in mapBamToGFF(bamFile,gffList[i],sense,extension,rpm,clusterGram,matrix,MMR,worker,telemetryFile,native):
+            yield i,row
+    if worker:
+        worker.close()
+
+
 def convertEnrichedRegionsToGFF(enrichedRegionFile):
     '''converts a young lab enriched regions file into a gff'''
     newGFF = []
@@ -144,10 +281,10 @@ def main():
     parser.add_option("-b","--bam", dest="bam",nargs = 1, default=None,
                       help = "Enter .bam file to be processed.")
     parser.add_option("-i","--input", dest="input",nargs = 1, default=None,
-                      help = "Enter .gff or ENRICHED REGION file to be processed.")
+                      help = "Enter .gff or ENRICHED REGION file to be processed. Enter a comma separated list to map several files at once")
     #output flag
     parser.add_option("-o","--output", dest="output",nargs = 1, default=None,
-                      help = "Enter the output filename.")
+                      help = "Enter the output filename. Enter a comma separated list with one output per input file")
     #additional options
     parser.add_option("-s","--sense", dest="sense",nargs = 1, default='.',
                       help = "Map to '+','-' or 'both' strands. Default maps to both.")
@@ -159,6 +296,14 @@ def main():
                       help = "Outputs a fixed bin size clustergram. user must specify bin size.")
     parser.add_option("-m","--matrix", dest="matrix",nargs = 1, default=None,
                       help = "Outputs a variable bin sized matrix. User must specify number of bins.")
+    parser.add_option("--telemetry", dest="telemetry",nargs = 1, default='',
+                      help = "Enter a file to append JSON lines progress records to while mapping")
+    parser.add_option("--profile", dest="profile",nargs = 1, default='',
+                      help = "Enter a folder to write a profile of the mapping run to")
+    parser.add_option("--metrics", dest="metrics",nargs = 1, default='',
+                      help = "Enter the run metrics report of a ROSE run to record the resources of the mapping run in")
+    parser.add_option("--native", dest="native",action = 'store_true', default=False,
+                      help = "If flagged, maps in process with the python liquidator instead of starting bamliquidator for every region")
     (options,args) = parser.parse_args()
 
     print(options)
@@ -195,27 +340,34 @@ def main():
     
     
     if options.input and options.bam:
-        inputFile = options.input
-        if inputFile.split('.')[-1] != 'gff':
-            print('converting file to a .gff')
-            gffFile = convertEnrichedRegionsToGFF(inputFile)
-        else:
-            gffFile = inputFile
+        inputFileList = options.input.split(',')
+        gffFileList = []
+        for inputFile in inputFileList:
+            if inputFile.split('.')[-1] != 'gff':
+                print('converting file to a .gff')
+                gffFileList.append(convertEnrichedRegionsToGFF(inputFile))
+            else:
+                gffFileList.append(inputFile)
 
         bamFile = options.bam
         
         if options.output == None:
-            output = os.getcwd() + inputFile.split('/')[-1]+'.mapped'
+            outputList = [os.getcwd() + inputFile.split('/')[-1]+'.mapped' for inputFile in inputFileList]
         else:
-            output = options.output
+            outputList = options.output.split(',')
+        if len(outputList) != len(inputFileList):
+            print('ERROR: number of output files must match the number of input files')
+            parser.print_help()
+            exit()
         if options.cluster:
             print('mapping to GFF and making clustergram with fixed bin width')
-            newGFF = mapBamToGFF(bamFile,gffFile,options.sense,int(options.extension),options.rpm,int(options.cluster),None)
+            newGFFRows = mapBamToGFFs(bamFile,gffFileList,options.sense,int(options.extension),options.rpm,int(options.cluster),None,options.telemetry,options.native)
         elif options.matrix:
             print('mapping to GFF and making a matrix with fixed bin number')
-            newGFF = mapBamToGFF(bamFile,gffFile,options.sense,int(options.extension),options.rpm,None,int(options.matrix))
-            
-        unParseTable(newGFF,output,'\t')
+            newGFFRows = mapBamToGFFs(bamFile,gffFileList,options.sense,int(options.extension),options.rpm,None,int(options.matrix),options.telemetry,options.native)
+
+        #rows are written as they are mapped, so the mapping is measured with the writing
+        StageMetrics(options.metrics).measure('mapBamToGFF',bamFile,profileCall,options.profile,'bamToGFF_turbo_%s' % (outputList[0].split('/')[-1]),unParseTables,newGFFRows,outputList,'\t')
     else:
         parser.print_help()
         
@@ -0,0 +1,232 @@
+#ROSE_batch.py
+
+'''
+PROGRAM TO RUN ROSE ON MANY SAMPLES OF ONE GENOME
+LOADS THE ANNOTATION AND TSS COLLECTIONS ONCE, RUNS INDEPENDENT SAMPLES AT THE SAME TIME
+AND WRITES ONE SUMMARY OF THE WHOLE BATCH
+'''
+
+import sys
+
+
+
+import ROSE_utils
+
+import ROSE_main
+
+import os
+
+import copy
+
+import time
+
+import traceback
+
+import multiprocessing
+
+from string import join
+
+
+#==================================================================
+#==========================MANIFEST================================
+#==================================================================
+
+#the manifest is a tab delimited table with a line per sample of
+#NAME  INPUT_GFF_OR_BED  RANKBY_BAM  [CONTROL_BAM]  [COMMA_SEPARATED_EXTRA_BAMS]
+#lines starting with # are skipped and NONE or an empty field means no control
+
+def parseManifest(manifestFile):
+
+    '''
+    returns a list of sample dicts from a batch manifest
+    '''
+
+    samples = []
+    for line in ROSE_utils.parseTable(manifestFile,'\t'):
+        if len(line) == 0 or len(line[0].strip()) == 0 or line[0][0] == '#':
+            continue
+        line = [field.strip() for field in line] + ['','']
+        if len(line[1]) == 0 or len(line[2]) == 0:
+            print('ERROR: SAMPLE %s NEEDS AN INPUT AND A RANKBY BAM' % (line[0]))
+            sys.exit(1)
+        sample = {'name':line[0],'input':line[1],'rankby':line[2],'control':None,'bams':None}
+        if len(line[3]) > 0 and line[3] != 'NONE':
+            sample['control'] = line[3]
+        if len(line[4]) > 0:
+            sample['bams'] = line[4]
+        samples.append(sample)
+
+    names = [sample['name'] for sample in samples]
+    if len(names) != len(ROSE_utils.uniquify(names)):
+        print('ERROR: SAMPLE NAMES IN %s ARE NOT UNIQUE' % (manifestFile))
+        sys.exit(1)
+    for sample in samples:
+        if sample['name'].count('/') > 0:
+            print('ERROR: SAMPLE NAME %s CANNOT CONTAIN /' % (sample['name']))
+            sys.exit(1)
+        for inputFile in [sample['input'],sample['rankby'],sample['control']]:
+            if inputFile and not os.path.exists(inputFile):
+                print('ERROR: SAMPLE %s IS MISSING %s' % (sample['name'],inputFile))
+                sys.exit(1)
+    return samples
+
+
+#==================================================================
+#=========================RUNNING SAMPLES==========================
+#==================================================================
+
+def runSample(sampleOptions,annotation,logFile):
+
+    '''
+    runs ROSE on one sample, sending its output and that of every process
+    it starts to logFile. returns the exit code
+    '''
+
+    log = open(logFile,'w')
+    os.dup2(log.fileno(),1)
+    os.dup2(log.fileno(),2)
+    try:
+        ROSE_main.runROSE(sampleOptions,annotation)
+        return 0
+    except SystemExit,error:
+        if error.code == None:
+            return 0
+        if isinstance(error.code,int):
+            return error.code
+        print(error.code)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def countEnhancers(tableFile):
+
+    '''
+    returns the number of enhancers in a callSuper table, or '' if it is missing
+    '''
+
+    if not os.path.exists(tableFile):
+        return ''
+    table = ROSE_utils.parseTable(tableFile,'\t')
+    return len([line for line in table if len(line[0]) > 0 and line[0][0] != '#' and line[0] != 'REGION_ID'])
+
+
+def runBatch(samples,options,annotation,outFolder,nSamples):
+
+    '''
+    runs up to nSamples samples at once, each in a forked process that
+    shares the loaded annotation. returns a summary table
+    '''
+
+    pending = list(samples)
+    running = {}
+    for sample in samples:
+        sample['out'] = ROSE_utils.formatFolder(outFolder + sample['name'] + '/',True)
+        sample['log'] = '%s%s_ROSE.log' % (sample['out'],sample['name'])
+
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < nSamples:
+            sample = pending.pop(0)
+            sampleOptions = copy.copy(options)
+            sampleOptions.input = sample['input']
+            sampleOptions.rankby = sample['rankby']
+            sampleOptions.control = sample['control']
+            sampleOptions.out = sample['out']
+            if sample['bams']:
+                sampleOptions.bams = sample['bams']
+            print('STARTING SAMPLE %s, LOGGING TO %s' % (sample['name'],sample['log']))
+            #anything left in the buffers would otherwise be written again by the child
+            sys.stdout.flush()
+            sys.stderr.flush()
+            sample['start'] = time.time()
+            pid = os.fork()
+            if pid == 0:
+                os._exit(runSample(sampleOptions,annotation,sample['log']))
+            running[pid] = sample
+
+        #blocks until a sample exits, including one killed outright
+        pid,status = os.wait()
+        if pid not in running:
+            continue
+        sample = running.pop(pid)
+        sample['end'] = time.time()
+        if os.WIFEXITED(status):
+            sample['returncode'] = os.WEXITSTATUS(status)
+        else:
+            sample['returncode'] = 128 + os.WTERMSIG(status)
+
+        inputName = sample['input'].split('/')[-1].split('.')[0]
+        sample['enhancers'] = countEnhancers('%s%s_AllEnhancers.table.txt' % (sample['out'],inputName))
+        sample['superEnhancers'] = countEnhancers('%s%s_SuperEnhancers.table.txt' % (sample['out'],inputName))
+        if sample['returncode'] == 0 and sample['enhancers'] != '':
+            sample['status'] = 'done'
+            print('SAMPLE %s FINISHED IN %.1f MINUTES' % (sample['name'],(sample['end']-sample['start'])/60))
+        else:
+            sample['status'] = 'failed'
+            print('ERROR: SAMPLE %s FAILED WITH EXIT CODE %s, SEE %s' % (sample['name'],sample['returncode'],sample['log']))
+
+    summary = [['SAMPLE','STATUS','EXIT_CODE','MINUTES','ENHANCERS','SUPER_ENHANCERS','OUTPUT_FOLDER','LOG']]
+    for sample in samples:
+        summary.append([sample['name'],sample['status'],sample['returncode'],'%.2f' % ((sample['end']-sample['start'])/60),
+                        sample['enhancers'],sample['superEnhancers'],sample['out'],sample['log']])
+    return summary
+
+
+#==================================================================
+#=========================MAIN METHOD==============================
+#==================================================================
+
+def main():
+    '''
+    main run call
+    '''
+    #every ROSE_main flag applies to all samples of the batch
+    parser = ROSE_main.makeParser()
+    parser.set_usage("usage: %prog [options] -g [GENOME] -m [MANIFEST] -o [OUTPUT_FOLDER] [OPTIONAL_FLAGS]")
+    parser.add_option("-m","--manifest", dest="manifest",nargs = 1, default=None,
+                      help = "Enter a tab delimited manifest of NAME, INPUT, RANKBY_BAM and optional CONTROL_BAM and EXTRA_BAMS per sample")
+    parser.add_option("-n","--samples", dest="samples",nargs = 1, default=None,
+                      help = "Enter the number of samples to run at once. Default is half the number of cpus")
+
+    (options,args) = parser.parse_args()
+
+    if not options.manifest or not options.out or not options.genome:
+        parser.print_help()
+        exit()
+
+    outFolder = ROSE_utils.formatFolder(options.out,True)
+    samples = parseManifest(options.manifest)
+    print('RUNNING %s SAMPLES FROM %s' % (len(samples),options.manifest))
+
+    if options.samples:
+        nSamples = int(options.samples)
+    else:
+        nSamples = max(1,multiprocessing.cpu_count()/2)
+
+    #THE ANNOTATION IS ONLY NEEDED FOR TSS EXCLUSION
+    #LOADED HERE ONCE, EVERY SAMPLE INHERITS IT WHEN FORKED
+    annotFile = ROSE_main.getAnnotFile(options.genome)
+    if int(options.tss) != 0:
+        annotation = ROSE_main.loadAnnotation(annotFile,[int(options.tss),50])
+    else:
+        annotation = None
+
+    batchStart = time.time()
+    summary = runBatch(samples,options,annotation,outFolder,nSamples)
+    summaryFile = outFolder + 'batch_summary.txt'
+    ROSE_utils.unParseTable(summary,summaryFile,'\t')
+
+    failed = [line[0] for line in summary[1:] if line[1] != 'done']
+    print('BATCH OF %s SAMPLES TOOK %.1f MINUTES' % (len(samples),(time.time()-batchStart)/60))
+    print('WROTE SUMMARY TO %s' % (summaryFile))
+    if len(failed) > 0:
+        print('ERROR: %s SAMPLES FAILED: %s' % (len(failed),join(failed,',')))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+#ROSE_benchmark.py
+
+'''
+PROGRAM TO TIME THE STAGES OF ROSE ON SYNTHETIC DATA AND CATCH PERFORMANCE REGRESSIONS
+WRITES SORTED AND INDEXED BAMS, A CONSTITUENT GFF AND A REFSEQ ANNOTATION OF CONFIGURABLE SIZE
+WITHOUT SAMTOOLS OR NETWORK ACCESS, TIMES EACH STAGE AND COMPARES THE TIMES TO A JSON BASELINE
+'''
+
+import sys
+
+
+
+import ROSE_utils
+
+import ROSE_bamToGFF
+
+import ROSE_main
+
+import ROSE_geneMapper
+
+import ROSE_callSuper
+
+import os
+
+import time
+
+import json
+
+import random
+
+import struct
+
+import zlib
+
+import platform
+
+from string import join
+
+
+#==================================================================
+#=====================SYNTHETIC BAM WRITER=========================
+#==================================================================
+
+#largest amount of uncompressed data held by one BGZF block
+BGZF_BLOCK_SIZE = 0xff00
+
+#empty BGZF block that marks the end of a bam
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+def reg2bin(beg,end):
+    '''
+    returns the smallest bin holding the 0-based half open interval [beg,end)
+    following the SAM spec binning scheme
+    '''
+    end -= 1
+    if beg>>14 == end>>14: return 4681 + (beg>>14)
+    if beg>>17 == end>>17: return 585 + (beg>>17)
+    if beg>>20 == end>>20: return 73 + (beg>>20)
+    if beg>>23 == end>>23: return 9 + (beg>>23)
+    if beg>>26 == end>>26: return 1 + (beg>>26)
+    return 0
+
+
+def bgzfBlock(data):
+    '''
+    compresses data into one BGZF block
+    '''
+    compressor = zlib.compressobj(6,zlib.DEFLATED,-15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH',31,139,8,4,0,0,255,6,66,67,2,len(cdata)+25)
+    return header + cdata + struct.pack('<iI',zlib.crc32(data),len(data))
+
+
+class BamWriter:
+    '''
+    writes a sorted bam and its .bai index
+    records must be added in coordinate order
+    '''
+
+    def __init__(self,bamFile,chromSizes):
+        self._bamFile = bamFile
+        self._fh = open(bamFile,'wb')
+        self._pieces = []
+        self._size = 0
+        self._coffset = 0
+        self._refs = [chrom for chrom,size in chromSizes]
+        self._index = [{'bins':{},'linear':{},'first':None,'last':None,'mapped':0} for chrom in self._refs]
+        text = join(['@SQ\tSN:%s\tLN:%s\n' % (chrom,size) for chrom,size in chromSizes],'')
+        header = 'BAM\x01' + struct.pack('<i',len(text)) + text + struct.pack('<i',len(chromSizes))
+        for chrom,size in chromSizes:
+            header += struct.pack('<i',len(chrom)+1) + chrom + '\x00' + struct.pack('<i',size)
+        self.__write(header)
+
+    def __flush(self,final = False):
+        if self._size < BGZF_BLOCK_SIZE and not (final and self._size > 0):
+            return
+        data = join(self._pieces,'')
+        while len(data) >= BGZF_BLOCK_SIZE or (final and len(data) > 0):
+            block = bgzfBlock(data[0:BGZF_BLOCK_SIZE])
+            self._fh.write(block)
+            self._coffset += len(block)
+            data = data[BGZF_BLOCK_SIZE:]
+        self._pieces = [data]
+        self._size = len(data)
+
+    def __write(self,data):
+        self._pieces.append(data)
+        self._size += len(data)
+        self.__flush()
+
+    def __voffset(self):
+        return self._coffset<<16 | self._size
+
+    def addRead(self,refID,pos,readLength,minus,packedSeq,name):
+        '''
+        adds an unspliced read of readLength bases at the 0-based pos
+        packedSeq is the 4 bit packed sequence of the read
+        '''
+        end = pos + readLength
+        flag = 16 if minus else 0
+        core = struct.pack('<iiBBHHHiiii',refID,pos,len(name)+1,60,reg2bin(pos,end),1,flag,readLength,-1,-1,0)
+        body = core + name + '\x00' + struct.pack('<I',readLength<<4) + packedSeq + '\xff'*readLength
+        start = self.__voffset()
+        self.__write(struct.pack('<i',len(body)) + body)
+        stop = self.__voffset()
+
+        ref = self._index[refID]
+        chunks = ref['bins'].setdefault(reg2bin(pos,end),[])
+        if len(chunks) > 0 and chunks[-1][1] == start:
+            chunks[-1][1] = stop
+        else:
+            chunks.append([start,stop])
+        for window in range(pos>>14,((end-1)>>14)+1):
+            if not ref['linear'].has_key(window):
+                ref['linear'][window] = start
+        if ref['first'] == None:
+            ref['first'] = start
+        ref['last'] = stop
+        ref['mapped'] += 1
+
+    def close(self):
+        '''
+        finishes the bam and writes its index next to it
+        '''
+        self.__flush(True)
+        self._fh.write(BGZF_EOF)
+        self._fh.close()
+
+        bai = ['BAI\x01',struct.pack('<i',len(self._index))]
+        for ref in self._index:
+            bins = sorted(ref['bins'].items())
+            hasMeta = ref['first'] != None
+            bai.append(struct.pack('<i',len(bins) + int(hasMeta)))
+            for bin,chunks in bins:
+                bai.append(struct.pack('<Ii',bin,len(chunks)))
+                for chunkStart,chunkEnd in chunks:
+                    bai.append(struct.pack('<QQ',chunkStart,chunkEnd))
+            if hasMeta:
+                bai.append(struct.pack('<IiQQQQ',ROSE_utils.BAI_PSEUDO_BIN,2,ref['first'],ref['last'],ref['mapped'],0))
+            nWindows = max(ref['linear'].keys()) + 1 if len(ref['linear']) > 0 else 0
+            bai.append(struct.pack('<i',nWindows))
+            offset = 0
+            for window in range(nWindows):
+                offset = ref['linear'].get(window,offset)
+                bai.append(struct.pack('<Q',offset))
+        bai.append(struct.pack('<Q',0))
+        baiFile = open(self._bamFile + '.bai','wb')
+        baiFile.write(join(bai,''))
+        baiFile.close()
+
+
+#==================================================================
+#======================SYNTHETIC DATA==============================
+#==================================================================
+
+def packSequence(seq):
+    '''
+    packs a sequence of bases 4 bits per base as a bam stores it
+    '''
+    codes = [ROSE_utils.SEQ_CODES.index(base) for base in seq] + [0]
+    return join([chr(codes[i]<<4 | codes[i+1]) for i in range(0,len(seq),2)],'')
+
+
+def makeSyntheticGFF(gffFile,chromSizes,nRegions,rand):
+    '''
+    writes a constituent gff of nRegions enriched regions of 200bp to 5kb
+    returns the regions as (chrom,start,end) tuples
+    '''
+    genomeSize = sum([size for chrom,size in chromSizes])
+    regions = []
+    for chrom,size in chromSizes:
+        for i in range(max(1,nRegions*size/genomeSize)):
+            start = rand.randint(1,size-5000)
+            regions.append((chrom,start,start + rand.randint(200,5000)))
+    regions.sort()
+
+    gff = []
+    for i in range(len(regions)):
+        chrom,start,end = regions[i]
+        regionID = 'region_%s' % (i+1)
+        gff.append([chrom,regionID,'',start,end,'','.','',regionID])
+    ROSE_utils.unParseTable(gff,gffFile,'\t')
+    return regions
+
+
+def makeSyntheticBam(bamFile,chromSizes,nReads,regions,peakFraction,rand,readLength = 50):
+    '''
+    writes a sorted and indexed bam of nReads reads
+    peakFraction of the reads fall in the given regions, the rest are spread evenly
+    '''
+    bases = 'ACGT'
+    sequences = [packSequence(join([rand.choice(bases) for j in range(readLength)],'')) for i in range(64)]
+    genomeSize = sum([size for chrom,size in chromSizes])
+
+    writer = BamWriter(bamFile,chromSizes)
+    readID = 0
+    for refID in range(len(chromSizes)):
+        chrom,size = chromSizes[refID]
+        chromRegions = [region for region in regions if region[0] == chrom]
+        nChromReads = nReads*size/genomeSize
+        positions = []
+        for i in range(nChromReads):
+            if len(chromRegions) > 0 and rand.random() < peakFraction:
+                region = rand.choice(chromRegions)
+                positions.append(rand.randint(region[1],region[2]))
+            else:
+                positions.append(rand.randint(0,size-readLength))
+        positions.sort()
+        for pos in positions:
+            readID += 1
+            writer.addRead(refID,min(pos,size-readLength),readLength,rand.random() < 0.5,rand.choice(sequences),'read%s' % (readID))
+    writer.close()
+
+
+def makeSyntheticAnnotation(annotFile,chromSizes,nGenes,rand):
+    '''
+    writes a UCSC refseq table of nGenes single exon genes
+    '''
+    genomeSize = sum([size for chrom,size in chromSizes])
+    header = ['#bin','name','chrom','strand','txStart','txEnd','cdsStart','cdsEnd','exonCount','exonStarts','exonEnds','score','name2','cdsStartStat','cdsEndStat','exonFrames']
+    annotTable = [header]
+    geneID = 0
+    for chrom,size in chromSizes:
+        for i in range(max(1,nGenes*size/genomeSize)):
+            geneID += 1
+            start = rand.randint(1,size-100000)
+            end = start + rand.randint(1000,100000)
+            sense = rand.choice('+-')
+            annotTable.append([0,'NM_%s' % (geneID),chrom,sense,start,end,start,end,1,'%s,' % (start),'%s,' % (end),0,'GENE%s' % (geneID),'cmpl','cmpl','0,'])
+    ROSE_utils.unParseTable(annotTable,annotFile,'\t')
+
+
+def makeSyntheticData(dataFolder,params):
+    '''
+    writes the synthetic inputs described by params into dataFolder
+    the data are only rewritten when params change
+    returns a dictionary of the input files
+    '''
+    dataFolder = ROSE_utils.formatFolder(dataFolder,True)
+    dataFiles = {
+        'gff':dataFolder + 'SYNTHETIC.gff',
+        'rankBam':dataFolder + 'SYNTHETIC_RANK.bam',
+        'controlBam':dataFolder + 'SYNTHETIC_CONTROL.bam',
+        'annot':dataFolder + 'SYNTHETIC_refseq.ucsc',
+        }
+    paramsFile = dataFolder + 'params.json'
+    if os.path.exists(paramsFile) and json.load(open(paramsFile)) == params:
+        if len([fileName for fileName in dataFiles.values() if not os.path.exists(fileName)]) == 0:
+            print('USING SYNTHETIC DATA IN %s' % (dataFolder))
+            return dataFiles
+
+    print('WRITING SYNTHETIC DATA TO %s' % (dataFolder))
+    rand = random.Random(params['seed'])
+    chromSizes = [('chr%s' % (i+1),params['chromSize']) for i in range(params['chroms'])]
+    regions = makeSyntheticGFF(dataFiles['gff'],chromSizes,params['regions'],rand)
+    makeSyntheticBam(dataFiles['rankBam'],chromSizes,params['reads'],regions,0.5,rand)
+    makeSyntheticBam(dataFiles['controlBam'],chromSizes,params['reads'],regions,0.05,rand)
+    makeSyntheticAnnotation(dataFiles['annot'],chromSizes,params['genes'],rand)
+    json.dump(params,open(paramsFile,'w'),sort_keys=True)
+    return dataFiles
+
+
+#==================================================================
+#=========================STAGE TIMING=============================
+#==================================================================
+
+def timeStage(stageName,stageFunc,repeats):
+    '''
+    runs stageFunc repeats times and returns the best time in seconds
+    and the value of the last run
+    '''
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        value = stageFunc()
+        times.append(time.time()-start)
+    print('%s: best of %s runs %.3f sec' % (stageName,repeats,min(times)))
+    return min(times),value
+
+
+def runBenchmark(outFolder,params,repeats):
+    '''
+    times each stage of ROSE on synthetic data
+    returns a dictionary of best stage times in seconds
+    '''
+    dataFiles = makeSyntheticData(outFolder + 'data/',params)
+    runFolder = ROSE_utils.formatFolder(outFolder + 'run/',True)
+    mappedFolder = ROSE_utils.formatFolder(runFolder + 'mappedGFF/',True)
+    stageTimes = {}
+
+    #STITCHING
+    referenceCollection = ROSE_utils.gffToLocusCollection(dataFiles['gff'])
+    stageTimes['stitchCollection'],stitchedCollection = timeStage('stitchCollection',lambda: referenceCollection.stitchCollection(params['stitch'],'both'),repeats)
+    stitchedGFFName = 'SYNTHETIC_%sKB_STITCHED' % (params['stitch']/1000)
+    stitchedGFFFile = runFolder + stitchedGFFName + '.gff'
+    ROSE_utils.unParseTable(ROSE_utils.sortGFFByBam(ROSE_utils.locusCollectionToGFF(stitchedCollection),dataFiles['rankBam']),stitchedGFFFile,'\t')
+
+    #OVERLAP QUERIES IN BOTH DIRECTIONS
+    def overlapStage():
+        nOverlaps = 0
+        for locus in referenceCollection.getLoci():
+            nOverlaps += len(stitchedCollection.getOverlap(locus,'both'))
+        for locus in stitchedCollection.getLoci():
+            nOverlaps += len(referenceCollection.getOverlap(locus,'both'))
+        return nOverlaps
+    stageTimes['getOverlap'],nOverlaps = timeStage('getOverlap',overlapStage,repeats)
+
+    #MAPPING BOTH REGION SETS TO EACH BAM
+    bamFileList = [dataFiles['rankBam'],dataFiles['controlBam']]
+    def mapStage():
+        for bamFile in bamFileList:
+            bamFileName = bamFile.split('/')[-1]
+            outputList = ['%s%s_%s_MAPPED.gff' % (mappedFolder,stitchedGFFName,bamFileName),'%s%s_%s_MAPPED.gff' % (mappedFolder,'SYNTHETIC',bamFileName)]
+            newGFFRows = ROSE_bamToGFF.mapBamToGFFs(bamFile,[stitchedGFFFile,dataFiles['gff']],'both',200,1,True,1,True,processes = params['processes'])
+            ROSE_utils.unParseTables(newGFFRows,outputList,'\t')
+    stageTimes['mapBamToGFF'],value = timeStage('mapBamToGFF',mapStage,repeats)
+
+    #REGION MAP
+    regionMapFile = runFolder + stitchedGFFName + '_ENHANCER_REGION_MAP.txt'
+    stageTimes['mapCollection'],value = timeStage('mapCollection',lambda: ROSE_main.mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolder,regionMapFile,refName = stitchedGFFName),repeats)
+
+    #CUTOFF
+    enhancerFile = runFolder + 'SYNTHETIC_AllEnhancers.table.txt'
+    stageTimes['cutoff'],value = timeStage('cutoff',lambda: ROSE_callSuper.callSuper(runFolder,regionMapFile,'SYNTHETIC',bamFileList[1].split('/')[-1]),repeats)
+
+    #GENE MAPPING
+    stageTimes['mapEnhancerToGene'],value = timeStage('mapEnhancerToGene',lambda: ROSE_geneMapper.mapEnhancerToGene(dataFiles['annot'],enhancerFile,'',True,50000,False),repeats)
+
+    return stageTimes
+
+
+#==================================================================
+#======================BASELINE COMPARISON=========================
+#==================================================================
+
+def compareBaseline(results,baseline,threshold,floor):
+    '''
+    returns the stages that took more than (1+threshold) times their baseline time
+    and more than floor seconds longer
+    '''
+    regressed = []
+    for stage in sorted(results['stages'].keys()):
+        seconds = results['stages'][stage]
+        baseSeconds = baseline['stages'].get(stage)
+        if seconds == None or baseSeconds == None:
+            print('%s: not timed in both runs' % (stage))
+            continue
+        change = (seconds-baseSeconds)/max(baseSeconds,1e-9)
+        status = 'ok'
+        if seconds > baseSeconds*(1+threshold) and seconds-baseSeconds > floor:
+            status = 'REGRESSED'
+            regressed.append(stage)
+        print('%s: %.3f sec vs baseline %.3f sec (%+.1f%%) %s' % (stage,seconds,baseSeconds,100*change,status))
+    return regressed
+
+
+#==================================================================
+#=========================MAIN METHOD==============================
+#==================================================================
+
+def main():
+    '''
+    main run call
+    '''
+    from optparse import OptionParser
+    usage = "usage: %prog [options] -o [OUTPUT_FOLDER]"
+    parser = OptionParser(usage = usage)
+    #required flags
+    parser.add_option("-o","--out", dest="out",nargs = 1, default=None,
+                      help = "Enter an output folder for the synthetic data and results")
+
+    #optional flags
+    parser.add_option("-n","--reads", dest="reads",nargs = 1, default=200000,
+                      help = "Enter the number of reads in each synthetic bam. Default is 200,000")
+    parser.add_option("-r","--regions", dest="regions",nargs = 1, default=5000,
+                      help = "Enter the number of constituent regions. Default is 5,000")
+    parser.add_option("-g","--genes", dest="genes",nargs = 1, default=2000,
+                      help = "Enter the number of annotated genes. Default is 2,000")
+    parser.add_option("-c","--chroms", dest="chroms",nargs = 1, default=3,
+                      help = "Enter the number of chromosomes. Default is 3")
+    parser.add_option("--chromsize", dest="chromSize",nargs = 1, default=10000000,
+                      help = "Enter the length of each chromosome. Default is 10Mb")
+    parser.add_option("-s","--stitch", dest="stitch",nargs = 1, default=12500,
+                      help = "Enter a max linking distance for stitching. Default is 12,500")
+    parser.add_option("--seed", dest="seed",nargs = 1, default=1,
+                      help = "Enter a random seed for the synthetic data. Default is 1")
+    parser.add_option("-p","--processes", dest="processes",nargs = 1, default=1,
+                      help = "Enter the number of processes used to map each bam. Default is 1")
+    parser.add_option("--repeats", dest="repeats",nargs = 1, default=3,
+                      help = "Enter the number of times each stage is run. The best time is kept. Default is 3")
+    parser.add_option("-b","--baseline", dest="baseline",nargs = 1, default=None,
+                      help = "Enter a JSON baseline to compare the stage times against")
+    parser.add_option("--save", dest="save",action = 'store_true', default=False,
+                      help = "If flagged, saves the stage times as the baseline instead of comparing to it")
+    parser.add_option("-t","--threshold", dest="threshold",nargs = 1, default=0.25,
+                      help = "Enter the fraction a stage may slow down before it counts as a regression. Default is 0.25")
+    parser.add_option("--floor", dest="floor",nargs = 1, default=0.05,
+                      help = "Enter the number of seconds a stage may slow down regardless of threshold. Default is 0.05")
+
+    (options,args) = parser.parse_args()
+
+    if not options.out:
+        parser.print_help()
+        exit()
+
+    outFolder = ROSE_utils.formatFolder(options.out,True)
+
+    params = {
+        'reads':int(options.reads),
+        'regions':int(options.regions),
+        'genes':int(options.genes),
+        'chroms':int(options.chroms),
+        'chromSize':int(options.chromSize),
+        'stitch':int(options.stitch),
+        'seed':int(options.seed),
+        'processes':int(options.processes),
+        }
+
+    stageTimes = runBenchmark(outFolder,params,int(options.repeats))
+
+    results = {
+        'params':params,
+        'stages':stageTimes,
+        'repeats':int(options.repeats),
+        'python':platform.python_version(),
+        'host':platform.node(),
+        'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+    resultsFile = outFolder + 'benchmark.json'
+    json.dump(results,open(resultsFile,'w'),sort_keys=True,indent=1)
+    print('WROTE STAGE TIMES TO %s' % (resultsFile))
+
+    if options.baseline and options.save:
+        json.dump(results,open(options.baseline,'w'),sort_keys=True,indent=1)
+        print('SAVED BASELINE TO %s' % (options.baseline))
+
+    elif options.baseline:
+        baseline = json.load(open(options.baseline))
+        if baseline['params'] != params:
+            print('ERROR: BASELINE %s WAS MADE WITH DIFFERENT PARAMETERS' % (options.baseline))
+            print(baseline['params'])
+            sys.exit(1)
+        regressed = compareBaseline(results,baseline,float(options.threshold),float(options.floor))
+        if len(regressed) > 0:
+            print('ERROR: %s STAGES REGRESSED BEYOND THRESHOLD: %s' % (len(regressed),join(regressed,',')))
+            sys.exit(1)
+        print('NO REGRESSIONS')
+
+
+if __name__ == "__main__":
+    main()
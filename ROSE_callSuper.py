@@ -0,0 +1,348 @@
+#ROSE_callSuper.py
+
+'''
+PROGRAM TO CALL SUPER-ENHANCERS FROM AN ENHANCER REGION MAP
+A PYTHON PORT OF ROSE_callSuper.R THAT WRITES THE SAME TABLES AND BEDS WITHOUT R
+RANKS STITCHED ENHANCERS BY BACKGROUND SUBTRACTED SIGNAL AND SEPARATES THEM AT THE HOCKEY STICK CUTOFF
+'''
+
+import sys
+
+
+
+import ROSE_utils
+
+import re
+
+import time
+
+import numpy
+
+from string import join
+
+from collections import defaultdict
+
+
+#==================================================================
+#====================R COMPATIBLE FORMATTING=======================
+#==================================================================
+
+#the tables are read and written the way read.delim and write.table do in
+#ROSE_callSuper.R so that the outputs of the two stay interchangeable
+
+#significant digits R prints a double with
+R_DIGITS = 15
+
+R_RESERVED = ['if','else','repeat','while','function','for','next','break','TRUE','FALSE','NULL',
+              'Inf','NaN','NA','NA_integer_','NA_real_','NA_character_','in']
+
+def formatRNumber(value):
+
+    '''
+    formats a double the way R prints it: with the fewest significant
+    digits, up to 15, that give the same value, in fixed or scientific
+    notation, whichever is narrower
+    '''
+
+    value = float(value)
+    if value != value:
+        return 'NA'
+    if value in (float('inf'),float('-inf')):
+        return ['-Inf','Inf'][value > 0]
+    if value == 0:
+        return '0'
+    target = float('%.*e' % (R_DIGITS-1,value))
+    for sig in range(1,R_DIGITS+1):
+        sciText = '%.*e' % (sig-1,value)
+        if float(sciText) == target:
+            break
+    mantissa,exponent = sciText.split('e')
+    exponent = int(exponent)
+    sciText = '%se%s%02d' % (mantissa,['+','-'][exponent < 0],abs(exponent))
+    fixedText = '%.*f' % (max(0,sig-1-exponent),value)
+    if len(fixedText) <= len(sciText):
+        return fixedText
+    return sciText
+
+
+def makeRNames(names):
+
+    '''
+    makes column names syntactically valid and unique like R's make.names
+    '''
+
+    rNames = []
+    nameCounts = defaultdict(int)
+    for name in names:
+        rName = re.sub('[^A-Za-z0-9._]','.',name)
+        if not re.match('[A-Za-z]|[.](?![0-9])',rName):
+            rName = 'X' + rName
+        if rName in R_RESERVED:
+            rName += '.'
+        #repeated names get .1, .2 and so on
+        if nameCounts[rName] > 0:
+            rNames.append('%s.%s' % (rName,nameCounts[rName]))
+        else:
+            rNames.append(rName)
+        nameCounts[rName] += 1
+    return rNames
+
+
+def formatRColumns(rows):
+
+    '''
+    formats the columns of a table the way read.delim types them and
+    write.table prints them: whole numbers as integers, other numbers as
+    doubles and everything else as text
+    '''
+
+    formatted = [list(line) for line in rows]
+    if len(rows) == 0:
+        return formatted
+    for j in range(len(rows[0])):
+        column = [line[j] for line in rows if line[j] != 'NA']
+        if len([x for x in column if not re.match('^-?[0-9]+$',x)]) == 0 and max([abs(int(x)) for x in column] + [0]) < 2**31:
+            for line in formatted:
+                if line[j] != 'NA':
+                    line[j] = str(int(line[j]))
+            continue
+        try:
+            [float(x) for x in column]
+        except ValueError:
+            continue
+        for line in formatted:
+            if line[j] != 'NA':
+                line[j] = formatRNumber(line[j])
+    return formatted
+
+
+#==================================================================
+#==========================CUTOFF==================================
+#==================================================================
+
+def calculateCutoff(signalVector):
+
+    '''
+    finds the hockey stick cutoff of a signal vector: the point where a
+    diagonal sliding along the ranked signal is tangent to it. returns a
+    dict of the absolute cutoff, the cutoff over the median and over the
+    mean, and x, the rank of the tangent point
+    '''
+
+    inputVector = numpy.sort(numpy.maximum(numpy.asarray(signalVector,dtype=float),0))
+    nPoints = len(inputVector)
+    slope = (inputVector[-1]-inputVector[0])/nPoints
+
+    #a line of this slope through point x has below it every point i with
+    #inputVector[i]-slope*i <= inputVector[x]-slope*x, so the tangent point,
+    #which has the fewest points below its line, is where that difference is
+    #smallest. R searches for it with optimize, this finds it exactly
+    xPts = numpy.arange(1,nPoints+1)
+    xPt = int(numpy.argmin(inputVector-slope*xPts)) + 1
+    yCutoff = inputVector[xPt-1]
+
+    median = numpy.median(inputVector)
+    mean = numpy.mean(inputVector)
+    return {'absolute':float(yCutoff),
+            'overMedian':float(yCutoff/median) if median else float('inf'),
+            'overMean':float(yCutoff/mean) if mean else float('inf'),
+            'x':xPt}
+
+
+#==================================================================
+#=========================OUTPUT WRITERS===========================
+#==================================================================
+
+def writeEnhancerBed(bedRows,trackName,trackDescription,outputFile,superRows,baseColor = '0,0,0',superColor = '255,0,0'):
+
+    '''
+    writes a two track bed of all the enhancers and of the super-enhancers
+    '''
+
+    trackDescription = (trackDescription + '\nCreated on ' + time.strftime('%b %d %Y')).replace('\n','\t')
+    tName = trackName.replace(' ','_')
+    bed = open(outputFile,'w')
+    bed.write('track name="%s" description="%s" itemRGB=On color=%s\n' % (tName,trackDescription,baseColor))
+    for line in bedRows:
+        bed.write(join(line,'\t') + '\n')
+    bed.write('\ntrack name="Super_%s" description="Super %s" itemRGB=On color=%s\n' % (tName,trackDescription,superColor))
+    for i in superRows:
+        bed.write(join(bedRows[i],'\t') + '\n')
+    bed.close()
+
+
+def writeGatewayBeds(bedRows,outputFileRoot,superRows):
+
+    '''
+    writes the WUSTL gateway beds of all the enhancers and of the super-enhancers
+    '''
+
+    gatewayRows = [line + ['.'] for line in bedRows]
+    ROSE_utils.unParseTable(gatewayRows,outputFileRoot + '_Gateway_Enhancers.bed','\t')
+    ROSE_utils.unParseTable([gatewayRows[i] for i in superRows],outputFileRoot + '_Gateway_SuperEnhancers.bed','\t')
+
+
+def writeSuperEnhancerTable(header,rows,description,outputFile):
+
+    '''
+    writes an enhancer table under a commented description
+    '''
+
+    description = ('#' + description + '\nCreated on ' + time.strftime('%b %d %Y')).replace('\n','\n#')
+    table = open(outputFile,'w')
+    table.write(description + ' \n')
+    table.write(join(header,'\t') + '\n')
+    for line in rows:
+        table.write(join(line,'\t') + '\n')
+    table.close()
+
+
+def plotCutoff(plotFile,signalVector,cutoff,nSuper,xLabel,yLabel):
+
+    '''
+    draws the hockey stick plot of the ranked signal if matplotlib is
+    installed. returns True if the plot was written
+    '''
+
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as pyplot
+    except ImportError:
+        print('WARNING: MATPLOTLIB IS NOT INSTALLED, NOT DRAWING %s' % (plotFile))
+        return False
+
+    rankedSignal = numpy.sort(signalVector)[::-1]
+    xPts = numpy.arange(len(rankedSignal),0,-1)
+    figure = pyplot.figure(figsize=(6,6),dpi=100)
+    pyplot.plot(xPts,rankedSignal,color='red',linewidth=2,marker='o')
+    pyplot.axhline(cutoff,color='grey',linestyle='--')
+    pyplot.axvline(len(rankedSignal)-nSuper,color='grey',linestyle='--')
+    pyplot.text(0,0.8*max(rankedSignal),' Cutoff used: %s\n Super-Enhancers identified: %s' % (formatRNumber(cutoff),nSuper))
+    pyplot.xlabel(xLabel)
+    pyplot.ylabel(yLabel)
+    figure.savefig(plotFile)
+    pyplot.close(figure)
+    return True
+
+
+#==================================================================
+#=====================SUPER-ENHANCER CALLING=======================
+#==================================================================
+
+def callSuper(outFolder,enhancerFile,enhancerName,controlName):
+
+    '''
+    ranks the stitched enhancers of a region map by ranking bam signal, less
+    control signal unless controlName is NONE, calls the super-enhancers and
+    writes the tables, beds and plot of ROSE_callSuper.R to outFolder.
+    returns the list of files written
+    '''
+
+    regionMap = ROSE_utils.parseTable(enhancerFile,'\t')
+    header = makeRNames(regionMap[0])
+    rows = formatRColumns(regionMap[1:])
+    if len(rows) == 0:
+        print('ERROR: NO ENHANCERS IN %s' % (enhancerFile))
+        return []
+
+    #PERFORM WCE SUBTRACTION
+    rankByFactor = header[6]
+    signalVector = numpy.array([float(line[6]) for line in regionMap[1:]])
+    if controlName != 'NONE':
+        controlName = header[7]
+        print('HERE IS THE WCE NAME')
+        print(controlName)
+        signalVector = signalVector - numpy.array([float(line[7]) for line in regionMap[1:]])
+
+    #SETTING NEGATIVE VALUES IN THE SIGNAL TO 0
+    signalVector[signalVector < 0] = 0
+
+    #FIGURING OUT THE CUTOFF
+    cutoffOptions = calculateCutoff(signalVector)
+    cutoff = cutoffOptions['absolute']
+    print('CUTOFF OF %s AT ENHANCER %s' % (formatRNumber(cutoff),cutoffOptions['x']))
+
+    #THESE ARE THE SUPER-ENHANCERS
+    superRows = [int(i) for i in numpy.nonzero(signalVector > cutoff)[0]]
+    enhancerDescription = '%s Enhancers\nCreated from %s\nRanked by %s\nUsing cutoff of %s for Super-Enhancers' % (enhancerName,enhancerFile,rankByFactor,formatRNumber(cutoff))
+
+    #RANK 1 IS THE STRONGEST ENHANCER, TIES GO TO THE ONE LISTED LAST
+    nRows = len(rows)
+    rankOrder = numpy.argsort(signalVector,kind='mergesort')
+    enhancerRank = numpy.empty(nRows,dtype=int)
+    enhancerRank[rankOrder] = numpy.arange(nRows,0,-1)
+    isSuper = numpy.zeros(nRows,dtype=int)
+    isSuper[superRows] = 1
+
+    outputFiles = []
+
+    #MAKING HOCKEY STICK PLOT
+    plotFile = '%s%s_Plot_points.png' % (outFolder,enhancerName)
+    if controlName == 'NONE':
+        yLabel = '%s  Signal' % (rankByFactor)
+    else:
+        yLabel = '%s  Signal -  %s' % (rankByFactor,controlName)
+    if plotCutoff(plotFile,signalVector,cutoff,len(superRows),'%s _enhancers' % (rankByFactor),yLabel):
+        outputFiles.append(plotFile)
+
+    #WRITING BED FILES
+    bedRows = [[line[1],line[2],line[3],line[0],formatRNumber(enhancerRank[i])] for i,line in enumerate(rows)]
+    bedFile = '%s%s_Enhancers_withSuper.bed' % (outFolder,enhancerName)
+    writeEnhancerBed(bedRows,'%s Enhancers' % (rankByFactor),enhancerDescription,bedFile,superRows)
+    outputFiles.append(bedFile)
+
+    bedFileRoot = '%s%s' % (outFolder,enhancerName)
+    writeGatewayBeds(bedRows,bedFileRoot,superRows)
+    outputFiles += [bedFileRoot + '_Gateway_Enhancers.bed',bedFileRoot + '_Gateway_SuperEnhancers.bed']
+
+    #WRITING ENHANCER AND SUPER-ENHANCER TABLES WITH ENHANCERS RANKED AND SUPER STATUS ANNOTATED
+    tableHeader = header + ['enhancerRank','isSuper']
+    tableRows = [rows[i] + [formatRNumber(enhancerRank[i]),formatRNumber(isSuper[i])] for i in numpy.argsort(enhancerRank)]
+    enhancerTableFile = '%s%s_AllEnhancers.table.txt' % (outFolder,enhancerName)
+    writeSuperEnhancerTable(tableHeader,tableRows,enhancerDescription,enhancerTableFile)
+
+    superTableFile = '%s%s_SuperEnhancers.table.txt' % (outFolder,enhancerName)
+    writeSuperEnhancerTable(tableHeader,[line for line in tableRows if line[-1] == '1'],enhancerDescription,superTableFile)
+    outputFiles += [enhancerTableFile,superTableFile]
+
+    print('IDENTIFIED %s SUPER-ENHANCERS OUT OF %s ENHANCERS' % (len(superRows),nRows))
+    return outputFiles
+
+
+#==================================================================
+#=========================MAIN METHOD==============================
+#==================================================================
+
+def main():
+    '''
+    main run call
+    '''
+    from optparse import OptionParser
+    usage = "usage: %prog [options] -o [OUTPUT_FOLDER] -i [ENHANCER_REGION_MAP] -n [ENHANCER_NAME]"
+    parser = OptionParser(usage = usage)
+    #required flags
+    parser.add_option("-o","--out", dest="out",nargs = 1, default=None,
+                      help = "Enter an output folder")
+    parser.add_option("-i","--i", dest="input",nargs = 1, default=None,
+                      help = "Enter the _ENHANCER_REGION_MAP.txt of a ROSE run")
+    parser.add_option("-n","--name", dest="name",nargs = 1, default=None,
+                      help = "Enter the name the outputs start with")
+
+    #optional flags
+    parser.add_option("-c","--control", dest="control",nargs = 1, default='NONE',
+                      help = "Enter the control bam name, or NONE to rank without subtracting control. Default is NONE")
+
+    (options,args) = parser.parse_args()
+
+    if not options.out or not options.input or not options.name:
+        parser.print_help()
+        exit()
+
+    outFolder = ROSE_utils.formatFolder(options.out,True)
+    if len(callSuper(outFolder,options.input,options.name,options.control)) == 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#ROSE_check.py
+
+'''
+PROGRAM TO CHECK BEHAVIOR OF ROSE THAT OUTPUT TABLES ALONE DO NOT SHOW
+RUNS EACH CHECK ON SMALL SYNTHETIC DATA AND EXITS WITH STATUS 1 IF ANY FAILS
+'''
+
+import sys
+
+
+
+import ROSE_utils
+
+import ROSE_bamToGFF
+
+import ROSE_benchmark
+
+import os
+
+import json
+
+from string import join
+
+
+#==================================================================
+#=========================HELD LINES CHECK=========================
+#==================================================================
+
+#bamToGFF maps regions in bam order and writes each gff in its own order.
+#for gffs sorted by sortGFFByBam, as ROSE writes the stitched gff, every row
+#must go out as soon as it is mapped instead of waiting on another gff
+
+#small enough to run in seconds, large enough for several chromosomes
+CHECK_PARAMS = {'reads':20000,'regions':1000,'genes':200,'chroms':3,'chromSize':2000000,'stitch':12500,'seed':1,'processes':1}
+
+def checkHeldLines(checkFolder):
+    '''
+    maps a sorted stitched gff and a sorted constituent gff together with a
+    sweep and returns the list of checks that failed
+    '''
+    checkFolder = ROSE_utils.formatFolder(checkFolder,True)
+    dataFiles = ROSE_benchmark.makeSyntheticData(checkFolder + 'data/',CHECK_PARAMS)
+
+    referenceCollection = ROSE_utils.gffToLocusCollection(dataFiles['gff'])
+    stitchedCollection = referenceCollection.stitchCollection(CHECK_PARAMS['stitch'],'both')
+    gffList = [ROSE_utils.sortGFFByBam(ROSE_utils.locusCollectionToGFF(stitchedCollection),dataFiles['rankBam']),
+               ROSE_utils.sortGFFByBam(ROSE_utils.parseTable(dataFiles['gff'],'\t'),dataFiles['rankBam'])]
+
+    telemetryFile = checkFolder + 'telemetry.jsonl'
+    if os.path.exists(telemetryFile):
+        os.remove(telemetryFile)
+    for gffIndex,row in ROSE_bamToGFF.mapBamToGFFs(dataFiles['rankBam'],gffList,'both',200,1,True,1,True,telemetryFile = telemetryFile):
+        pass
+    heldPeak = json.loads(open(telemetryFile).readlines()[-1])['heldPeak']
+
+    #a row is counted as held while it is being handed on
+    if heldPeak > 1:
+        print('ERROR: HELD %s OF %s ROWS IN MEMORY MAPPING SORTED GFFS' % (heldPeak,sum([len(gff) for gff in gffList])))
+        return ['heldLines']
+    print('held lines check passed, at most %s row held' % (heldPeak))
+    return []
+
+
+#==================================================================
+#=========================EXECUTOR CHECKS==========================
+#==================================================================
+
+#the local scheduler and the stand-in cluster run a passing job, a failing job
+#and a job that exits 0 without its output. each must report the exit code
+#the pipeline exits with: 0, the job's own code, and 1 for the missing output
+
+def checkExecutors(checkFolder):
+    '''
+    runs every check on the local and fake backends and returns the list of
+    checks that failed
+    '''
+    checkFolder = ROSE_utils.formatFolder(checkFolder,True)
+    outputFile = checkFolder + 'output.txt'
+    missingFile = checkFolder + 'missing.txt'
+    for fileName in [outputFile,missingFile]:
+        if os.path.exists(fileName):
+            os.remove(fileName)
+
+    checkList = [('pass','echo done > %s' % (outputFile),[outputFile],True,0),
+                 ('fail','exit 3',[],False,3),
+                 ('missingOutput','true',[missingFile],False,1)]
+    failed = []
+    for backend in ['local','fake']:
+        for checkName,cmd,outputs,expectDone,expectCode in checkList:
+            scheduler = ROSE_utils.makeExecutor(backend,1,checkFolder + 'jobs/')
+            jobID = scheduler.submit(cmd,checkName,outputs)
+            done = scheduler.wait(60)
+            returncode = scheduler.returncode()
+            status = scheduler.getJob(jobID)['status']
+            if done != expectDone or returncode != expectCode or status != ('done' if expectDone else 'failed'):
+                print('ERROR: %s EXECUTOR CHECK %s GAVE %s WITH EXIT CODE %s, EXPECTED EXIT CODE %s' % (backend,checkName,status,returncode,expectCode))
+                failed.append('%s_%s' % (backend,checkName))
+            else:
+                print('%s executor check %s passed' % (backend,checkName))
+    return failed
+
+
+#==================================================================
+#=========================MAIN METHOD==============================
+#==================================================================
+
+def main():
+    '''
+    main run call
+    '''
+    from optparse import OptionParser
+    usage = "usage: %prog [options] -o [CHECK_FOLDER]"
+    parser = OptionParser(usage = usage)
+    parser.add_option("-o","--out", dest="out",nargs = 1, default=None,
+                      help = "Enter a folder for the synthetic data and scratch files of the checks")
+
+    (options,args) = parser.parse_args()
+
+    if not options.out:
+        parser.print_help()
+        exit()
+
+    outFolder = ROSE_utils.formatFolder(options.out,True)
+    failed = checkExecutors(outFolder + 'executors/')
+    failed += checkHeldLines(outFolder + 'heldLines/')
+    if len(failed) > 0:
+        print('ERROR: %s CHECKS FAILED: %s' % (len(failed),join(failed,',')))
+        sys.exit(1)
+    print('ALL CHECKS PASSED')
+
+
+if __name__ == "__main__":
+    main()
@@ -27,17 +27,16 @@ from collections import defaultdict
 
 
 
-def mapEnhancerToGene(annotFile,enhancerFile,transcribedFile='',uniqueGenes=True,searchWindow =50000,noFormatTable = False):
-    
+def loadGeneAnnotation(annotFile,transcribedFile='',startDict=None):
+
     '''
-    maps genes to enhancers. if uniqueGenes, reduces to gene name only. Otherwise, gives for each refseq
+    loads what gene mapping needs from an annotation: the start dict, and the
+    transcript and TSS collections of the transcribed genes. a start dict
+    already made from annotFile can be passed in to skip making it again
+    returns startDict,transcribedCollection,tssCollection
     '''
-    startDict = ROSE_utils.makeStartDict(annotFile)
-    enhancerTable = ROSE_utils.parseTable(enhancerFile,'\t')
-
-    #internal parameter for debugging
-    byRefseq = False
-
+    if startDict == None:
+        startDict = ROSE_utils.makeStartDict(annotFile)
 
     if len(transcribedFile) > 0:
         transcribedTable = ROSE_utils.parseTable(transcribedFile,'\t')
@@ -59,6 +58,23 @@ def mapEnhancerToGene(annotFile,enhancerFile,transcribedFile='',uniqueGenes=True
     #50 is the internal parameter for LocusCollection and doesn't really matter
     tssCollection = ROSE_utils.LocusCollection(tssLoci,50)
 
+    return startDict,transcribedCollection,tssCollection
+
+
+def mapEnhancerToGene(annotFile,enhancerFile,transcribedFile='',uniqueGenes=True,searchWindow =50000,noFormatTable = False,annotation = None):
+    
+    '''
+    maps genes to enhancers. if uniqueGenes, reduces to gene name only. Otherwise, gives for each refseq
+    annotation is the output of loadGeneAnnotation when the caller has already loaded it
+    '''
+    if annotation == None:
+        annotation = loadGeneAnnotation(annotFile,transcribedFile)
+    startDict,transcribedCollection,tssCollection = annotation
+    enhancerTable = ROSE_utils.parseTable(enhancerFile,'\t')
+
+    #internal parameter for debugging
+    byRefseq = False
+
     
 
     geneDict = {'overlapping':defaultdict(list),'proximal':defaultdict(list)}
@@ -246,6 +262,8 @@ def main():
                       help = "Enter a search distance for genes. Default is 50,000bp")
     parser.add_option("-f","--format", dest="formatTable",action= "store_true", default=False,
                       help = "If flagged, maintains original formatting of input table")
+    parser.add_option("--profile", dest="profile",nargs = 1, default='',
+                      help = "Enter a folder to write a profile of the gene mapping to")
 
     #RETRIEVING FLAGS
     (options,args) = parser.parse_args()
@@ -297,7 +315,7 @@ def main():
     else:
         transcribedFile = ''
 
-    enhancerToGeneTable,geneToEnhancerTable = mapEnhancerToGene(annotFile,enhancerFile,transcribedFile,True,window,noFormatTable)
+    enhancerToGeneTable,geneToEnhancerTable = ROSE_utils.profileCall(options.profile,'geneMapper_%s' % (enhancerFile.split('/')[-1]),mapEnhancerToGene,annotFile,enhancerFile,transcribedFile,True,window,noFormatTable)
 
     #Writing enhancer output
     enhancerFileName = enhancerFile.split('/')[-1].split('.')[0]
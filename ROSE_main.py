@@ -13,8 +13,14 @@ import sys
 
 import ROSE_utils
 
+import ROSE_callSuper
+
+import ROSE_bamToGFF
+
 import time
 
+import math
+
 import os
 
 from string import upper,join
@@ -43,12 +49,60 @@ def checkRefCollection(referenceCollection):
         print("REFERENCE COLLECTION PASSES QC")
         return
 
+#==================================================================
+#========================ANNOTATION================================
+#==================================================================
+
+
+def getAnnotFile(genome):
+
+    '''
+    returns the refseq annotation of a genome build in the annotation folder
+    '''
+
+    cwd = os.getcwd()
+    genomeDict = {
+        'HG18':'%s/annotation/hg18_refseq.ucsc' % (cwd),
+        'MM9': '%s/annotation/mm9_refseq.ucsc' % (cwd),
+        'HG19':'%s/annotation/hg19_refseq.ucsc' % (cwd),
+	'HG38':'%s/annotation/hg38_refseq.ucsc' % (cwd),
+        'MM8': '%s/annotation/mm8_refseq.ucsc' % (cwd),
+        'MM10':'%s/annotation/mm10_refseq.ucsc' % (cwd),
+        }
+
+    return genomeDict[upper(genome)]
+
+
+def loadAnnotation(annotFile,tssWindows):
+
+    '''
+    loads the start dict of an annotation and a TSS LocusCollection for
+    each window in tssWindows. returns startDict,{window:tssCollection}
+    '''
+
+    print('MAKING START DICT')
+    startDict = ROSE_utils.makeStartDict(annotFile)
+
+    tssCollections = {}
+    for window in ROSE_utils.uniquify(tssWindows):
+        #this makes a locus centered around +/- window of transcribed genes
+        tssLoci = []
+        for geneID in startDict.keys():
+            tssLoci.append(ROSE_utils.makeTSSLocus(geneID,startDict,window,window))
+
+        #this turns the tssLoci list into a LocusCollection
+        #50 is the internal parameter for LocusCollection and doesn't really matter
+        tssCollections[window] = ROSE_utils.LocusCollection(tssLoci,50)
+
+    return startDict,tssCollections
+
+
 #==================================================================
 #=====================REGION STITCHING=============================
 #==================================================================
 
 
-def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True):
+def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True,annotation=None):
     print('PERFORMING REGION STITCHING')
     #first have to turn bound region file into a locus collection
 
@@ -58,21 +112,13 @@ def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True):
     debugOutput = []
     #filter out all bound regions that overlap the TSS of an ACTIVE GENE
     if removeTSS:
-        #first make a locus collection of TSS
-        startDict = ROSE_utils.makeStartDict(annotFile)
+        #first make a locus collection of TSS, unless a batch has already loaded it
+        if annotation == None:
+            annotation = loadAnnotation(annotFile,[tssWindow,50])
+        startDict,tssCollections = annotation
+        tssCollection = tssCollections[tssWindow]
 
-        #now makeTSS loci for active genes
         removeTicker=0
-        #this loop makes a locus centered around +/- tssWindow of transcribed genes
-        #then adds it to the list tssLoci
-        tssLoci = []
-        for geneID in startDict.keys():
-            tssLoci.append(ROSE_utils.makeTSSLocus(geneID,startDict,tssWindow,tssWindow))
-
-
-        #this turns the tssLoci list into a LocusCollection
-        #50 is the internal parameter for LocusCollection and doesn't really matter
-        tssCollection = ROSE_utils.LocusCollection(tssLoci,50)
 
         #gives all the loci in boundCollection
         boundLoci = boundCollection.getLoci()
@@ -96,14 +142,7 @@ def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True):
         #now replace any stitched region that overlap 2 distinct genes
         #with the original loci that were there
         fixedLoci = []
-        tssLoci = []
-        for geneID in startDict.keys():
-            tssLoci.append(ROSE_utils.makeTSSLocus(geneID,startDict,50,50))
-
-
-        #this turns the tssLoci list into a LocusCollection
-        #50 is the internal parameter for LocusCollection and doesn't really matter
-        tssCollection = ROSE_utils.LocusCollection(tssLoci,50)
+        tssCollection = tssCollections[50]
         removeTicker = 0
         originalTicker = 0
         for stitchedLocus in stitchedCollection.getLoci():
@@ -128,15 +167,41 @@ def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True):
     else:
         return stitchedCollection,debugOutput
 
+#==================================================================
+#=====================IN MEMORY MAPPING============================
+#==================================================================
+
+def mapSignals(bamFile,gffList,nBin,fullPrecision = False,cacheFolder = '',processes = 1,telemetryFile = '',profileFolder = '',exportList = []):
+
+    '''
+    maps a bam to the regions of each gff table in gffList in process, with
+    the settings ROSE_main runs bamToGFF with. returns the first bin density
+    of each region of the first gff, by region index. if exportList is given,
+    the rows of every gff are also written there as bamToGFF would write them
+    '''
+
+    indexedRows = list(ROSE_bamToGFF.mapBamToGFFs(bamFile,gffList,'both',200,1,True,nBin,True,10000,processes,cacheFolder,fullPrecision,telemetryFile,profileFolder))
+    if len(exportList) > 0:
+        if fullPrecision:
+            ROSE_utils.unParseMatrices(indexedRows,exportList,nBin)
+        else:
+            ROSE_utils.unParseTables(indexedRows,exportList,'\t')
+    return [row[2] for gffIndex,row in indexedRows if gffIndex == 0][1:]
+
+
 #==================================================================
 #=====================REGION LINKING MAPPING=======================
 #==================================================================
 
-def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolder,output,refName):
+def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolder,output,refName,binary = False,telemetryFile = '',mappedLoci = None,mappedSignals = None):
 
 
     '''
     makes a table of factor density in a stitched locus and ranks table by number of loci stitched together
+    if binary, reads the .npy density matrices written by bamToGFF --binary instead of the mapped gff text
+    if telemetryFile is given, progress records are appended to it as JSON lines
+    if mappedSignals is given, it holds for each bam name the density of each
+    locus of mappedLoci by index, and no mapped files are read
     '''
 
     
@@ -148,27 +213,33 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
     lociLenList = []
 
     #strip out any that are in chrY
-    for locus in list(loci):
-        if locus.chr() == 'chrY':
-            loci.remove(locus)
+    loci = [locus for locus in loci if locus.chr() != 'chrY']
+
+    #the collection hands loci back in no set order, so loci of the same length
+    #are listed by position, the same for a fresh and a reloaded collection
+    loci.sort(key = lambda locus: (locus.chr(),locus.start(),locus.ID()))
     
     for locus in loci:
         #numLociList.append(int(stitchLocus.ID().split('_')[1]))
         lociLenList.append(locus.len())
         #numOrder = order(numLociList,decreasing=True)
     lenOrder = ROSE_utils.order(lociLenList,decreasing=True)
-    ticker = 0
-    for i in lenOrder:
-        ticker+=1
-        if ticker%1000 ==0:
-            print(ticker)
-        locus = loci[i]
+    tableLoci = [loci[i] for i in lenOrder]
+
+    #each stitched locus is counted once for the table and once per bam
+    telemetry = ROSE_utils.Telemetry(telemetryFile,'mapCollection',len(loci)*(1+len(bamFileList)),label = output)
+    binStart = time.time()
+
+    #the constituents of every stitched locus are found in one sweep over both sets
+    refLoci = referenceCollection.getLoci()
+    refOverlaps = ROSE_utils.overlapJoin(tableLoci,refLoci)
+    for locus,refOverlap in zip(tableLoci,refOverlaps):
+        telemetry.tick()
 
         #First get the size of the enriched regions within the stitched locus
         refEnrichSize = 0
-        refOverlappingLoci = referenceCollection.getOverlap(locus,'both')
-        for refLocus in refOverlappingLoci:
-            refEnrichSize+=refLocus.len()
+        for j in refOverlap:
+            refEnrichSize+=refLoci[j].len()
 
         try:
             stitchCount = int(locus.ID().split('_')[0])
@@ -176,6 +247,7 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
             stitchCount = 1
         
         locusTable.append([locus.ID(),locus.chr(),locus.start(),locus.end(),stitchCount,refEnrichSize])
+    telemetry.addTime('bin',time.time()-binStart)
         
             
 
@@ -188,41 +260,74 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
         #assumes standard convention for naming enriched region gffs
         
         #opening up the mapped GFF
-        print('OPENING %s%s_%s_MAPPED.gff' % (mappedFolder,refName,bamFileName))
-
-        mappedGFF =ROSE_utils.parseTable('%s%s_%s_MAPPED.gff' % (mappedFolder,refName,bamFileName),'\t')        
+        fetchStart = time.time()
+        mappedFile = '%s%s_%s_MAPPED.gff' % (mappedFolder,refName,bamFileName)
+        if mappedSignals != None:
+            print('USING IN MEMORY DENSITIES')
+            densityList = mappedSignals[bamFileName]
+        elif binary:
+            print('OPENING %s' % (ROSE_utils.matrixFiles(mappedFile)[0]))
+            mappedGFF,mappedMatrix = ROSE_utils.loadMatrix(mappedFile)
+            #empty bins come back as nan and are treated like NA in the text table
+            densityList = ['NA' if math.isnan(x) else x for x in mappedMatrix[:,0].tolist()]
+        else:
+            print('OPENING %s' % (mappedFile))
+            mappedGFF =ROSE_utils.parseTable(mappedFile,'\t')        
+            densityList = [line[2] for line in mappedGFF[1:]]
 
         signalDict = defaultdict(float)
         print('MAKING SIGNAL DICT FOR %s' % (bamFile))
-        mappedLoci = []
-        for line in mappedGFF[1:]:
-
-            chrom = line[1].split('(')[0]
-            start = int(line[1].split(':')[-1].split('-')[0])
-            end = int(line[1].split(':')[-1].split('-')[1])
-            mappedLoci.append(ROSE_utils.Locus(chrom,start,end,'.',line[0]))
-            try:
-                signalDict[line[0]] = float(line[2])*(abs(end-start))
-            except ValueError:
-                print('WARNING NO SIGNAL FOR LINE:')
-                print(line)
-                continue
+        if mappedSignals != None:
+            #regions are keyed by their index, their loci are already made
+            regionLoci = []
+            for i,density in enumerate(densityList):
+                locus = mappedLoci[i]
+                regionLoci.append(ROSE_utils.Locus(locus.chr(),locus.start(),locus.end(),'.',i))
+                if density == 'NA' or density != density:
+                    print('WARNING NO SIGNAL FOR REGION %s' % (locus.ID()))
+                    continue
+                signalDict[i] = float(density)*(abs(locus.end()-locus.start()))
+        else:
+            regionLoci = []
+            for line,density in zip(mappedGFF[1:],densityList):
+
+                chrom = line[1].split('(')[0]
+                start = int(line[1].split(':')[-1].split('-')[0])
+                end = int(line[1].split(':')[-1].split('-')[1])
+                regionLoci.append(ROSE_utils.Locus(chrom,start,end,'.',line[0]))
+                try:
+                    signalDict[line[0]] = float(density)*(abs(end-start))
+                except ValueError:
+                    print('WARNING NO SIGNAL FOR LINE:')
+                    print(line)
+                    continue
                 
                 
         
-        mappedCollection = ROSE_utils.LocusCollection(mappedLoci,500)
+        #like a LocusCollection, only the first of regions with the same coordinates is kept
+        uniqueLoci = []
+        seenCoords = set()
+        for region in regionLoci:
+            if (region.chr(),region.start(),region.end()) not in seenCoords:
+                seenCoords.add((region.chr(),region.start(),region.end()))
+                uniqueLoci.append(region)
         locusTable[0].append(bamFileName)
+        binStart = time.time()
+        telemetry.addTime('fetch',binStart-fetchStart)
 
-        for i in range(1,len(locusTable)):
+        regionOverlaps = ROSE_utils.overlapJoin(tableLoci,uniqueLoci)
+        for i,regionOverlap in enumerate(regionOverlaps):
+            telemetry.tick()
             signal=0.0
-            line = locusTable[i]
-            lineLocus = ROSE_utils.Locus(line[1],line[2],line[3],'.')
-            overlappingRegions = mappedCollection.getOverlap(lineLocus,sense='both')
-            for region in overlappingRegions:
-                signal+= signalDict[region.ID()]
-            locusTable[i].append(signal)
+            for j in regionOverlap:
+                signal+= signalDict[uniqueLoci[j].ID()]
+            locusTable[i+1].append(signal)
+        telemetry.addTime('bin',time.time()-binStart)
 
+    outputStart = time.time()
     ROSE_utils.unParseTable(locusTable,output,'\t')
+    telemetry.addTime('output',time.time()-outputStart)
+    telemetry.close()
 
 
 
@@ -230,12 +335,10 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
 #=========================MAIN METHOD==============================
 #==================================================================
 
-def main():
+def makeParser():
     '''
-    main run call
+    returns the option parser of the main run call
     '''
-    debug = False
-
 
     from optparse import OptionParser
     usage = "usage: %prog [options] -g [GENOME] -i [INPUT_REGION_GFF] -r [RANKBY_BAM_FILE] -o [OUTPUT_FOLDER] [OPTIONAL_FLAGS]"
@@ -259,18 +362,41 @@ def main():
                       help = "Enter a max linking distance for stitching")
     parser.add_option("-t","--tss", dest="tss",nargs = 1, default=0,
                       help = "Enter a distance from TSS to exclude. 0 = no TSS exclusion")
+    parser.add_option("--binary", dest="binary",action = 'store_true', default=False,
+                      help = "Passes densities from bamToGFF to the region map as .npy matrices instead of text tables")
+    parser.add_option("--cache", dest="cache",nargs = 1, default=None,
+                      help = "Enter a folder to keep a persistent coverage cache of each bam in. Reruns on the same bams skip reading them and give the same densities")
+    parser.add_option("--resume", dest="resume",action = 'store_true', default=False,
+                      help = "If flagged, skips every stage whose inputs and parameters are unchanged since it last ran in the output folder")
+    parser.add_option("-j","--jobs", dest="jobs",nargs = 1, default=None,
+                      help = "Enter the number of bamToGFF jobs to run at once. Default runs one per bam. With --inmemory, the number of processes mapping each bam")
+    parser.add_option("--inmemory", dest="inmemory",action = 'store_true', default=False,
+                      help = "If flagged, maps every bam in this process and passes the region densities to the region map without writing mapped gffs")
+    parser.add_option("--export", dest="export",action = 'store_true', default=False,
+                      help = "With --inmemory, also writes the mapped gffs, as .npy matrices with --binary")
+    parser.add_option("--executor", dest="executor",type = 'choice',choices = ['local','slurm','lsf','fake'],default='local',
+                      help = "Enter where bamToGFF jobs run: local, slurm, lsf, or fake for a local stand-in cluster. Default is local")
+    parser.add_option("--submit-args", dest="submitArgs",nargs = 1, default='',
+                      help = "Enter extra arguments for sbatch or bsub, e.g. \"-p short --mem=8G\"")
+    parser.add_option("--profile", dest="profile",action = 'store_true', default=False,
+                      help = "If flagged, profiles every stage, including the bamToGFF runs, into the profile folder of the output folder")
+
+    return parser
+
+
+def runROSE(options,annotation = None):
+    '''
+    runs ROSE with parsed options. annotation is the startDict and TSS
+    collections from loadAnnotation when a batch has already loaded them
+    '''
+    debug = False
 
-
-
-
-    #RETRIEVING FLAGS
-    (options,args) = parser.parse_args()
-
-
-    if not options.input or not options.rankby or not options.out or not options.genome:
-        print('hi there')
-        parser.print_help()
-        exit()
+    #in memory mapping never leaves this process, so it cannot go to a cluster
+    if options.inmemory and options.executor != 'local':
+        print('ERROR: --inmemory MAPS IN THIS PROCESS AND ONLY RUNS WITH THE local EXECUTOR')
+        sys.exit(1)
+    if options.export and not options.inmemory:
+        print('WARNING: --export ONLY APPLIES WITH --inmemory, MAPPED GFFS ARE ALWAYS WRITTEN OTHERWISE')
 
     #making the out folder if it doesn't exist
     outFolder = ROSE_utils.formatFolder(options.out,True)
@@ -280,23 +406,39 @@ def main():
     gffFolder = ROSE_utils.formatFolder(outFolder+'gff/',True)
     mappedFolder = ROSE_utils.formatFolder(outFolder+ 'mappedGFF/',True)
 
+    #progress records from every mapping stage are appended here as JSON lines
+    telemetryFile = outFolder + 'telemetry.jsonl'
+
+    #every stage, and every mapping process, records the resources it used here
+    metricsFile = outFolder + 'run_metrics.json'
+    metrics = ROSE_utils.StageMetrics(metricsFile,True)
+
+    #every stage, and every child process, writes its profile here
+    if options.profile:
+        profileFolder = ROSE_utils.formatFolder(outFolder + 'profile/',True)
+    else:
+        profileFolder = ''
+
+    #every stage records its inputs, parameters and outputs here
+    manifests = ROSE_utils.StageManifests(outFolder + 'manifests/',options.resume)
+
 
     #GETTING INPUT FILE
     if options.input.split('.')[-1] == 'bed':
         #CONVERTING A BED TO GFF
         inputGFFName = options.input.split('/')[-1][0:-4]
         inputGFFFile = '%s%s.gff' % (gffFolder,inputGFFName)
-        ROSE_utils.bedToGFF(options.input,inputGFFFile)
-    elif options.input.split('.')[-1] =='gff':
-        #COPY THE INPUT GFF TO THE GFF FOLDER
-	inputGFFFile = options.input
-        os.system('cp %s %s' % (inputGFFFile,gffFolder))        
-
+        if not manifests.isFresh('gff',[options.input],{}):
+            ROSE_utils.bedToGFF(options.input,inputGFFFile)
+            manifests.record('gff',[options.input],{},[inputGFFFile])
     else:
-        print('WARNING: INPUT FILE DOES NOT END IN .gff or .bed. ASSUMING .gff FILE FORMAT')
+        if options.input.split('.')[-1] != 'gff':
+            print('WARNING: INPUT FILE DOES NOT END IN .gff or .bed. ASSUMING .gff FILE FORMAT')
         #COPY THE INPUT GFF TO THE GFF FOLDER
-	inputGFFFile = options.input
-        os.system('cp %s %s' % (inputGFFFile,gffFolder))        
+        inputGFFFile = options.input
+        if not manifests.isFresh('gff',[inputGFFFile],{}):
+            os.system('cp %s %s' % (inputGFFFile,gffFolder))
+            manifests.record('gff',[inputGFFFile],{},[gffFolder + inputGFFFile.split('/')[-1]])
 
 
     #GETTING THE LIST OF BAMFILES TO PROCESS
@@ -332,21 +474,7 @@ def main():
 
 
     #GETTING THE CORRECT ANNOT FILE
-    cwd = os.getcwd()
-    genomeDict = {
-        'HG18':'%s/annotation/hg18_refseq.ucsc' % (cwd),
-        'MM9': '%s/annotation/mm9_refseq.ucsc' % (cwd),
-        'HG19':'%s/annotation/hg19_refseq.ucsc' % (cwd),
-	'HG38':'%s/annotation/hg38_refseq.ucsc' % (cwd),
-        'MM8': '%s/annotation/mm8_refseq.ucsc' % (cwd),
-        'MM10':'%s/annotation/mm10_refseq.ucsc' % (cwd),
-        }
-
-    annotFile = genomeDict[upper(genome)]
-
-    #MAKING THE START DICT
-    print('MAKING START DICT')
-    startDict = ROSE_utils.makeStartDict(annotFile)
+    annotFile = getAnnotFile(genome)
 
 
     #LOADING IN THE BOUND REGION REFERENCE COLLECTION
@@ -357,15 +485,6 @@ def main():
     print('CHECKING INPUT TO MAKE SURE EACH REGION HAS A UNIQUE IDENTIFIER')
     checkRefCollection(referenceCollection) #makes sure that all input regions have a unique ID
 
-    #NOW STITCH REGIONS
-    print('STITCHING REGIONS TOGETHER')
-    stitchedCollection,debugOutput = regionStitching(inputGFFFile,stitchWindow,tssWindow,annotFile,removeTSS)
-
-    
-    #NOW MAKE A STITCHED COLLECTION GFF
-    print('MAKING GFF FROM STITCHED COLLECTION')
-    stitchedGFF=ROSE_utils.locusCollectionToGFF(stitchedCollection)
-    
     if not removeTSS:
         stitchedGFFFile = '%s%s_%sKB_STITCHED.gff' % (gffFolder,inputName,stitchWindow/1000)
         stitchedGFFName = '%s_%sKB_STITCHED' % (inputName,stitchWindow/1000)
@@ -375,15 +494,34 @@ def main():
         stitchedGFFName = '%s_%sKB_STITCHED_TSS_DISTAL' % (inputName,stitchWindow/1000)
         debugOutFile = '%s%s_%sKB_STITCHED_TSS_DISTAL.debug' % (gffFolder,inputName,stitchWindow/1000)
 
-    #WRITING DEBUG OUTPUT TO DISK
-        
-    if debug:
-        print('WRITING DEBUG OUTPUT TO DISK AS %s' % (debugOutFile))
-        ROSE_utils.unParseTable(debugOutput,debugOutFile,'\t')
+    #STITCHING DEPENDS ON THE ANNOTATION ONLY WHEN TSSs ARE EXCLUDED
+    stitchInputs = [inputGFFFile]
+    if removeTSS:
+        stitchInputs.append(annotFile)
+    stitchParams = {'stitch':stitchWindow,'tss':tssWindow}
+
+    if manifests.isFresh('stitching',stitchInputs,stitchParams):
+        print('LOADING STITCHED REGIONS FROM %s' % (stitchedGFFFile))
+        stitchedCollection = ROSE_utils.gffToLocusCollection(stitchedGFFFile,50)
+    else:
+        #NOW STITCH REGIONS
+        print('STITCHING REGIONS TOGETHER')
+        stitchedCollection,debugOutput = metrics.measure('stitching',inputGFFFile,ROSE_utils.profileCall,profileFolder,'stitching',regionStitching,inputGFFFile,stitchWindow,tssWindow,annotFile,removeTSS,annotation)
 
-    #WRITE THE GFF TO DISK
-    print('WRITING STITCHED GFF TO DISK AS %s' % (stitchedGFFFile))
-    ROSE_utils.unParseTable(stitchedGFF,stitchedGFFFile,'\t')
+        #NOW MAKE A STITCHED COLLECTION GFF
+        print('MAKING GFF FROM STITCHED COLLECTION')
+        #IN THE ORDER THE RANKING BAM IS MAPPED IN, SO MAPPED ROWS ARE WRITTEN AS THEY COME
+        stitchedGFF=ROSE_utils.sortGFFByBam(ROSE_utils.locusCollectionToGFF(stitchedCollection),options.rankby)
+
+        #WRITING DEBUG OUTPUT TO DISK
+        if debug:
+            print('WRITING DEBUG OUTPUT TO DISK AS %s' % (debugOutFile))
+            ROSE_utils.unParseTable(debugOutput,debugOutFile,'\t')
+
+        #WRITE THE GFF TO DISK
+        print('WRITING STITCHED GFF TO DISK AS %s' % (stitchedGFFFile))
+        ROSE_utils.unParseTable(stitchedGFF,stitchedGFFFile,'\t')
+        manifests.record('stitching',stitchInputs,stitchParams,[stitchedGFFFile])
 
 
 
@@ -399,97 +537,167 @@ def main():
     # bin for bam mapping
     nBin =1
 
-    #IMPORTANT
-    #CHANGE cmd1 and cmd2 TO PARALLELIZE OUTPUT FOR BATCH SUBMISSION
-    #e.g. if using LSF cmd1 = "bsub python bamToGFF.py -f 1 -e 200 -r -m %s -b %s -i %s -o %s" % (nBin,bamFile,stitchedGFFFile,mappedOut1)
+    #EACH MAPPED GFF IS A STAGE OF ITS OWN SO THAT A RESUMED RUN ONLY REMAPS THE REGIONS THAT CHANGED
+    mapParams = {'extension':200,'floor':1,'rpm':True,'matrix':nBin,'binary':options.binary,'format':ROSE_utils.MAPPING_FORMAT}
 
-    for bamFile in bamFileList:
+    if options.inmemory:
+        #EVERY BAM IS MAPPED IN THIS PROCESS AND ITS STITCHED REGION DENSITIES GO STRAIGHT TO THE REGION MAP
+        #WITH --binary THE DENSITIES KEEP FULL PRECISION, AS THEY WOULD THROUGH THE .npy MATRICES
+        regionMapInputs = [stitchedGFFFile,inputGFFFile] + bamFileList
+        regionMapParams = dict(mapParams)
+        regionMapParams.update({'bams':[bamFile.split('/')[-1] for bamFile in bamFileList],'inmemory':True,'export':options.export})
 
-        bamFileName = bamFile.split('/')[-1]
+        if not manifests.isFresh('regionMap',regionMapInputs,regionMapParams):
+            if options.jobs:
+                nProcesses = int(options.jobs)
+            else:
+                nProcesses = 1
+            stitchedGFF = ROSE_utils.parseTable(stitchedGFFFile,'\t')
+            mappedLoci = [ROSE_utils.Locus(line[0],int(line[3]),int(line[4]),'.',line[1]) for line in stitchedGFF]
+            mappedSignals = {}
+            regionMapOutputs = [outputFile1]
+            mappingStart = time.time()
+            for bamFile in bamFileList:
+                bamFileName = bamFile.split('/')[-1]
+                gffList = [stitchedGFF]
+                exportList = []
+                if options.export:
+                    gffList.append(inputGFFFile)
+                    exportList = ['%s%s_%s_MAPPED.gff' % (mappedFolder,gffName,bamFileName) for gffName in [stitchedGFFName,inputName]]
+                    if options.binary:
+                        for mappedOut in exportList:
+                            regionMapOutputs += list(ROSE_utils.matrixFiles(mappedOut))
+                    else:
+                        regionMapOutputs += exportList
+                print('MAPPING %s IN MEMORY' % (bamFile))
+                mappedSignals[bamFileName] = metrics.measure('mapBamToGFF',bamFile,mapSignals,bamFile,gffList,nBin,options.binary,options.cache or '',nProcesses,telemetryFile,profileFolder,exportList)
+            print('MAPPING TOOK %.1f MINUTES' % ((time.time()-mappingStart)/60))
+
+            print('BAM MAPPING COMPLETED NOW MAPPING DATA TO REGIONS')
+            metrics.measure('mapCollection',outputFile1,ROSE_utils.profileCall,profileFolder,'mapCollection',mapCollection,stitchedCollection,referenceCollection,bamFileList,mappedFolder,outputFile1,refName = stitchedGFFName,telemetryFile = telemetryFile,mappedLoci = mappedLoci,mappedSignals = mappedSignals)
+            manifests.record('regionMap',regionMapInputs,regionMapParams,regionMapOutputs)
 
-        #MAPPING TO THE STITCHED GFF
-        mappedOut1 ='%s%s_%s_MAPPED.gff' % (mappedFolder,stitchedGFFName,bamFileName)
-        #WILL TRY TO RUN AS A BACKGROUND PROCESS. BATCH SUBMIT THIS LINE TO IMPROVE SPEED
-        cmd1 = "python ROSE_bamToGFF.py -f 1 -e 200 -r -m %s -b %s -i %s -o %s &" % (nBin,bamFile,stitchedGFFFile,mappedOut1)
-        print(cmd1)
-        os.system(cmd1)
-
-        #MAPPING TO THE ORIGINAL GFF
-        mappedOut2 ='%s%s_%s_MAPPED.gff' % (mappedFolder,inputName,bamFileName)
-        #WILL TRY TO RUN AS A BACKGROUND PROCESS. BATCH SUBMIT THIS LINE TO IMPROVE SPEED
-        cmd2 = "python ROSE_bamToGFF.py -f 1 -e 200 -r -m %s -b %s -i %s -o %s &" % (nBin,bamFile,inputGFFFile,mappedOut2)
-        print(cmd2)
-        os.system(cmd2)
-        
+    else:
+        #MAPPING JOBS RUN AT MOST options.jobs AT A TIME, LOCALLY OR AS ONE CLUSTER JOB ARRAY
+        #CLUSTER JOB SCRIPTS AND LOGS GO INTO THE jobs FOLDER OF THE OUTPUT FOLDER
+        if options.jobs:
+            nJobs = int(options.jobs)
+        else:
+            nJobs = len(bamFileList)
+        scheduler = ROSE_utils.makeExecutor(options.executor,nJobs,outFolder+'jobs/',options.submitArgs)
+
+        mappedStages = []
 
-    
-    print('PAUSING TO MAP')
-    time.sleep(10)
-
-    #CHECK FOR MAPPING OUTPUT
-    outputDone = False
-    ticker = 0
-    print('WAITING FOR MAPPING TO COMPLETE. ELAPSED TIME (MIN):')
-    while not outputDone:
-
-        '''
-        check every 5 minutes for completed output
-        '''
-        outputDone = True
-        if ticker%6 == 0:
-            print(ticker*5)
-        ticker +=1
-        #CHANGE THIS PARAMETER TO ALLOW MORE TIME TO MAP
-        if ticker == 144:
-            print('ERROR: OPERATION TIME OUT. MAPPING OUTPUT NOT DETECTED')
-            exit()
-            break
         for bamFile in bamFileList:
-            
-            #GET THE MAPPED OUTPUT NAMES HERE FROM MAPPING OF EACH BAMFILE
+
             bamFileName = bamFile.split('/')[-1]
-            mappedOut1 ='%s%s_%s_MAPPED.gff' % (mappedFolder,stitchedGFFName,bamFileName)
 
-            try:
-                 mapFile = open(mappedOut1,'r')
-                 mapFile.close()
-            except IOError:
-                outputDone = False
+            #MAPPING TO THE STITCHED GFF
+            mappedOut1 ='%s%s_%s_MAPPED.gff' % (mappedFolder,stitchedGFFName,bamFileName)
 
+            #MAPPING TO THE ORIGINAL GFF
             mappedOut2 ='%s%s_%s_MAPPED.gff' % (mappedFolder,inputName,bamFileName)
-            
-            try:
-                mapFile = open(mappedOut2,'r')
-                mapFile.close()
-            except IOError:
-                outputDone = False
-        if outputDone == True:
-            break
-        time.sleep(300)
-    print('MAPPING TOOK %s MINUTES' % (ticker*5))
 
-    print('BAM MAPPING COMPLETED NOW MAPPING DATA TO REGIONS')
-    #CALCULATE DENSITY BY REGION
-    mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolder,outputFile1,refName = stitchedGFFName)
+            gffList = []
+            outputList = []
+            jobOutputs = []
+            for gffFile,mappedOut in [(stitchedGFFFile,mappedOut1),(inputGFFFile,mappedOut2)]:
+                if options.binary:
+                    mappedOutputs = list(ROSE_utils.matrixFiles(mappedOut))
+                else:
+                    mappedOutputs = [mappedOut]
+                stage = 'map_%s' % (mappedOut.split('/')[-1])
+                if not manifests.isFresh(stage,[bamFile,gffFile],mapParams):
+                    gffList.append(gffFile)
+                    outputList.append(mappedOut)
+                    jobOutputs += mappedOutputs
+                    mappedStages.append((stage,[bamFile,gffFile],mappedOutputs))
+            if len(gffList) == 0:
+                continue
 
+            #THE GFFS LEFT TO MAP ARE MAPPED IN ONE PASS OVER THE BAM
+            cmd = "python ROSE_bamToGFF.py -f 1 -e 200 -r -m %s --sweep -b %s -i %s -o %s" % (nBin,bamFile,join(gffList,','),join(outputList,','))
+            if options.cache:
+                cmd += " --cache %s" % (options.cache)
+            if options.binary:
+                cmd += " --binary"
+            if profileFolder:
+                cmd += " --profile %s" % (profileFolder)
+            cmd += " --telemetry %s --metrics %s" % (telemetryFile,metricsFile)
+            scheduler.submit(cmd,'bamToGFF_%s' % (bamFileName),jobOutputs)
+
+        #WAITING FOR MAPPING TO COMPLETE
+        #CHANGE THIS PARAMETER TO ALLOW MORE TIME TO MAP
+        mappingStart = time.time()
+        mappingDone = scheduler.wait(12*3600)
+        #the mapping processes have appended their records by now
+        metrics.write()
+        if not mappingDone:
+            print('ERROR: BAM MAPPING FAILED')
+            sys.exit(scheduler.returncode())
+        print('MAPPING TOOK %.1f MINUTES' % ((time.time()-mappingStart)/60))
+        for stage,stageInputs,stageOutputs in mappedStages:
+            manifests.record(stage,stageInputs,mapParams,stageOutputs)
+
+        #THE REGION MAP READS THE STITCHED REGION DENSITIES OF EVERY BAM
+        regionMapInputs = [stitchedGFFFile,inputGFFFile]
+        for bamFile in bamFileList:
+            mappedOut1 ='%s%s_%s_MAPPED.gff' % (mappedFolder,stitchedGFFName,bamFile.split('/')[-1])
+            if options.binary:
+                regionMapInputs += list(ROSE_utils.matrixFiles(mappedOut1))
+            else:
+                regionMapInputs.append(mappedOut1)
+        regionMapParams = {'bams':[bamFile.split('/')[-1] for bamFile in bamFileList],'binary':options.binary,'format':ROSE_utils.MAPPING_FORMAT}
+
+        if not manifests.isFresh('regionMap',regionMapInputs,regionMapParams):
+            print('BAM MAPPING COMPLETED NOW MAPPING DATA TO REGIONS')
+            #CALCULATE DENSITY BY REGION
+            metrics.measure('mapCollection',outputFile1,ROSE_utils.profileCall,profileFolder,'mapCollection',mapCollection,stitchedCollection,referenceCollection,bamFileList,mappedFolder,outputFile1,refName = stitchedGFFName,binary = options.binary,telemetryFile = telemetryFile)
+            manifests.record('regionMap',regionMapInputs,regionMapParams,[outputFile1])
 
-    time.sleep(10)
 
     print('CALLING AND PLOTTING SUPER-ENHANCERS')
 
 
     if options.control:
-
-        rankbyName = options.rankby.split('/')[-1]
         controlName = options.control.split('/')[-1]
-        cmd = 'R --no-save %s %s %s %s < ROSE_callSuper.R' % (outFolder,outputFile1,inputName,controlName)
-
     else:
-        rankbyName = options.rankby.split('/')[-1]
         controlName = 'NONE'
-        cmd = 'R --no-save %s %s %s %s < ROSE_callSuper.R' % (outFolder,outputFile1,inputName,controlName)
-    print(cmd)
-    os.system(cmd)
+
+    #THE CUTOFF IS CALLED IN PROCESS BY THE PYTHON PORT OF ROSE_callSuper.R
+    superInputs = [outputFile1,'ROSE_callSuper.py']
+    superParams = {'name':inputName,'control':controlName,'format':ROSE_utils.MAPPING_FORMAT}
+    if not manifests.isFresh('callSuper',superInputs,superParams):
+        superOutputs = metrics.measure('cutoff',outputFile1,ROSE_utils.profileCall,profileFolder,'callSuper',ROSE_callSuper.callSuper,outFolder,outputFile1,inputName,controlName)
+        if len(superOutputs) > 0:
+            manifests.record('callSuper',superInputs,superParams,superOutputs)
+        else:
+            print('ERROR: CALLING SUPER-ENHANCERS DID NOT WRITE ITS OUTPUT')
+
+    if profileFolder:
+        ROSE_utils.summarizeProfiles(profileFolder)
+        print('WROTE PROFILES TO %s' % (profileFolder))
+
+    metrics.write()
+    print('WROTE RESOURCE METRICS TO %s' % (metricsFile))
+
+
+def main():
+    '''
+    main run call
+    '''
+    parser = makeParser()
+
+    #RETRIEVING FLAGS
+    (options,args) = parser.parse_args()
+
+
+    if not options.input or not options.rankby or not options.out or not options.genome:
+        print('hi there')
+        parser.print_help()
+        exit()
+
+    runROSE(options)
 
 
 
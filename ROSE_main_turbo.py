@@ -13,6 +13,10 @@ import sys
 
 import ROSE_utils
 
+import ROSE_callSuper
+
+import ROSE_geneMapper
+
 import time
 
 import os
@@ -26,7 +30,7 @@ from collections import defaultdict
 #==================================================================
 
 
-def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True):
+def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True,startDict=None):
     print('PERFORMING REGION STITCHING')
     #first have to turn bound region file into a locus collection
 
@@ -36,8 +40,9 @@ def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True):
     debugOutput = []
     #filter out all bound regions that overlap the TSS of an ACTIVE GENE
     if removeTSS:
-        #first make a locus collection of TSS
-        startDict = ROSE_utils.makeStartDict(annotFile)
+        #first make a locus collection of TSS, from the start dict of main if given
+        if startDict == None:
+            startDict = ROSE_utils.makeStartDict(annotFile)
 
         #now makeTSS loci for active genes
         removeTicker=0
@@ -110,11 +115,12 @@ def regionStitching(inputGFF,stitchWindow,tssWindow,annotFile,removeTSS=True):
 #=====================REGION LINKING MAPPING=======================
 #==================================================================
 
-def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolder,output,refName):
+def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolder,output,refName,telemetryFile = ''):
 
 
     '''
     makes a table of factor density in a stitched locus and ranks table by number of loci stitched together
+    if telemetryFile is given, progress records are appended to it as JSON lines
     '''
 
     
@@ -129,17 +135,22 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
     for locus in list(loci):
         if locus.chr() == 'chrY':
             loci.remove(locus)
+
+    #the collection hands loci back in no set order, so loci of the same length
+    #are listed by position, the same for a fresh and a reloaded collection
+    loci.sort(key = lambda locus: (locus.chr(),locus.start(),locus.ID()))
     
     for locus in loci:
         #numLociList.append(int(stitchLocus.ID().split('_')[1]))
         lociLenList.append(locus.len())
         #numOrder = order(numLociList,decreasing=True)
     lenOrder = ROSE_utils.order(lociLenList,decreasing=True)
-    ticker = 0
+
+    #each stitched locus is counted once for the table and once per bam
+    telemetry = ROSE_utils.Telemetry(telemetryFile,'mapCollection',len(loci)*(1+len(bamFileList)),label = output)
+    binStart = time.time()
     for i in lenOrder:
-        ticker+=1
-        if ticker%1000 ==0:
-            print(ticker)
+        telemetry.tick()
         locus = loci[i]
 
         #First get the size of the enriched regions within the stitched locus
@@ -154,6 +165,7 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
             stitchCount = 1
         
         locusTable.append([locus.ID(),locus.chr(),locus.start(),locus.end(),stitchCount,refEnrichSize])
+    telemetry.addTime('bin',time.time()-binStart)
         
             
 
@@ -167,6 +179,7 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
         
         #opening up the mapped GFF
         print('OPENING %s%s_%s_MAPPED.gff' % (mappedFolder,refName,bamFileName))
+        fetchStart = time.time()
 
         mappedGFF =ROSE_utils.parseTable('%s%s_%s_MAPPED.gff' % (mappedFolder,refName,bamFileName),'\t')        
 
@@ -190,8 +203,11 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
         
         mappedCollection = ROSE_utils.LocusCollection(mappedLoci,500)
         locusTable[0].append(bamFileName)
+        binStart = time.time()
+        telemetry.addTime('fetch',binStart-fetchStart)
 
         for i in range(1,len(locusTable)):
+            telemetry.tick()
             signal=0.0
             line = locusTable[i]
             lineLocus = ROSE_utils.Locus(line[1],line[2],line[3],'.')
@@ -199,8 +215,12 @@ def mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolde
             for region in overlappingRegions:
                 signal+= signalDict[region.ID()]
             locusTable[i].append(signal)
+        telemetry.addTime('bin',time.time()-binStart)
 
+    outputStart = time.time()
     ROSE_utils.unParseTable(locusTable,output,'\t')
+    telemetry.addTime('output',time.time()-outputStart)
+    telemetry.close()
 
 
 
@@ -237,6 +257,18 @@ def main():
                       help = "Enter a max linking distance for stitching")
     parser.add_option("-t","--tss", dest="tss",nargs = 1, default=0,
                       help = "Enter a distance from TSS to exclude. 0 = no TSS exclusion")
+    parser.add_option("--resume", dest="resume",action = 'store_true', default=False,
+                      help = "If flagged, skips every stage whose inputs and parameters are unchanged since it last ran in the output folder")
+    parser.add_option("-j","--jobs", dest="jobs",nargs = 1, default=None,
+                      help = "Enter the number of bamToGFF jobs to run at once. Default runs one per bam")
+    parser.add_option("--executor", dest="executor",type = 'choice',choices = ['local','slurm','lsf','fake'],default='local',
+                      help = "Enter where bamToGFF jobs run: local, slurm, lsf, or fake for a local stand-in cluster. Default is local")
+    parser.add_option("--submit-args", dest="submitArgs",nargs = 1, default='',
+                      help = "Enter extra arguments for sbatch or bsub, e.g. \"-p short --mem=8G\"")
+    parser.add_option("--profile", dest="profile",action = 'store_true', default=False,
+                      help = "If flagged, profiles every stage, including the bamToGFF and gene mapper runs, into the profile folder of the output folder")
+    parser.add_option("--native", dest="native",action = 'store_true', default=False,
+                      help = "If flagged, bamToGFF maps in process with the python liquidator instead of starting bamliquidator for every region")
 
 
 
@@ -258,23 +290,39 @@ def main():
     gffFolder = ROSE_utils.formatFolder(outFolder+'gff/',True)
     mappedFolder = ROSE_utils.formatFolder(outFolder+ 'mappedGFF/',True)
 
+    #progress records from every mapping stage are appended here as JSON lines
+    telemetryFile = outFolder + 'telemetry.jsonl'
+
+    #every stage, and every mapping process, records the resources it used here
+    metricsFile = outFolder + 'run_metrics.json'
+    metrics = ROSE_utils.StageMetrics(metricsFile,True)
+
+    #every stage, and every child process, writes its profile here
+    if options.profile:
+        profileFolder = ROSE_utils.formatFolder(outFolder + 'profile/',True)
+    else:
+        profileFolder = ''
+
+    #every stage records its inputs, parameters and outputs here
+    manifests = ROSE_utils.StageManifests(outFolder + 'manifests/',options.resume)
+
 
     #GETTING INPUT FILE
     if options.input.split('.')[-1] == 'bed':
         #CONVERTING A BED TO GFF
         inputGFFName = options.input.split('/')[-1][0:-4]
         inputGFFFile = '%s%s.gff' % (gffFolder,inputGFFName)
-        ROSE_utils.bedToGFF(options.input,inputGFFFile)
-    elif options.input.split('.')[-1] =='gff':
-        #COPY THE INPUT GFF TO THE GFF FOLDER
-	inputGFFFile = options.input
-        os.system('cp %s %s' % (inputGFFFile,gffFolder))        
-
+        if not manifests.isFresh('gff',[options.input],{}):
+            ROSE_utils.bedToGFF(options.input,inputGFFFile)
+            manifests.record('gff',[options.input],{},[inputGFFFile])
     else:
-        print('WARNING: INPUT FILE DOES NOT END IN .gff or .bed. ASSUMING .gff FILE FORMAT')
+        if options.input.split('.')[-1] != 'gff':
+            print('WARNING: INPUT FILE DOES NOT END IN .gff or .bed. ASSUMING .gff FILE FORMAT')
         #COPY THE INPUT GFF TO THE GFF FOLDER
-	inputGFFFile = options.input
-        os.system('cp %s %s' % (inputGFFFile,gffFolder))        
+        inputGFFFile = options.input
+        if not manifests.isFresh('gff',[inputGFFFile],{}):
+            os.system('cp %s %s' % (inputGFFFile,gffFolder))
+            manifests.record('gff',[inputGFFFile],{},[gffFolder + inputGFFFile.split('/')[-1]])
 
 
     #GETTING THE LIST OF BAMFILES TO PROCESS
@@ -322,6 +370,7 @@ def main():
     annotFile = genomeDict[upper(genome)]
 
     #MAKING THE START DICT
+    #ONE START DICT SERVES STITCHING AND GENE MAPPING
     print('MAKING START DICT')
     startDict = ROSE_utils.makeStartDict(annotFile)
 
@@ -331,15 +380,6 @@ def main():
     referenceCollection = ROSE_utils.gffToLocusCollection(inputGFFFile)
 
 
-    #NOW STITCH REGIONS
-    print('STITCHING REGIONS TOGETHER')
-    stitchedCollection,debugOutput = regionStitching(inputGFFFile,stitchWindow,tssWindow,annotFile,removeTSS)
-
-    
-    #NOW MAKE A STITCHED COLLECTION GFF
-    print('MAKING GFF FROM STITCHED COLLECTION')
-    stitchedGFF=ROSE_utils.locusCollectionToGFF(stitchedCollection)
-    
     if not removeTSS:
         stitchedGFFFile = '%s%s_%sKB_STITCHED.gff' % (gffFolder,inputName,stitchWindow/1000)
         stitchedGFFName = '%s_%sKB_STITCHED' % (inputName,stitchWindow/1000)
@@ -349,15 +389,34 @@ def main():
         stitchedGFFName = '%s_%sKB_STITCHED_TSS_DISTAL' % (inputName,stitchWindow/1000)
         debugOutFile = '%s%s_%sKB_STITCHED_TSS_DISTAL.debug' % (gffFolder,inputName,stitchWindow/1000)
 
-    #WRITING DEBUG OUTPUT TO DISK
-        
-    if debug:
-        print('WRITING DEBUG OUTPUT TO DISK AS %s' % (debugOutFile))
-        ROSE_utils.unParseTable(debugOutput,debugOutFile,'\t')
+    #STITCHING DEPENDS ON THE ANNOTATION ONLY WHEN TSSs ARE EXCLUDED
+    stitchInputs = [inputGFFFile]
+    if removeTSS:
+        stitchInputs.append(annotFile)
+    stitchParams = {'stitch':stitchWindow,'tss':tssWindow}
+
+    if manifests.isFresh('stitching',stitchInputs,stitchParams):
+        print('LOADING STITCHED REGIONS FROM %s' % (stitchedGFFFile))
+        stitchedCollection = ROSE_utils.gffToLocusCollection(stitchedGFFFile,50)
+    else:
+        #NOW STITCH REGIONS
+        print('STITCHING REGIONS TOGETHER')
+        stitchedCollection,debugOutput = metrics.measure('stitching',inputGFFFile,ROSE_utils.profileCall,profileFolder,'stitching',regionStitching,inputGFFFile,stitchWindow,tssWindow,annotFile,removeTSS,startDict)
 
-    #WRITE THE GFF TO DISK
-    print('WRITING STITCHED GFF TO DISK AS %s' % (stitchedGFFFile))
-    ROSE_utils.unParseTable(stitchedGFF,stitchedGFFFile,'\t')
+        #NOW MAKE A STITCHED COLLECTION GFF
+        print('MAKING GFF FROM STITCHED COLLECTION')
+        #IN THE ORDER THE RANKING BAM IS MAPPED IN, SO MAPPED ROWS ARE WRITTEN AS THEY COME
+        stitchedGFF=ROSE_utils.sortGFFByBam(ROSE_utils.locusCollectionToGFF(stitchedCollection),options.rankby)
+
+        #WRITING DEBUG OUTPUT TO DISK
+        if debug:
+            print('WRITING DEBUG OUTPUT TO DISK AS %s' % (debugOutFile))
+            ROSE_utils.unParseTable(debugOutput,debugOutFile,'\t')
+
+        #WRITE THE GFF TO DISK
+        print('WRITING STITCHED GFF TO DISK AS %s' % (stitchedGFFFile))
+        ROSE_utils.unParseTable(stitchedGFF,stitchedGFFFile,'\t')
+        manifests.record('stitching',stitchInputs,stitchParams,[stitchedGFFFile])
 
 
 
@@ -373,9 +432,17 @@ def main():
     # bin for bam mapping
     nBin =1
 
-    #IMPORTANT
-    #CHANGE cmd1 and cmd2 TO PARALLELIZE OUTPUT FOR BATCH SUBMISSION
-    #e.g. if using LSF cmd1 = "bsub python bamToGFF.py -f 1 -e 200 -r -m %s -b %s -i %s -o %s" % (nBin,bamFile,stitchedGFFFile,mappedOut1)
+    #MAPPING JOBS RUN AT MOST options.jobs AT A TIME, LOCALLY OR AS ONE CLUSTER JOB ARRAY
+    #CLUSTER JOB SCRIPTS AND LOGS GO INTO THE jobs FOLDER OF THE OUTPUT FOLDER
+    if options.jobs:
+        nJobs = int(options.jobs)
+    else:
+        nJobs = len(bamFileList)
+    scheduler = ROSE_utils.makeExecutor(options.executor,nJobs,outFolder+'jobs/',options.submitArgs)
+
+    #EACH MAPPED GFF IS A STAGE OF ITS OWN SO THAT A RESUMED RUN ONLY REMAPS THE REGIONS THAT CHANGED
+    mapParams = {'extension':200,'rpm':True,'matrix':nBin,'turbo':True,'format':ROSE_utils.MAPPING_FORMAT}
+    mappedStages = []
 
     for bamFile in bamFileList:
 
@@ -383,94 +450,95 @@ def main():
 
         #MAPPING TO THE STITCHED GFF
         mappedOut1 ='%s%s_%s_MAPPED.gff' % (mappedFolder,stitchedGFFName,bamFileName)
-        #WILL TRY TO RUN AS A BACKGROUND PROCESS. BATCH SUBMIT THIS LINE TO IMPROVE SPEED
-        cmd1 = "python ROSE_bamToGFF_turbo.py -e 200 -r -m %s -b %s -i %s -o %s &" % (nBin,bamFile,stitchedGFFFile,mappedOut1)
-        print(cmd1)
-        os.system(cmd1)
 
         #MAPPING TO THE ORIGINAL GFF
         mappedOut2 ='%s%s_%s_MAPPED.gff' % (mappedFolder,inputName,bamFileName)
-        #WILL TRY TO RUN AS A BACKGROUND PROCESS. BATCH SUBMIT THIS LINE TO IMPROVE SPEED
-        cmd2 = "python ROSE_bamToGFF_turbo.py 1 -e 200 -r -m %s -b %s -i %s -o %s &" % (nBin,bamFile,inputGFFFile,mappedOut2)
-        print(cmd2)
-        os.system(cmd2)
-        
-
-    
-    print('PAUSING TO MAP')
-    time.sleep(10)
-
-    #CHECK FOR MAPPING OUTPUT
-    outputDone = False
-    ticker = 0
-    print('WAITING FOR MAPPING TO COMPLETE. ELAPSED TIME (MIN):')
-    while not outputDone:
-
-        '''
-        check every 1 minutes for completed output
-        '''
-        outputDone = True
-        if ticker%6 == 0:
-            print(ticker*5)
-        ticker +=1
-        #CHANGE THIS PARAMETER TO ALLOW MORE TIME TO MAP
-        if ticker == 120:
-            print('ERROR: OPERATION TIME OUT. MAPPING OUTPUT NOT DETECTED AFTER 2 HOURS')
-            exit()
-            break
-        for bamFile in bamFileList:
-            
-            #GET THE MAPPED OUTPUT NAMES HERE FROM MAPPING OF EACH BAMFILE
-            bamFileName = bamFile.split('/')[-1]
-            mappedOut1 ='%s%s_%s_MAPPED.gff' % (mappedFolder,stitchedGFFName,bamFileName)
-
-            try:
-                 mapFile = open(mappedOut1,'r')
-                 mapFile.close()
-            except IOError:
-                outputDone = False
-
-            mappedOut2 ='%s%s_%s_MAPPED.gff' % (mappedFolder,inputName,bamFileName)
-            
-            try:
-                mapFile = open(mappedOut2,'r')
-                mapFile.close()
-            except IOError:
-                outputDone = False
-        if outputDone == True:
-            break
-        time.sleep(60)
-    print('MAPPING TOOK %s MINUTES' % (ticker))
-
-    print('BAM MAPPING COMPLETED NOW MAPPING DATA TO REGIONS')
-    #CALCULATE DENSITY BY REGION
-    mapCollection(stitchedCollection,referenceCollection,bamFileList,mappedFolder,outputFile1,refName = stitchedGFFName)
 
+        gffList = []
+        outputList = []
+        for gffFile,mappedOut in [(stitchedGFFFile,mappedOut1),(inputGFFFile,mappedOut2)]:
+            stage = 'map_%s' % (mappedOut.split('/')[-1])
+            if not manifests.isFresh(stage,[bamFile,gffFile],mapParams):
+                gffList.append(gffFile)
+                outputList.append(mappedOut)
+                mappedStages.append((stage,[bamFile,gffFile],[mappedOut]))
+        if len(gffList) == 0:
+            continue
+
+        #THE GFFS LEFT TO MAP ARE MAPPED IN ONE PASS OVER THE BAM
+        cmd = "python ROSE_bamToGFF_turbo.py -e 200 -r -m %s -b %s -i %s -o %s --telemetry %s --metrics %s" % (nBin,bamFile,join(gffList,','),join(outputList,','),telemetryFile,metricsFile)
+        if profileFolder:
+            cmd += " --profile %s" % (profileFolder)
+        if options.native:
+            cmd += " --native"
+        scheduler.submit(cmd,'bamToGFF_turbo_%s' % (bamFileName),outputList)
+
+    #WAITING FOR MAPPING TO COMPLETE
+    #CHANGE THIS PARAMETER TO ALLOW MORE TIME TO MAP
+    mappingStart = time.time()
+    mappingDone = scheduler.wait(2*3600)
+    #the mapping processes have appended their records by now
+    metrics.write()
+    if not mappingDone:
+        print('ERROR: BAM MAPPING FAILED')
+        sys.exit(scheduler.returncode())
+    print('MAPPING TOOK %.1f MINUTES' % ((time.time()-mappingStart)/60))
+    for stage,stageInputs,stageOutputs in mappedStages:
+        manifests.record(stage,stageInputs,mapParams,stageOutputs)
+
+    #THE REGION MAP READS THE STITCHED REGION DENSITIES OF EVERY BAM
+    regionMapInputs = [stitchedGFFFile,inputGFFFile] + ['%s%s_%s_MAPPED.gff' % (mappedFolder,stitchedGFFName,bamFile.split('/')[-1]) for bamFile in bamFileList]
+    regionMapParams = {'bams':[bamFile.split('/')[-1] for bamFile in bamFileList],'format':ROSE_utils.MAPPING_FORMAT}
+
+    if not manifests.isFresh('regionMap',regionMapInputs,regionMapParams):
+        print('BAM MAPPING COMPLETED NOW MAPPING DATA TO REGIONS')
+        #CALCULATE DENSITY BY REGION
+        metrics.measure('mapCollection',outputFile1,ROSE_utils.profileCall,profileFolder,'mapCollection',mapCollection,stitchedCollection,referenceCollection,bamFileList,mappedFolder,outputFile1,refName = stitchedGFFName,telemetryFile = telemetryFile)
+        manifests.record('regionMap',regionMapInputs,regionMapParams,[outputFile1])
 
-    time.sleep(10)
 
     print('CALLING AND PLOTTING SUPER-ENHANCERS')
 
 
     if options.control:
-
-        rankbyName = options.rankby.split('/')[-1]
         controlName = options.control.split('/')[-1]
-        cmd = 'R --no-save %s %s %s %s < ROSE_callSuper.R' % (outFolder,outputFile1,inputName,controlName)
-
     else:
-        rankbyName = options.rankby.split('/')[-1]
         controlName = 'NONE'
-        cmd = 'R --no-save %s %s %s %s < ROSE_callSuper.R' % (outFolder,outputFile1,inputName,controlName)
-    print(cmd)
-    os.system(cmd)
 
+    #THE CUTOFF IS CALLED IN PROCESS BY THE PYTHON PORT OF ROSE_callSuper.R
+    superInputs = [outputFile1,'ROSE_callSuper.py']
+    superParams = {'name':inputName,'control':controlName,'format':ROSE_utils.MAPPING_FORMAT}
+    if not manifests.isFresh('callSuper',superInputs,superParams):
+        superOutputs = metrics.measure('cutoff',outputFile1,ROSE_utils.profileCall,profileFolder,'callSuper',ROSE_callSuper.callSuper,outFolder,outputFile1,inputName,controlName)
+        if len(superOutputs) > 0:
+            manifests.record('callSuper',superInputs,superParams,superOutputs)
+        else:
+            print('ERROR: CALLING SUPER-ENHANCERS DID NOT WRITE ITS OUTPUT')
 
-    #calling the gene mapper                                                                        
-    time.sleep(20)
+
+    #MAPPING GENES TO THE SUPER-ENHANCERS IN PROCESS WITH THE START DICT ALREADY MADE
     superTableFile = "%s_SuperEnhancers.table.txt" % (inputName)
-    cmd = "python ROSE_geneMapper.py -g %s -i %s%s" % (genome,outFolder,superTableFile)
-    os.system(cmd)    
+
+    geneInputs = [outFolder + superTableFile,annotFile]
+    geneParams = {'genome':genome,'window':50000}
+    geneOutputs = ['%s%s_SuperEnhancers_%s.txt' % (outFolder,inputName,suffix) for suffix in ['ENHANCER_TO_GENE','GENE_TO_ENHANCER']]
+    if not manifests.isFresh('geneMapper',geneInputs,geneParams):
+        if os.path.exists(outFolder + superTableFile):
+            print('MAPPING GENES TO %s%s' % (outFolder,superTableFile))
+            geneAnnotation = ROSE_geneMapper.loadGeneAnnotation(annotFile,'',startDict)
+            enhancerToGeneTable,geneToEnhancerTable = metrics.measure('mapEnhancerToGene',outFolder + superTableFile,ROSE_utils.profileCall,profileFolder,'geneMapper_%s' % (superTableFile),ROSE_geneMapper.mapEnhancerToGene,annotFile,outFolder + superTableFile,'',True,50000,False,geneAnnotation)
+            ROSE_utils.unParseTable(enhancerToGeneTable,geneOutputs[0],'\t')
+            ROSE_utils.unParseTable(geneToEnhancerTable,geneOutputs[1],'\t')
+            manifests.record('geneMapper',geneInputs,geneParams,geneOutputs)
+        else:
+            print('ERROR: NO SUPER-ENHANCER TABLE TO MAP GENES TO')
+
+    if profileFolder:
+        ROSE_utils.summarizeProfiles(profileFolder)
+        print('WROTE PROFILES TO %s' % (profileFolder))
+
+    metrics.write()
+    print('WROTE RESOURCE METRICS TO %s' % (metricsFile))
 
 
 
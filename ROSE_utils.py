@@ -6,6 +6,23 @@ from string import *
 import sys
 import subprocess
 import datetime
+import struct
+import zlib
+import hashlib
+import shutil
+import itertools
+import json
+import time
+import cProfile
+import pstats
+import glob
+import threading
+import Queue
+import shlex
+import pipes
+import resource
+
+import numpy
 
 from collections import defaultdict
 
@@ -36,6 +53,84 @@ def unParseTable(table, output, sep):
 
     fh_out.close()
 
+
+def unParseTables(indexedRows,outputList,sep,bufferSize = 1048576):
+    '''
+    writes a stream of (tableIndex,row) pairs to one output file per table
+    through buffered handles, so rows reach disk while the stream is still
+    being made and never have to be held in memory together.
+    rows go to output.tmp files that are renamed once the stream is done,
+    so an output file only exists once it is complete
+    '''
+    tempList = ['%s.tmp' % (output) for output in outputList]
+    handleList = [open(tempFile,'w',bufferSize) for tempFile in tempList]
+    try:
+        for i,line in indexedRows:
+            handleList[i].write(join([str(x) for x in line],sep))
+            handleList[i].write('\n')
+    finally:
+        for fh_out in handleList:
+            fh_out.close()
+    for tempFile,output in zip(tempList,outputList):
+        os.rename(tempFile,output)
+
+
+#binned density tables can also be stored as a .npy matrix of floats, with the
+#ID and locus of each row kept in a small text index next to it
+
+def matrixFiles(output):
+    '''
+    returns the (.npy matrix, .regions.txt index) file names used in place of a table output
+    '''
+    root = os.path.splitext(output)[0]
+    return root + '.npy',root + '.regions.txt'
+
+
+def unParseMatrices(indexedRows,outputList,nBins):
+    '''
+    writes a stream of (tableIndex,row) pairs of mapped gff rows as one .npy
+    matrix and .regions.txt index per output. the first row of each table is
+    its header. bin values are stored as float64, NA as nan.
+    the matrix is written last, so it only exists once both files are complete
+    '''
+    tempList = ['%s.body.tmp' % (matrixFiles(output)[0]) for output in outputList]
+    bodyList = [open(tempFile,'wb',1048576) for tempFile in tempList]
+    regionList = [open('%s.tmp' % (matrixFiles(output)[1]),'w',1048576) for output in outputList]
+    rowCounts = [-1]*len(outputList)
+    try:
+        for i,line in indexedRows:
+            if rowCounts[i] == -1:
+                regionList[i].write(join([str(x) for x in line],'\t') + '\n')
+            else:
+                regionList[i].write('%s\t%s\n' % (line[0],line[1]))
+                values = [numpy.nan if x == 'NA' else x for x in line[2:]]
+                bodyList[i].write(numpy.array(values,dtype='<f8').tostring())
+            rowCounts[i] += 1
+    finally:
+        for fh in bodyList + regionList:
+            fh.close()
+
+    for i in range(len(outputList)):
+        matrixFile,regionFile = matrixFiles(outputList[i])
+        os.rename(regionFile + '.tmp',regionFile)
+        fh_out = open(matrixFile + '.tmp','wb')
+        numpy.lib.format.write_array_header_1_0(fh_out,{'descr':'<f8','fortran_order':False,'shape':(max(rowCounts[i],0),nBins)})
+        fh_body = open(tempList[i],'rb')
+        shutil.copyfileobj(fh_body,fh_out,1048576)
+        fh_body.close()
+        fh_out.close()
+        os.remove(tempList[i])
+        os.rename(matrixFile + '.tmp',matrixFile)
+
+
+def loadMatrix(output):
+    '''
+    loads a table written by unParseMatrices. returns the region index as a
+    table (header row first) and the density matrix, memory mapped read only
+    '''
+    matrixFile,regionFile = matrixFiles(output)
+    return parseTable(regionFile,'\t'),numpy.load(matrixFile,mmap_mode='r')
+
 #parseTable 4/14/08
 #takes in a table where columns are separated by a given symbol and outputs
 #a nested list such that list[row][col]
@@ -495,6 +590,22 @@ def locusCollectionToGFF(locusCollection):
     return gff
 
 
+def sortGFFByBam(gff,bamFile):
+    '''
+    returns the lines of a gff sorted by the order of their chromosomes in the
+    header of bamFile, then by start, end and ID. this is the order bamToGFF
+    maps regions in, so the rows of a sorted gff are written as they are mapped.
+    chromosomes missing from the bam go first, as bamToGFF gets to them first
+    '''
+    reader = BamReader(bamFile)
+    refIDs = {}
+    for line in gff:
+        if not refIDs.has_key(line[0]):
+            refIDs[line[0]] = reader.resolveChrom(line[0])
+    reader.close()
+    return sorted(gff,key = lambda line: (refIDs[line[0]],int(line[3]),int(line[4]),line[1]))
+
+
 def gffToLocusCollection(gff,window =500):
 
     '''
@@ -550,8 +661,10 @@ def makeTranscriptCollection(annotFile,upSearch,downSearch,window = 500,geneList
         ticker = 0
         if len(geneList) == 0:
             geneList =refseqDict.keys()
+        #a set keeps the lookup per transcript constant
+        geneSet = set(geneList)
         for line in refseqTable[1:]:
-            if geneList.count(line[1]) > 0:
+            if line[1] in geneSet:
                 if line[3] == '-':
                     locus = Locus(line[2],int(line[4])-downSearch,int(line[5])+upSearch,line[3],line[1])
                 else:
@@ -590,6 +703,438 @@ def makeSearchLocus(locus,upSearch,downSearch):
     return searchLocus
 
 
+def overlapJoin(queryLoci,regionLoci):
+    '''
+    returns for each locus of queryLoci the indexes of the loci of regionLoci
+    that overlap it on either strand, as getOverlap(locus,'both') would find them.
+    both lists are sorted once and swept together chromosome by chromosome,
+    the overlapping regions of a query come back in order of their start
+    '''
+    overlaps = [[] for locus in queryLoci]
+
+    regionsByChrom = defaultdict(list)
+    for j,region in enumerate(regionLoci):
+        regionsByChrom[region.chr()].append((region.start(),region.end(),j))
+    queriesByChrom = defaultdict(list)
+    for i,locus in enumerate(queryLoci):
+        queriesByChrom[locus.chr()].append((locus.start(),locus.end(),i))
+
+    for chrom,queries in queriesByChrom.items():
+        regions = sorted(regionsByChrom[chrom])
+        queries.sort()
+        nextRegion = 0
+        active = []
+        for start,end,i in queries:
+            #regions open once they start before the query ends
+            while nextRegion < len(regions) and regions[nextRegion][0] <= end:
+                active.append(regions[nextRegion])
+                nextRegion += 1
+            #and close for good once they end before a query starts, as later queries start later
+            active = [region for region in active if region[1] >= start]
+            overlaps[i] = [j for regionStart,regionEnd,j in active if regionStart <= end]
+    return overlaps
+
+
+#==================================================================
+#==========================BAM READER==============================
+#==================================================================
+
+#native reader for sorted and indexed bams
+#decodes the BGZF blocks and walks the .bai index in process so that region
+#queries do not have to start a samtools subprocess and parse SAM text
+
+#bin of the .bai pseudo bin that holds per reference metadata
+BAI_PSEUDO_BIN = 37450
+
+#cigar operations that consume the reference
+CIGAR_OPS = 'MIDNSHP=X'
+CIGAR_REF_OPS = [0,2,3,7,8]
+
+#lookup table turning one byte of packed sequence into two bases
+SEQ_CODES = '=ACMGRSVTWYHKDBN'
+SEQ_TABLE = [SEQ_CODES[i>>4] + SEQ_CODES[i&15] for i in range(256)]
+
+#lookup table turning binary base qualities into phred+33 text
+QUAL_TABLE = join([chr(min(i+33,126)) for i in range(256)],'')
+
+def reg2bins(beg,end):
+    '''
+    returns the list of bins that may hold reads overlapping the 0-based
+    half open interval [beg,end) following the SAM spec binning scheme
+    '''
+    end -= 1
+    bins = [0]
+    bins += range(1+(beg>>26),2+(end>>26))
+    bins += range(9+(beg>>23),10+(end>>23))
+    bins += range(73+(beg>>20),74+(end>>20))
+    bins += range(585+(beg>>17),586+(end>>17))
+    bins += range(4681+(beg>>14),4682+(end>>14))
+    return bins
+
+
+def chromAliases(chrom):
+    '''
+    returns the names a chromosome may go by in a bam: with and without
+    the chr prefix, and chrM/chrMT/M/MT for the mitochondrial genome
+    '''
+    if chrom[0:3] == 'chr':
+        base = chrom[3:]
+    else:
+        base = chrom
+    if base.upper() == 'M' or base.upper() == 'MT':
+        baseList = ['M','MT']
+    else:
+        baseList = [base]
+    return baseList + ['chr' + base for base in baseList]
+
+
+class BamReader:
+    '''reads alignment records out of a sorted bam using its .bai index'''
+
+    #refID,pos,l_read_name,mapq,bin,n_cigar_op,flag,l_seq,next_refID,next_pos,tlen
+    __coreStruct = struct.Struct('<iiBBHHHiiii')
+
+    def __init__(self,bamFile,baiFile = ''):
+        self._bam = bamFile
+        if len(baiFile) == 0:
+            if os.path.exists(bamFile + '.bai'):
+                baiFile = bamFile + '.bai'
+            else:
+                baiFile = bamFile[0:-4] + '.bai'
+        self._bai = baiFile
+        self._fh = open(bamFile,'rb')
+        self._blockCache = {}
+        self._index = None
+        self.__readHeader()
+
+    #==============================BGZF==============================
+
+    def __readBlock(self,coffset):
+        '''
+        returns the decompressed data of the BGZF block at coffset
+        and the file offset of the next block
+        '''
+        if self._blockCache.has_key(coffset):
+            return self._blockCache[coffset]
+        self._fh.seek(coffset)
+        header = self._fh.read(18)
+        if len(header) < 18:
+            return '',coffset
+        bsize = struct.unpack('<H',header[16:18])[0]
+        cdata = self._fh.read(bsize - 25)
+        self._fh.read(8)
+        data = zlib.decompress(cdata,-15)
+        #only the most recently touched blocks are worth keeping around
+        if len(self._blockCache) > 64:
+            self._blockCache.clear()
+        self._blockCache[coffset] = (data,coffset + bsize + 1)
+        return self._blockCache[coffset]
+
+    def __readHeader(self):
+        '''
+        reads the reference names and lengths out of the bam header
+        '''
+        data = ''
+        coffset = 0
+        #the header can span several blocks, so keep reading until it is all in hand
+        while True:
+            block,coffset = self.__readBlock(coffset)
+            if len(block) == 0:
+                break
+            data += block
+            if len(data) < 8:
+                continue
+            lText = struct.unpack_from('<i',data,4)[0]
+            if len(data) < 12 + lText:
+                continue
+            nRef = struct.unpack_from('<i',data,8+lText)[0]
+            p = 12 + lText
+            complete = True
+            for i in range(nRef):
+                if len(data) < p + 4:
+                    complete = False
+                    break
+                lName = struct.unpack_from('<i',data,p)[0]
+                p += 8 + lName
+                if len(data) < p:
+                    complete = False
+                    break
+            if complete:
+                break
+        if data[0:4] != 'BAM\x01':
+            raise ValueError('%s is not a bam file' % (self._bam))
+
+        self._text = data[8:8+lText]
+        self._refNames = []
+        self._refLengths = []
+        p = 12 + lText
+        for i in range(nRef):
+            lName = struct.unpack_from('<i',data,p)[0]
+            self._refNames.append(data[p+4:p+3+lName])
+            self._refLengths.append(struct.unpack_from('<i',data,p+4+lName)[0])
+            p += 8 + lName
+        self._refDict = dict([(name,i) for i,name in enumerate(self._refNames)])
+
+        #aliases resolve only when no reference carries that exact name
+        self._aliasDict = {}
+        for i,name in enumerate(self._refNames):
+            for alias in chromAliases(name):
+                if not self._refDict.has_key(alias) and not self._aliasDict.has_key(alias):
+                    self._aliasDict[alias] = i
+
+    #==============================INDEX=============================
+
+    def __readIndex(self):
+        '''
+        loads the bins, chunks and linear index of every reference from the .bai
+        '''
+        fh = open(self._bai,'rb')
+        data = fh.read()
+        fh.close()
+        if data[0:4] != 'BAI\x01':
+            raise ValueError('%s is not a bam index' % (self._bai))
+        nRef = struct.unpack_from('<i',data,4)[0]
+        p = 8
+        self._index = []
+        for i in range(nRef):
+            binDict = {}
+            meta = None
+            nBin = struct.unpack_from('<i',data,p)[0]
+            p += 4
+            for j in range(nBin):
+                binID,nChunk = struct.unpack_from('<Ii',data,p)
+                p += 8
+                chunks = struct.unpack_from('<%dQ' % (2*nChunk),data,p)
+                p += 16*nChunk
+                chunks = [(chunks[k],chunks[k+1]) for k in range(0,2*nChunk,2)]
+                if binID == BAI_PSEUDO_BIN:
+                    meta = chunks
+                else:
+                    binDict[binID] = chunks
+            nIntv = struct.unpack_from('<i',data,p)[0]
+            p += 4
+            linear = struct.unpack_from('<%dQ' % (nIntv),data,p)
+            p += 8*nIntv
+            self._index.append({'bins':binDict,'linear':linear,'meta':meta})
+        #number of reads with no coordinate is an optional trailing field
+        if len(data) >= p + 8:
+            self._noCoor = struct.unpack_from('<Q',data,p)[0]
+        else:
+            self._noCoor = 0
+
+    def __getChunks(self,refID,beg,end):
+        '''
+        returns the sorted and merged list of chunks that may hold reads
+        overlapping [beg,end) on refID
+        '''
+        if self._index == None:
+            self.__readIndex()
+        if refID >= len(self._index):
+            return []
+        refIndex = self._index[refID]
+        linear = refIndex['linear']
+        if len(linear) == 0:
+            minOffset = 0
+        elif (beg>>14) < len(linear):
+            minOffset = linear[beg>>14]
+        else:
+            minOffset = linear[-1]
+
+        chunks = []
+        for binID in reg2bins(beg,end):
+            if refIndex['bins'].has_key(binID):
+                chunks += [chunk for chunk in refIndex['bins'][binID] if chunk[1] > minOffset]
+        chunks.sort()
+
+        merged = []
+        for chunk in chunks:
+            if len(merged) > 0 and chunk[0] <= merged[-1][1]:
+                if chunk[1] > merged[-1][1]:
+                    merged[-1] = (merged[-1][0],chunk[1])
+            else:
+                merged.append(chunk)
+        return merged
+
+    #==============================RECORDS===========================
+
+    def __iterRecords(self,refID,beg,end):
+        '''
+        yields (data,offset,core,refEnd) for every record on refID that overlaps
+        the 0-based half open interval [beg,end). data[offset:] holds the record
+        after the block_size field and refEnd is the 0-based end of the alignment
+        '''
+        coreStruct = self.__coreStruct
+        for cbeg,cend in self.__getChunks(refID,beg,end):
+            coffset = cbeg >> 16
+            skip = cbeg & 0xffff
+            endBlock = cend >> 16
+            endU = cend & 0xffff
+            buf = ''
+            while coffset < endBlock or (coffset == endBlock and endU > 0):
+                data,nextOffset = self.__readBlock(coffset)
+                if len(data) == 0:
+                    break
+                if coffset == endBlock:
+                    data = data[0:endU]
+                if skip > 0:
+                    data = data[skip:]
+                    skip = 0
+                buf += data
+                coffset = nextOffset
+
+                #walk every complete record currently in the buffer
+                p = 0
+                nBuf = len(buf)
+                while p + 4 <= nBuf:
+                    blockSize = struct.unpack_from('<i',buf,p)[0]
+                    if p + 4 + blockSize > nBuf:
+                        break
+                    core = coreStruct.unpack_from(buf,p+4)
+                    offset = p + 4
+                    p += 4 + blockSize
+                    if core[0] != refID or core[1] >= end:
+                        #sorted bam, so nothing further along can overlap
+                        return
+                    refLen = 0
+                    if core[5] > 0:
+                        cigarStart = offset + 32 + core[2]
+                        for op in struct.unpack_from('<%dI' % (core[5]),buf,cigarStart):
+                            if CIGAR_REF_OPS.count(op & 15):
+                                refLen += op >> 4
+                    refEnd = core[1] + max(refLen,1)
+                    if refEnd <= beg:
+                        continue
+                    yield buf,offset,core,refEnd
+                buf = buf[p:]
+
+    def readCounts(self):
+        '''
+        returns (mapped,unmapped) read counts summed from the per reference
+        metadata of the .bai, or None if the index was written without it.
+        unmapped includes the reads with no coordinate
+        '''
+        if self._index == None:
+            self.__readIndex()
+        mapped = 0
+        unmapped = self._noCoor
+        for refIndex in self._index:
+            if refIndex['meta'] == None:
+                #a reference with no reads has no bins and no metadata
+                if len(refIndex['bins']) > 0:
+                    return None
+                continue
+            mapped += refIndex['meta'][1][0]
+            unmapped += refIndex['meta'][1][1]
+        return mapped,unmapped
+
+    def resolveChrom(self,chrom):
+        '''
+        returns the integer reference ID of a chromosome name, allowing for
+        chr/no chr and chrM/MT naming differences, or -1 if it is not in the bam
+        '''
+        if self._refDict.has_key(chrom):
+            return self._refDict[chrom]
+        for alias in chromAliases(chrom):
+            if self._refDict.has_key(alias):
+                return self._refDict[alias]
+            if self._aliasDict.has_key(alias):
+                return self._aliasDict[alias]
+        return -1
+
+    def __queryBounds(self,chrom,start,end):
+        '''
+        converts a 1-based inclusive region into a refID and 0-based half open interval.
+        chrom is either a reference ID or a name to resolve
+        '''
+        if type(chrom) == int:
+            refID = chrom
+        else:
+            refID = self.resolveChrom(chrom)
+        if refID < 0 or refID >= len(self._refNames):
+            return None
+        return refID,max(int(start)-1,0),int(end)
+
+    def references(self):
+        '''returns the list of reference names in header order'''
+        return list(self._refNames)
+
+    def referenceLengths(self):
+        '''returns a dictionary of reference lengths keyed by reference name'''
+        return dict(zip(self._refNames,self._refLengths))
+
+    def fetch(self,chrom,start,end):
+        '''
+        returns reads overlapping the 1-based inclusive region chrom:start-end
+        as SAM style field lists like samtools view. optional tags are not decoded
+        '''
+        bounds = self.__queryBounds(chrom,start,end)
+        if bounds == None:
+            return []
+        refID,beg,end = bounds
+        reads = []
+        for buf,offset,core,refEnd in self.__iterRecords(refID,beg,end):
+            (refID,pos,lName,mapq,binID,nCigar,flag,lSeq,nextRefID,nextPos,tlen) = core
+            p = offset + 32
+            name = buf[p:p+lName-1]
+            p += lName
+            if nCigar > 0:
+                ops = struct.unpack_from('<%dI' % (nCigar),buf,p)
+                cigar = join(['%s%s' % (op>>4,CIGAR_OPS[op&15]) for op in ops],'')
+            else:
+                cigar = '*'
+            p += 4*nCigar
+            if lSeq > 0:
+                packed = bytearray(buf[p:p+(lSeq+1)/2])
+                seq = join([SEQ_TABLE[b] for b in packed],'')[0:lSeq]
+                qual = buf[p+(lSeq+1)/2:p+(lSeq+1)/2+lSeq]
+                if qual[0] == '\xff':
+                    qual = '*'
+                else:
+                    qual = qual.translate(QUAL_TABLE)
+            else:
+                seq = '*'
+                qual = '*'
+            if nextRefID == -1:
+                nextChrom = '*'
+            elif nextRefID == refID:
+                nextChrom = '='
+            else:
+                nextChrom = self._refNames[nextRefID]
+            reads.append([name,str(flag),self._refNames[refID],str(pos+1),str(mapq),cigar,nextChrom,str(nextPos+1),str(tlen),seq,qual])
+        return reads
+
+    def fetchPositions(self,chrom,start,end):
+        '''
+        fast path of fetch that skips decoding names, sequences and qualities.
+        returns a list of (start,end,flag,length,cigarOps,seqKey) tuples where start
+        and end are the 1-based inclusive alignment coordinates, length is the read
+        length, cigarOps are the raw cigar integers and seqKey is the packed
+        sequence for use as a uniqueness key
+        '''
+        return list(self.iterPositions(chrom,start,end))
+
+    def iterPositions(self,chrom,start,end):
+        '''
+        generator version of fetchPositions for scans too long to hold in a list
+        '''
+        bounds = self.__queryBounds(chrom,start,end)
+        if bounds == None:
+            return
+        refID,beg,end = bounds
+        for buf,offset,core,refEnd in self.__iterRecords(refID,beg,end):
+            p = offset + 32 + core[2]
+            if core[5] > 0:
+                ops = struct.unpack_from('<%dI' % (core[5]),buf,p)
+            else:
+                ops = ()
+            p += 4*core[5]
+            seqKey = buf[p:p+(core[7]+1)/2]
+            yield (core[1]+1,refEnd,core[6],core[7],ops,seqKey)
+
+    def close(self):
+        self._fh.close()
+
+
 #==================================================================
 #==========================BAM CLASS===============================
 #==================================================================
@@ -599,36 +1144,154 @@ def makeSearchLocus(locus,upSearch,downSearch):
 
 
 def checkChrStatus(bamFile):
-    command = 'samtools view %s | head -n 1' % (bamFile)
-    #print "TESTING"
-    #print command
-    stats = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
-    statLines = stats.stdout.readlines()
-    stats.stdout.close()
-    chrPattern = re.compile('chr')
-    for line in statLines:
-      #print line
-      sline = line.split("\t")
-      #print sline[2]
-      if re.search(chrPattern, sline[2]):
-	return 1
-      else:
-	return 0
+    '''
+    returns 1 if the first reference of the bam header is named chr*, otherwise 0.
+    BamReader.resolveChrom handles either naming, so bamToGFF no longer needs this
+    '''
+    reader = BamReader(bamFile)
+    references = reader.references()
+    reader.close()
+    if len(references) > 0 and references[0].count('chr') > 0:
+        return 1
+    else:
+        return 0
 	    
+
+#modes for the unique option of the Bam read queries
+#True or 'sequence' drops reads whose sequence was already seen in the region
+#'position' drops reads whose 5' end and strand were already seen in the region
+#'flag' drops reads that a duplicate marker flagged with 0x400
+DEDUP_MODES = [False,True,'sequence','position','flag']
+
+def cigarRefLength(cigar):
+    '''
+    returns the number of reference bases a SAM cigar string spans
+    '''
+    return sum([int(n) for n,op in re.findall(r'(\d+)([MIDNSHP=X])',cigar) if op in 'MDN=X'])
+
+def fivePrimeKey(start,end,readStrand):
+    '''
+    returns an integer key of the 5' end and strand of a read with 1-based
+    inclusive alignment coordinates, for position based deduplication
+    '''
+    if readStrand == '-':
+        return end*2 + 1
+    else:
+        return start*2
+
 def convertBitwiseFlag(flag):
    if int(flag) & 16:
 	return "-";
    else:
 	return "+";
+
+
+class ReadBatch:
+    '''
+    the reads of one region as a struct of arrays: numpy arrays of 1-based
+    inclusive starts and ends, a boolean array that is True for - strand
+    reads, and an optional list of read IDs
+    '''
+    def __init__(self,chrom,starts,ends,minus,IDs = None):
+        self._chr = chrom
+        self._starts = numpy.asarray(starts,dtype=numpy.int64)
+        self._ends = numpy.asarray(ends,dtype=numpy.int64)
+        self._minus = numpy.asarray(minus,dtype=bool)
+        self._IDs = IDs
+    def chr(self): return self._chr
+    def starts(self): return self._starts
+    def ends(self): return self._ends
+    def minus(self): return self._minus
+    def IDs(self): return self._IDs
+    def __len__(self): return len(self._starts)
+    def strands(self):
+        '''returns the list of read strands, + or -'''
+        return ['-' if x else '+' for x in self._minus.tolist()]
+    def select(self,mask):
+        '''
+        returns a new ReadBatch of the reads picked by a boolean mask or index array
+        '''
+        if self._IDs == None:
+            IDs = None
+        else:
+            IDs = [self._IDs[i] for i in numpy.arange(len(self))[mask].tolist()]
+        return ReadBatch(self._chr,self._starts[mask],self._ends[mask],self._minus[mask],IDs)
+    def extend(self,extension):
+        '''
+        returns a new ReadBatch with + reads extended downstream of their end
+        and - reads upstream of their start by extension bp
+        '''
+        starts = numpy.where(self._minus,self._starts-extension,self._starts)
+        ends = numpy.where(self._minus,self._ends,self._ends+extension)
+        return ReadBatch(self._chr,starts,ends,self._minus,self._IDs)
+    def strandMask(self,countPlus,countMinus):
+        '''
+        returns a boolean mask of the reads on the counted strands
+        '''
+        mask = numpy.zeros(len(self),dtype=bool)
+        if countPlus:
+            mask |= ~self._minus
+        if countMinus:
+            mask |= self._minus
+        return mask
+    def toLoci(self):
+        '''returns the reads as a list of Locus objects like readsToLoci'''
+        if self._IDs == None:
+            IDs = ['']*len(self)
+        else:
+            IDs = self._IDs
+        return [Locus(self._chr,start,end,strand,ID) for start,end,strand,ID in zip(self._starts.tolist(),self._ends.tolist(),self.strands(),IDs)]
+
            
 class Bam:
     '''A class for a sorted and indexed bam file that allows easy analysis of reads'''
     def __init__(self,bamFile):
         self._bam = bamFile
-        
+        self._reader = None
+
+    def getReader(self):
+        '''
+        returns the in process BamReader for this bam, opening it on first use
+        '''
+        if self._reader == None:
+            self._reader = BamReader(self._bam)
+        return self._reader
+
 
-	  
     def getTotalReads(self,readType = 'mapped'):
+        '''
+        returns the number of mapped or total reads in the bam.
+        counts come from the .bai metadata and are remembered in a sidecar
+        file next to the bam. samtools flagstat is only run if the index
+        has no metadata
+        '''
+        countFile = self._bam + '.counts'
+        bamStat = os.stat(self._bam)
+        bamKey = [str(bamStat.st_size),repr(bamStat.st_mtime)]
+        counts = {}
+        if os.path.exists(countFile):
+            for line in parseTable(countFile,'\t'):
+                counts[line[0]] = line[1]
+            if [counts.get('size'),counts.get('mtime')] != bamKey:
+                counts = {}
+        if not counts.has_key(readType):
+            indexCounts = self.getReader().readCounts()
+            if indexCounts:
+                counts['mapped'] = str(indexCounts[0])
+                counts['total'] = str(indexCounts[0] + indexCounts[1])
+            else:
+                counts[readType] = str(self.getFlagstatReads(readType))
+            counts['size'],counts['mtime'] = bamKey
+            #the bam folder may not be writable, in which case nothing is remembered
+            try:
+                tempFile = '%s.%s.tmp' % (countFile,os.getpid())
+                unParseTable([[key,counts[key]] for key in sorted(counts.keys())],tempFile,'\t')
+                os.rename(tempFile,countFile)
+            except (IOError,OSError):
+                pass
+        return int(counts[readType])
+
+    def getFlagstatReads(self,readType = 'mapped'):
         command = 'samtools flagstat %s' % (self._bam)
         stats = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
         statLines = stats.stdout.readlines()
@@ -649,18 +1312,15 @@ class Bam:
 
     def getRawReads(self,locus,sense,unique = False,includeJxnReads = False,printCommand = False):
         '''
-        gets raw reads from the bam using samtools view.
-        can enforce uniqueness and strandedness
+        gets raw reads from the bam as samtools view style field lists.
+        can enforce uniqueness and strandedness.
+        unique is one of DEDUP_MODES
         '''
-        locusLine = locus.chr()+':'+str(locus.start())+'-'+str(locus.end())
+        locusLine = str(locus.chr())+':'+str(locus.start())+'-'+str(locus.end())
         
-        command = 'samtools view %s %s' % (self._bam,locusLine)
         if printCommand:
-            print(command)
-        getReads = subprocess.Popen(command,stdin = subprocess.PIPE,stderr = subprocess.PIPE,stdout = subprocess.PIPE,shell = True)
-        reads = getReads.communicate()
-        reads = reads[0].split('\n')[:-1]
-        reads = [read.split('\t') for read in reads]
+            print('fetching %s from %s' % (locusLine,self._bam))
+        reads = self.getReader().fetch(locus.chr(),locus.start(),locus.end())
         if includeJxnReads == False:
             reads = filter(lambda x: x[5].count('N') < 1,reads)
 
@@ -673,6 +1333,7 @@ class Bam:
         #convert = string.maketrans('160','--+')
         keptReads = []
         seqDict = defaultdict(int)
+        positionSet = set()
         if sense == '-':
           strand = ['+','-']
           strand.remove(locus.sense())
@@ -685,16 +1346,141 @@ class Bam:
             #readStrand = convertDict[read[1]]
             readStrand = convertBitwiseFlag(read[1])
 
+            if unique == 'position':
+                start = int(read[3])
+                key = fivePrimeKey(start,start+max(cigarRefLength(read[5]),1)-1,readStrand)
+                seen = key in positionSet
+                positionSet.add(key)
+            elif unique == 'flag':
+                seen = int(read[1]) & 1024 != 0
+            elif unique:
+                seen = seqDict[read[9]] > 0
+                seqDict[read[9]]+=1
+            else:
+                seen = False
+
             if sense == 'both' or sense == '.' or readStrand == strand:
 
-                if unique and seqDict[read[9]] == 0:
-                    keptReads.append(read)
-                elif not unique:
+                if not seen:
                     keptReads.append(read)
-            seqDict[read[9]]+=1
-            
+
         return keptReads
 
+    def getReadBatch(self,locus,sense = 'both',unique = False,includeJxnReads = False,IDtag = 'none'):
+        '''
+        struct of arrays version of getReadsLocus that returns a ReadBatch.
+        applies the same strand, uniqueness and junction rules as getRawReads
+        and splits junction reads like readsToLoci, all as array operations.
+        IDtag is one of sequence, seqID or none
+        '''
+        reader = self.getReader()
+        reads = reader.fetchPositions(locus.chr(),locus.start(),locus.end())
+        nRead = len(reads)
+        starts = numpy.array([read[0] for read in reads],dtype=numpy.int64)
+        ends = numpy.array([read[1] for read in reads],dtype=numpy.int64)
+        flags = numpy.array([read[2] for read in reads],dtype=numpy.int64)
+        lengths = numpy.array([read[3] for read in reads],dtype=numpy.int64)
+        minus = flags & 16 != 0
+
+        #cigars are parsed as one flat array of operations
+        nOps = numpy.array([len(read[4]) for read in reads],dtype=numpy.int64)
+        ops = numpy.fromiter(itertools.chain.from_iterable([read[4] for read in reads]),dtype=numpy.int64)
+        opStarts = numpy.cumsum(nOps) - nOps
+        opReads = numpy.repeat(numpy.arange(nRead),nOps)
+        nJxn = numpy.bincount(opReads[ops & 15 == 3],minlength=nRead)
+
+        keep = numpy.ones(nRead,dtype=bool)
+        if includeJxnReads == False:
+            keep &= nJxn == 0
+
+        #duplicates are judged against every read left, whatever its strand
+        if unique == 'position':
+            candidates = numpy.nonzero(keep)[0]
+            keys = numpy.where(minus,ends*2+1,starts*2)[candidates]
+            firstSeen = numpy.zeros(nRead,dtype=bool)
+            firstSeen[candidates[numpy.unique(keys,return_index=True)[1]]] = True
+            keep &= firstSeen
+        elif unique == 'flag':
+            keep &= flags & 1024 == 0
+        elif unique:
+            seqDict = {}
+            firstSeen = numpy.zeros(nRead,dtype=bool)
+            for i in numpy.nonzero(keep)[0].tolist():
+                seqKey = (reads[i][3],reads[i][5])
+                if not seqDict.has_key(seqKey):
+                    firstSeen[i] = True
+                    seqDict[seqKey] = 1
+            keep &= firstSeen
+
+        if sense == '-':
+          strand = ['+','-']
+          strand.remove(locus.sense())
+          strand = strand[0]
+        else:
+            strand = locus.sense()
+        if sense != 'both' and sense != '.':
+            keep &= minus == (strand == '-')
+            if strand == '.':
+                keep &= False
+
+        #reads spanning one junction are split in two, ones spanning more are dropped
+        keep &= nJxn <= 1
+        kept = numpy.nonzero(keep)[0]
+        split = nJxn[kept] == 1
+        pieces = numpy.where(split,2,1)
+        pieceReads = numpy.repeat(kept,pieces)
+        #reads with no stored sequence come back from samtools as '*'
+        pieceStarts = starts[pieceReads]
+        pieceEnds = pieceStarts + numpy.maximum(lengths,1)[pieceReads]
+
+        #same split as readsToLoci, from the first three numbers in the cigar
+        splitReads = kept[split]
+        firstPieces = (numpy.cumsum(pieces) - pieces)[split]
+        first = ops[opStarts[splitReads]] >> 4
+        gap = ops[opStarts[splitReads]+1] >> 4
+        second = ops[opStarts[splitReads]+2] >> 4
+        pieceEnds[firstPieces] = starts[splitReads] + first
+        pieceStarts[firstPieces+1] = starts[splitReads] + first + gap
+        pieceEnds[firstPieces+1] = starts[splitReads] + first + gap + second
+
+        if IDtag == 'sequence' or IDtag == 'seqID':
+            rawReads = reader.fetch(locus.chr(),locus.start(),locus.end())
+            IDs = []
+            firstDict = dict(zip(splitReads.tolist(),first.tolist()))
+            for i in kept.tolist():
+                if IDtag == 'sequence':
+                    ID = rawReads[i][9]
+                else:
+                    ID = rawReads[i][0]
+                if firstDict.has_key(i) and IDtag == 'sequence':
+                    IDs += [ID[0:firstDict[i]],ID[firstDict[i]:]]
+                elif firstDict.has_key(i):
+                    IDs += [ID,ID]
+                else:
+                    IDs.append(ID)
+        else:
+            IDs = None
+
+        if type(locus.chr()) == int:
+            refID = locus.chr()
+        else:
+            refID = reader.resolveChrom(locus.chr())
+        if refID >= 0:
+            chrom = reader.references()[refID]
+        else:
+            chrom = locus.chr()
+        return ReadBatch(chrom,pieceStarts,pieceEnds,minus[pieceReads],IDs)
+
+    def getReadPositions(self,locus,sense = 'both',unique = False,includeJxnReads = False):
+        '''
+        fast path of getReadsLocus that only returns read positions.
+        applies the same strand, uniqueness and junction rules as getRawReads
+        and splits junction reads like readsToLoci.
+        returns three lists: 1-based starts, strands and lengths
+        '''
+        reads = self.getReadBatch(locus,sense,unique,includeJxnReads)
+        return reads.starts().tolist(),reads.strands(),(reads.ends()-reads.starts()).tolist()
+
     def readsToLoci(self,reads,IDtag = 'sequence,seqID,none'):
         '''
         takes raw read lines from the bam and converts them into loci
@@ -773,6 +1559,1006 @@ class Bam:
                                     
 
 
+#==================================================================
+#=======================COVERAGE FUNCTIONS=========================
+#==================================================================
+
+#array backed read coverage used by bamToGFF in place of per base hashes
+#coverage is built from a difference array and a cumulative sum, so the cost
+#is linear in the number of reads plus the length of the region
+
+def readCoverage(starts,ends,lo,hi):
+    '''
+    returns an array of read depth at every base from lo to hi inclusive.
+    reads are given as arrays of inclusive start and end coordinates
+    '''
+    size = hi - lo + 1
+    starts = numpy.clip(numpy.asarray(starts,dtype=numpy.int64),lo,hi+1) - lo
+    ends = numpy.clip(numpy.asarray(ends,dtype=numpy.int64)+1,lo,hi+1) - lo
+    diff = numpy.bincount(starts,minlength=size+1) - numpy.bincount(ends,minlength=size+1)
+    return numpy.cumsum(diff[0:size])
+
+
+def binCoverage(coverage,lo,locus,nBins,floor = 0):
+    '''
+    splits the interior of a locus into nBins bins and returns the read density
+    of each bin as a list of floats, or None if the locus is too short to bin.
+    coverage is an array starting at base lo that spans the whole locus.
+    bins walk from the start of + and . loci and from the end of - loci,
+    and bases with a depth at or below a positive floor are not counted
+    '''
+    binSize = (locus.len()-1)/nBins
+    if binSize == 0:
+        return None
+    if floor > 0:
+        coverage = numpy.where(coverage > floor,coverage,0)
+    cumulative = numpy.concatenate(([0],numpy.cumsum(coverage)))
+
+    #each bin is open at both ends, so it holds binSize-1 bases
+    ticks = numpy.arange(nBins,dtype=numpy.int64)
+    if locus.sense() == '+' or locus.sense() == '.':
+        binStarts = locus.start() + ticks*binSize + 1
+    else:
+        binStarts = locus.end() - (ticks+1)*binSize + 1
+    binEnds = binStarts + binSize - 2
+    binSums = cumulative[binEnds-lo+1] - cumulative[binStarts-lo]
+    return [float(x)/binSize for x in binSums.tolist()]
+
+
+def countedStrands(locusSense,sense):
+    '''
+    returns (countPlus,countMinus), which read strands count towards a locus
+    when mapping with a given sense option ('+','-','.' or 'both').
+    + loci read + as sense; - and . loci read - as sense
+    '''
+    countSense = sense == '+' or sense == 'both' or sense == '.'
+    countAnti = sense == '-' or sense == 'both' or sense == '.'
+    if locusSense == '+':
+        return countSense,countAnti
+    else:
+        return countAnti,countSense
+
+
+#==================================================================
+#=========================COVERAGE CACHE===========================
+#==================================================================
+
+#extended read coverage of a bam stored on disk so that reruns on the same bam
+#can answer region densities without reading it again. coverage is kept per
+#chromosome and strand as a step function: the positions where the depth
+#changes and the depth from each of them on, saved as memory mappable .npy files.
+#a region query only fetches reads whose aligned span reaches its search window,
+#so reads whose sequence runs past their aligned end (soft clips, insertions)
+#are also kept on their own, and the ones a query would not fetch are taken out again
+
+#bumped whenever the files of a cache entry change, so old entries are not read
+COVERAGE_CACHE_FORMAT = 2
+
+class CoverageCache:
+    '''a persistent store of extended read coverage for one bam'''
+
+    def __init__(self,cacheFolder,bamFile,extension):
+        self._bam = os.path.abspath(bamFile)
+        self._extension = int(extension)
+        bamStat = os.stat(self._bam)
+        #any change to the bam, the extension or the cache format gives a new key
+        keyFields = [self._bam,str(bamStat.st_size),repr(bamStat.st_mtime),str(self._extension),str(COVERAGE_CACHE_FORMAT)]
+        self._key = hashlib.sha1(join(keyFields,'\t')).hexdigest()
+        self._folder = formatFolder(formatFolder(cacheFolder,True) + self._key,True)
+        self._manifestFile = self._folder + 'manifest.txt'
+        self._manifest = {}
+        if os.path.exists(self._manifestFile):
+            for line in parseTable(self._manifestFile,'\t'):
+                self._manifest[line[0]] = line[1]
+        else:
+            self._manifest = {'bam':self._bam,'size':keyFields[1],'mtime':keyFields[2],'extension':keyFields[3]}
+            self.__writeManifest()
+        self._arrays = {}
+
+    def __writeManifest(self):
+        tempFile = '%s.%s.tmp' % (self._manifestFile,os.getpid())
+        unParseTable([[key,self._manifest[key]] for key in sorted(self._manifest.keys())],tempFile,'\t')
+        os.rename(tempFile,self._manifestFile)
+
+    def __arrayFile(self,chrom,strand,kind):
+        chromName = re.sub(r'[^A-Za-z0-9_.-]','_',chrom)
+        strandName = {'+':'plus','-':'minus'}[strand]
+        return '%s%s_%s_%s.npy' % (self._folder,chromName,strandName,kind)
+
+    def key(self):
+        return self._key
+
+    def references(self):
+        '''
+        returns the reference names of the bam, reading the header only the first time
+        '''
+        if not self._manifest.has_key('references'):
+            self._manifest['references'] = join(BamReader(self._bam).references(),',')
+            self.__writeManifest()
+        return self._manifest['references'].split(',')
+
+    def getTotalReads(self,readType = 'mapped'):
+        '''
+        returns the bam read count, counting it only the first time
+        '''
+        field = '%sReads' % (readType)
+        if not self._manifest.has_key(field):
+            self._manifest[field] = str(Bam(self._bam).getTotalReads(readType))
+            self.__writeManifest()
+        return int(self._manifest[field])
+
+    def hasChrom(self,chrom):
+        return os.path.exists(self.__arrayFile(chrom,'-','depth'))
+
+    def build(self,chromList):
+        '''
+        stores the coverage of every chromosome in chromList that is not cached yet
+        '''
+        references = self.references()
+        for chrom in uniquify(chromList):
+            if self.hasChrom(chrom) or references.count(chrom) == 0:
+                continue
+            print('caching coverage of %s for %s' % (chrom,self._bam))
+            self.__buildChrom(chrom)
+
+    def __buildChrom(self,chrom):
+        '''
+        streams the reads of one chromosome and writes its step function coverage.
+        reads arrive sorted by start, so events before the start of the current
+        batch can no longer change and are finalized batch by batch
+        '''
+        reader = BamReader(self._bam)
+        extension = self._extension
+        batchSize = 500000
+        empty = numpy.zeros(0,dtype=numpy.int64)
+        breakList = {'+':[],'-':[]}
+        depthList = {'+':[],'-':[]}
+        overhangList = {'+':[],'-':[]}
+        runningDepth = {'+':0,'-':0}
+        pending = {'+':(empty,empty),'-':(empty,empty)}
+
+        def flush(batch,lastStart):
+            starts = numpy.array([read[0] for read in batch],dtype=numpy.int64)
+            refEnds = numpy.array([read[1] for read in batch],dtype=numpy.int64)
+            lengths = numpy.array([max(read[3],1) for read in batch],dtype=numpy.int64)
+            minus = numpy.array([read[2] & 16 != 0 for read in batch],dtype=bool)
+            for strand in ('+','-'):
+                if strand == '+':
+                    mask = ~minus
+                    extStarts = starts[mask]
+                    extEnds = starts[mask] + lengths[mask] + extension
+                else:
+                    mask = minus
+                    extStarts = starts[mask] - extension
+                    extEnds = starts[mask] + lengths[mask]
+
+                #a query for a locus starting after the aligned end plus the extension
+                #does not fetch the read, though its extended footprint can reach the locus
+                lastFetched = refEnds[mask] + extension
+                overhang = extEnds > lastFetched
+                overhangList[strand].append(numpy.column_stack((extStarts[overhang],extEnds[overhang],lastFetched[overhang])))
+
+                #a read covers extStart..extEnd, so its depth drops at extEnd+1
+                positions = numpy.concatenate((pending[strand][0],extStarts,extEnds+1))
+                deltas = numpy.concatenate((pending[strand][1],numpy.ones(len(extStarts),dtype=numpy.int64),-numpy.ones(len(extEnds),dtype=numpy.int64)))
+
+                #later reads on this strand cannot add events before the cutoff
+                if lastStart == None:
+                    ready = numpy.ones(len(positions),dtype=bool)
+                elif strand == '+':
+                    ready = positions < lastStart
+                else:
+                    ready = positions < lastStart - extension
+                pending[strand] = (positions[~ready],deltas[~ready])
+                positions = positions[ready]
+                deltas = deltas[ready]
+                if len(positions) == 0:
+                    continue
+
+                order = numpy.argsort(positions,kind='mergesort')
+                positions = positions[order]
+                deltas = deltas[order]
+                breaks,first = numpy.unique(positions,return_index=True)
+                net = numpy.add.reduceat(deltas,first)
+                depth = runningDepth[strand] + numpy.cumsum(net)
+                runningDepth[strand] = int(depth[-1])
+                keep = net != 0
+                breakList[strand].append(breaks[keep])
+                depthList[strand].append(depth[keep])
+
+        batch = []
+        for read in reader.iterPositions(chrom,1,reader.referenceLengths()[chrom]):
+            #junction reads are skipped just like in getReadsLocus
+            if [op for op in read[4] if op & 15 == 3]:
+                continue
+            batch.append(read)
+            if len(batch) >= batchSize:
+                flush(batch,batch[-1][0])
+                batch = []
+        flush(batch,None)
+        reader.close()
+
+        for strand in ('+','-'):
+            breaks = numpy.concatenate([empty] + breakList[strand])
+            depth = numpy.concatenate([empty] + depthList[strand]).astype(numpy.int32)
+            overhangs = numpy.concatenate([numpy.zeros((0,3),dtype=numpy.int64)] + overhangList[strand])
+            overhangs = overhangs[numpy.argsort(overhangs[:,0],kind='mergesort')]
+            #the depth is written last, as hasChrom looks for it
+            for kind,array in (('overhangs',overhangs),('breaks',breaks),('depth',depth)):
+                arrayFile = self.__arrayFile(chrom,strand,kind)
+                tempFile = '%s.%s.tmp' % (arrayFile,os.getpid())
+                fh = open(tempFile,'wb')
+                numpy.save(fh,array)
+                fh.close()
+                os.rename(tempFile,arrayFile)
+
+    def getCoverage(self,chrom,lo,hi,strand):
+        '''
+        returns the depth of extended reads on one strand at every base from lo to hi
+        inclusive, counting the reads a bam query for a locus from lo to hi would fetch
+        '''
+        if not self._arrays.has_key((chrom,strand)):
+            if self.hasChrom(chrom):
+                breaks = numpy.load(self.__arrayFile(chrom,strand,'breaks'),mmap_mode='r')
+                depth = numpy.load(self.__arrayFile(chrom,strand,'depth'),mmap_mode='r')
+                overhangs = numpy.load(self.__arrayFile(chrom,strand,'overhangs'),mmap_mode='r')
+            else:
+                breaks = numpy.zeros(0,dtype=numpy.int64)
+                depth = numpy.zeros(0,dtype=numpy.int32)
+                overhangs = numpy.zeros((0,3),dtype=numpy.int64)
+            #no overhanging footprint is longer than this, which bounds the search for them
+            if len(overhangs) > 0:
+                maxSpan = int((overhangs[:,1] - overhangs[:,0]).max())
+            else:
+                maxSpan = 0
+            self._arrays[(chrom,strand)] = (breaks,depth,overhangs,maxSpan)
+        breaks,depth,overhangs,maxSpan = self._arrays[(chrom,strand)]
+        if len(breaks) == 0:
+            return numpy.zeros(hi-lo+1,dtype=numpy.int64)
+        steps = numpy.searchsorted(breaks,numpy.arange(lo,hi+1),'right') - 1
+        coverage = numpy.where(steps >= 0,depth[numpy.maximum(steps,0)],0).astype(numpy.int64)
+
+        #taking out the footprints of reads that end too far before lo to be fetched
+        first = numpy.searchsorted(overhangs[:,0],lo-maxSpan,'left')
+        last = numpy.searchsorted(overhangs[:,0],hi,'right')
+        if last > first:
+            candidates = numpy.asarray(overhangs[first:last])
+            missed = candidates[(candidates[:,1] >= lo) & (candidates[:,2] < lo)]
+            if len(missed) > 0:
+                coverage -= readCoverage(missed[:,0],missed[:,1],lo,hi)
+        return coverage
+
+
+#==================================================================
+#===========================TELEMETRY==============================
+#==================================================================
+
+#progress of a mapping loop as periodic JSON lines records. each record has
+#the regions done out of the total, region and read rates, seconds spent per
+#phase (fetch, bin, output), subprocesses started and an ETA. records from
+#several processes can share one file since each is a single appended line
+
+class Telemetry:
+    '''periodic JSON lines progress records for one mapping loop'''
+
+    def __init__(self,telemetryFile = '',stage = '',total = 0,interval = 10.0,label = ''):
+        self._file = telemetryFile
+        self._stage = stage
+        self._label = label
+        self._total = total
+        self._interval = interval
+        self._startTime = time.time()
+        self._lastEmit = self._startTime
+        self._regions = 0
+        self._reads = 0
+        self._subprocesses = 0
+        self._heldPeak = 0
+        self._seconds = defaultdict(float)
+
+    def addTime(self,phase,seconds):
+        self._seconds[phase] += seconds
+
+    def addReads(self,reads):
+        self._reads += reads
+
+    def addSubprocesses(self,subprocesses = 1):
+        self._subprocesses += subprocesses
+
+    def holdLines(self,lines):
+        '''counts lines held in memory waiting on earlier ones, keeping the most held at once'''
+        self._heldPeak = max(self._heldPeak,lines)
+
+    def heldPeak(self):
+        return self._heldPeak
+
+    def counts(self):
+        '''
+        returns the reads, subprocesses and phase seconds counted so far, for merging
+        the counts of a worker process into a parent Telemetry with addCounts
+        '''
+        return self._reads,self._subprocesses,dict(self._seconds)
+
+    def addCounts(self,counts):
+        reads,subprocesses,seconds = counts
+        self._reads += reads
+        self._subprocesses += subprocesses
+        for phase in seconds:
+            self._seconds[phase] += seconds[phase]
+
+    def tick(self,regions = 1):
+        '''
+        counts finished regions and emits a record once interval seconds have passed
+        '''
+        self._regions += regions
+        if time.time() - self._lastEmit >= self._interval:
+            self.emit()
+
+    def emit(self,done = False):
+        now = time.time()
+        self._lastEmit = now
+        elapsed = max(now - self._startTime,1e-9)
+        regionRate = self._regions/elapsed
+        if done:
+            eta = 0.0
+        elif regionRate > 0 and self._total > 0:
+            eta = round(max(self._total - self._regions,0)/regionRate,1)
+        else:
+            eta = None
+        record = {'time':datetime.datetime.now().isoformat(),'stage':self._stage,'label':self._label,
+                  'pid':os.getpid(),'regions':self._regions,'total':self._total,'elapsed':round(elapsed,3),
+                  'regionsPerSec':round(regionRate,3),'reads':self._reads,'readsPerSec':round(self._reads/elapsed,3),
+                  'seconds':dict([(phase,round(self._seconds[phase],3)) for phase in self._seconds]),
+                  'subprocesses':self._subprocesses,'heldPeak':self._heldPeak,'eta':eta,'done':done}
+        print('%s: %s of %s regions, %s regions/sec, eta %s sec' % (self._stage,self._regions,self._total,record['regionsPerSec'],eta))
+        if len(self._file) > 0:
+            fh = open(self._file,'a')
+            fh.write(json.dumps(record,sort_keys=True) + '\n')
+            fh.close()
+
+    def close(self):
+        '''emits the final record'''
+        self.emit(True)
+
+
+#==================================================================
+#===========================PROFILING==============================
+#==================================================================
+
+#each profiled stage leaves STAGE.prof, loadable with pstats, and STAGE.txt,
+#its top functions by cumulative time, in the profile folder. child processes
+#are handed the same folder so that one folder covers the whole run
+
+#number of functions listed in each profile summary
+PROFILE_TOP = 30
+
+def profileCall(profileFolder,stage,func,*args,**kwargs):
+    '''
+    calls func(*args,**kwargs) and returns its value. if profileFolder is given,
+    the call is profiled and the stats of the stage are written to the folder
+    '''
+    if not profileFolder:
+        return func(*args,**kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func,*args,**kwargs)
+    finally:
+        profileFolder = formatFolder(profileFolder,True)
+        profiler.dump_stats('%s%s.prof' % (profileFolder,stage))
+        summary = open('%s%s.txt' % (profileFolder,stage),'w')
+        stats = pstats.Stats(profiler,stream = summary)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        summary.close()
+
+
+def summarizeProfiles(profileFolder,output = ''):
+    '''
+    writes the total time of every stage profiled into profileFolder and the
+    top functions by cumulative time over all of them to output
+    '''
+    profileFolder = formatFolder(profileFolder,False)
+    if not profileFolder:
+        return
+    if not output:
+        output = profileFolder + 'summary.txt'
+    profileList = sorted(glob.glob(profileFolder + '*.prof'))
+    if len(profileList) == 0:
+        return
+    summary = open(output,'w')
+    summary.write('STAGE\tSECONDS\n')
+    for profileFile in profileList:
+        stats = pstats.Stats(profileFile)
+        summary.write('%s\t%.3f\n' % (profileFile.split('/')[-1][0:-5],stats.total_tt))
+    summary.write('\nALL STAGES\n')
+    stats = pstats.Stats(*profileList,stream = summary)
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+    summary.close()
+
+
+#==================================================================
+#==========================RUN METRICS=============================
+#==================================================================
+
+#each measured stage records its wall and cpu seconds, peak resident memory
+#and bytes read and written as a JSON line next to the metrics report.
+#child processes are handed the same report file and append their own
+#records, the process running the pipeline folds all of them into the report
+
+def readIOBytes():
+    '''
+    returns the bytes this process has read and written through system calls,
+    cached reads included, or None where /proc is not available
+    '''
+    try:
+        fields = dict([line.split(':') for line in open('/proc/self/io').read().strip().split('\n')])
+    except (IOError,ValueError):
+        return None
+    return int(fields['rchar']),int(fields['wchar'])
+
+
+def resetPeakRSS():
+    '''
+    restarts the peak resident memory count of this process where linux allows it,
+    so that it covers one stage. returns False if it counts from process start
+    '''
+    try:
+        clearRefs = open('/proc/self/clear_refs','w')
+        clearRefs.write('5')
+        clearRefs.close()
+        return True
+    except IOError:
+        return False
+
+
+def maxRSSBytes(usage):
+    '''returns the ru_maxrss of a resource usage in bytes'''
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss
+    return usage.ru_maxrss*1024
+
+
+class StageMetrics:
+    '''resource records of the stages of one run'''
+
+    def __init__(self,metricsFile = '',report = False):
+        '''
+        records go to the .jsonl file next to metricsFile. with report, this
+        process owns the run: records of an earlier run are dropped and the
+        report is rewritten after every stage
+        '''
+        self._file = metricsFile
+        self._report = report
+        self._startTime = time.time()
+        if not metricsFile:
+            self._recordFile = ''
+            return
+        self._recordFile = os.path.splitext(metricsFile)[0] + '.jsonl'
+        if report and os.path.exists(self._recordFile):
+            os.remove(self._recordFile)
+
+    def measure(self,stage,label,func,*args,**kwargs):
+        '''
+        calls func(*args,**kwargs) and returns its value, recording the
+        resources the call used under stage and label. cpu and memory of child processes it waits
+        for are counted, their bytes read and written are not
+        '''
+        if not self._file:
+            return func(*args,**kwargs)
+        stageReset = resetPeakRSS()
+        selfStart = resource.getrusage(resource.RUSAGE_SELF)
+        childStart = resource.getrusage(resource.RUSAGE_CHILDREN)
+        ioStart = readIOBytes()
+        wallStart = time.time()
+        ok = False
+        try:
+            value = func(*args,**kwargs)
+            ok = True
+            return value
+        finally:
+            wallEnd = time.time()
+            selfEnd = resource.getrusage(resource.RUSAGE_SELF)
+            childEnd = resource.getrusage(resource.RUSAGE_CHILDREN)
+            ioEnd = readIOBytes()
+            record = {'stage':stage,'label':label,'pid':os.getpid(),'host':os.uname()[1],
+                      'start':datetime.datetime.fromtimestamp(wallStart).isoformat(),
+                      'wallSeconds':round(wallEnd-wallStart,3),
+                      'userSeconds':round((selfEnd.ru_utime-selfStart.ru_utime)+(childEnd.ru_utime-childStart.ru_utime),3),
+                      'systemSeconds':round((selfEnd.ru_stime-selfStart.ru_stime)+(childEnd.ru_stime-childStart.ru_stime),3),
+                      'peakRSSBytes':maxRSSBytes(selfEnd),'peakRSSWholeProcess':not stageReset,
+                      'readBytes':None,'writeBytes':None,'ok':ok}
+            record['cpuSeconds'] = round(record['userSeconds'] + record['systemSeconds'],3)
+            #the children peak only says something about this stage if it grew during it
+            if childEnd.ru_maxrss > childStart.ru_maxrss:
+                record['childPeakRSSBytes'] = maxRSSBytes(childEnd)
+            else:
+                record['childPeakRSSBytes'] = None
+            if ioStart and ioEnd:
+                record['readBytes'] = ioEnd[0] - ioStart[0]
+                record['writeBytes'] = ioEnd[1] - ioStart[1]
+            fh = open(self._recordFile,'a')
+            fh.write(json.dumps(record,sort_keys=True) + '\n')
+            fh.close()
+            if self._report:
+                self.write()
+
+    def write(self):
+        '''
+        writes the records of every process of the run and their totals to
+        the report file
+        '''
+        if not self._file or not self._report:
+            return
+        stages = []
+        if os.path.exists(self._recordFile):
+            for line in open(self._recordFile):
+                try:
+                    stages.append(json.loads(line))
+                except ValueError:
+                    #a child still writing its last line
+                    continue
+        stages.sort(key = lambda record: record['start'])
+        totals = {'wallSeconds':round(time.time()-self._startTime,3),
+                  'cpuSeconds':round(sum([record['cpuSeconds'] for record in stages]),3),
+                  'peakRSSBytes':max([max(record['peakRSSBytes'],record['childPeakRSSBytes']) for record in stages] + [0]),
+                  'readBytes':sum([record['readBytes'] or 0 for record in stages]),
+                  'writeBytes':sum([record['writeBytes'] or 0 for record in stages])}
+        report = {'command':join(sys.argv,' '),'start':datetime.datetime.fromtimestamp(self._startTime).isoformat(),
+                  'stages':stages,'totals':totals}
+        fh = open(self._file + '.tmp','w')
+        fh.write(json.dumps(report,sort_keys=True,indent = 1) + '\n')
+        fh.close()
+        os.rename(self._file + '.tmp',self._file)
+
+
+#==================================================================
+#==========================JOB SCHEDULER===========================
+#==================================================================
+
+#runs the shell commands of a stage on a bounded pool of child processes.
+#a watcher thread per running job turns its exit into a completion event, so
+#the next job starts, and the stage ends, as soon as a job exits.
+#the cluster executors below take the same submit and wait calls, so a
+#pipeline picks its backend once with makeExecutor
+
+class JobScheduler:
+    '''runs shell commands at most jobs at a time and tracks how they finish'''
+
+    def __init__(self,jobs = 1):
+        self._limit = max(1,int(jobs))
+        self._jobs = []
+        self._events = Queue.Queue()
+
+    def submit(self,cmd,name = '',outputs = []):
+        '''
+        queues a shell command and returns its job ID. the job only counts
+        as done if it exits with 0 and leaves every file in outputs
+        '''
+        jobID = len(self._jobs)
+        if not name:
+            name = 'job%s' % (jobID)
+        self._jobs.append({'id':jobID,'name':name,'cmd':cmd,'outputs':list(outputs),'status':'queued',
+                           'returncode':None,'start':None,'end':None,'process':None})
+        return jobID
+
+    def getJob(self,jobID):
+        return self._jobs[jobID]
+
+    def getJobs(self,status = ''):
+        return [job for job in self._jobs if not status or job['status'] == status]
+
+    def __start(self,job):
+        print('STARTING JOB %s: %s' % (job['name'],job['cmd']))
+        job['status'] = 'running'
+        job['start'] = time.time()
+        job['process'] = subprocess.Popen(job['cmd'],shell=True)
+        watcher = threading.Thread(target = self.__watch,args = (job['id'],job['process']))
+        watcher.daemon = True
+        watcher.start()
+
+    def __watch(self,jobID,process):
+        self._events.put((jobID,process.wait()))
+
+    def _finish(self,jobID,returncode):
+        job = self._jobs[jobID]
+        job['end'] = time.time()
+        job['returncode'] = returncode
+        missing = [output for output in job['outputs'] if not os.path.exists(output)]
+        if returncode == 0 and len(missing) == 0:
+            job['status'] = 'done'
+            print('JOB %s FINISHED IN %.1f SECONDS' % (job['name'],job['end']-job['start']))
+        else:
+            job['status'] = 'failed'
+            print('ERROR: JOB %s FAILED WITH EXIT CODE %s' % (job['name'],returncode))
+            for output in missing:
+                print('MISSING OUTPUT %s' % (output))
+
+    def wait(self,timeout = None):
+        '''
+        runs the queued jobs and blocks until they have all finished.
+        after a failure no new jobs start, and the running ones are left to
+        finish. jobs still running after timeout seconds are killed.
+        returns True if every job is done
+        '''
+        startTime = time.time()
+        queued = self.getJobs('queued')
+        running = 0
+        failed = len(self.getJobs('failed')) > 0
+        while running > 0 or (len(queued) > 0 and not failed):
+            while len(queued) > 0 and running < self._limit and not failed:
+                self.__start(queued.pop(0))
+                running += 1
+            #waiting in short slices keeps the wait interruptible
+            try:
+                if timeout == None:
+                    jobID,returncode = self._events.get(True,60)
+                else:
+                    jobID,returncode = self._events.get(True,min(60,max(timeout-(time.time()-startTime),0.001)))
+            except Queue.Empty:
+                if timeout != None and time.time()-startTime >= timeout:
+                    print('ERROR: JOBS STILL RUNNING AFTER %s SECONDS' % (timeout))
+                    for job in self.getJobs('running'):
+                        job['process'].kill()
+                        job['end'] = time.time()
+                        job['status'] = 'failed'
+                        print('ERROR: KILLED JOB %s' % (job['name']))
+                    for job in queued:
+                        job['status'] = 'cancelled'
+                    return False
+                continue
+            #killed jobs have already been counted
+            if self._jobs[jobID]['status'] != 'running':
+                continue
+            running -= 1
+            self._finish(jobID,returncode)
+            failed = failed or self._jobs[jobID]['status'] == 'failed'
+        for job in queued:
+            job['status'] = 'cancelled'
+        return not failed
+
+    def returncode(self):
+        '''
+        returns the exit code of the first failed job, 1 if it exited with 0
+        but left outputs missing, or 0 if no job failed
+        '''
+        for job in self.getJobs('failed'):
+            return job['returncode'] or 1
+        return 0
+
+
+#==================================================================
+#=========================CLUSTER EXECUTORS========================
+#==================================================================
+
+#on a cluster the queued jobs of a stage go out as one job array. every task
+#of the array runs the same script, which picks its command by the task index
+#the scheduler hands it. the executor then follows the array by its job ID,
+#asking the scheduler for the state and exit code of each task, so a task the
+#cluster kills fails the stage instead of leaving it waiting on files
+
+CLUSTER_POLL = 30
+
+class ClusterExecutor(JobScheduler):
+    '''
+    submits the queued jobs as one job array and follows its tasks by job ID.
+    a backend sets taskVariable, the environment variable its tasks find their
+    index in, and supplies three methods:
+    submitArray(scriptFile,arrayName,nTasks) submits tasks 1 to nTasks of the
+    script and returns the array job ID, raising OSError or CalledProcessError
+    if it cannot.
+    taskStates(arrayID) returns a dict keyed by task index of (state,returncode),
+    where state is running for a task still queued or running and finished
+    otherwise. tasks the cluster does not report yet are left out.
+    cancelArray(arrayID) stops every task of the array still queued or running
+    '''
+
+    taskVariable = ''
+
+    def __init__(self,jobs = 0,jobFolder = '',submitArgs = '',pollInterval = CLUSTER_POLL):
+        JobScheduler.__init__(self)
+        #0 leaves the number of tasks running at once to the cluster
+        self._limit = max(0,int(jobs))
+        self._folder = formatFolder(jobFolder or './',True)
+        self._submitArgs = shlex.split(submitArgs)
+        self._pollInterval = pollInterval
+        self._arrays = 0
+
+    def writeArray(self,jobs,arrayName):
+        '''
+        writes the script every task of the array runs and returns its path
+        '''
+        scriptFile = '%s%s.sh' % (self._folder,arrayName)
+        script = open(scriptFile,'w')
+        script.write('#!/bin/sh\n')
+        script.write('cd %s\n' % (pipes.quote(os.getcwd())))
+        script.write('case "$%s" in\n' % (self.taskVariable))
+        for i,job in enumerate(jobs):
+            script.write('%s)\n%s\n;;\n' % (i+1,job['cmd']))
+        script.write('*)\necho "NO TASK $%s IN %s"\nexit 1\n;;\nesac\n' % (self.taskVariable,scriptFile))
+        script.close()
+        return scriptFile
+
+    def wait(self,timeout = None):
+        '''
+        submits the queued jobs as one array and blocks until every task has
+        finished. tasks still queued or running after timeout seconds are
+        cancelled. returns True if every job is done
+        '''
+        startTime = time.time()
+        queued = self.getJobs('queued')
+        if len(queued) == 0:
+            return len(self.getJobs('failed')) == 0
+        self._arrays += 1
+        arrayName = 'ROSE_array%s' % (self._arrays)
+        scriptFile = self.writeArray(queued,arrayName)
+        try:
+            arrayID = self.submitArray(scriptFile,arrayName,len(queued))
+        except (OSError,subprocess.CalledProcessError),error:
+            print('ERROR: COULD NOT SUBMIT %s: %s' % (scriptFile,error))
+            for job in queued:
+                job['status'] = 'failed'
+            return False
+        print('SUBMITTED %s JOBS AS ARRAY %s' % (len(queued),arrayID))
+        running = {}
+        for i,job in enumerate(queued):
+            job['status'] = 'running'
+            job['start'] = time.time()
+            job['task'] = '%s[%s]' % (arrayID,i+1)
+            running[i+1] = job
+            print('JOB %s IS TASK %s: %s' % (job['name'],job['task'],job['cmd']))
+        while True:
+            try:
+                states = self.taskStates(arrayID)
+            except (OSError,subprocess.CalledProcessError),error:
+                #accounting hiccups are common, the next poll usually answers
+                print('WARNING: COULD NOT GET THE STATE OF ARRAY %s: %s' % (arrayID,error))
+                states = {}
+            for task in sorted(states):
+                if task in running and states[task][0] == 'finished':
+                    self._finish(running.pop(task)['id'],states[task][1])
+            if len(running) == 0:
+                break
+            if timeout != None and time.time()-startTime >= timeout:
+                print('ERROR: JOBS STILL RUNNING AFTER %s SECONDS' % (timeout))
+                self.cancelArray(arrayID)
+                for job in running.values():
+                    job['end'] = time.time()
+                    job['status'] = 'failed'
+                    print('ERROR: KILLED JOB %s' % (job['name']))
+                return False
+            time.sleep(self._pollInterval)
+        return len(self.getJobs('failed')) == 0
+
+
+#slurm states of a task that has not finished yet
+SLURM_ACTIVE = ['PENDING','RUNNING','REQUEUED','REQUEUE_HOLD','REQUEUE_FED','RESIZING','SUSPENDED',
+                'CONFIGURING','COMPLETING','SIGNALING','STAGE_OUT']
+
+class SlurmExecutor(ClusterExecutor):
+    '''runs the jobs of a stage as a slurm job array'''
+
+    taskVariable = 'SLURM_ARRAY_TASK_ID'
+
+    def submitArray(self,scriptFile,arrayName,nTasks):
+        tasks = '1-%s' % (nTasks)
+        if self._limit:
+            tasks += '%%%s' % (self._limit)
+        cmd = ['sbatch','--parsable','--array=%s' % (tasks),'--job-name=%s' % (arrayName),
+               '--output=%s%s_%%a.log' % (self._folder,arrayName)] + self._submitArgs + [scriptFile]
+        #--parsable prints jobID or jobID;cluster
+        return subprocess.check_output(cmd).strip().split(';')[0]
+
+    def taskStates(self,arrayID):
+        output = subprocess.check_output(['sacct','-j',arrayID,'--noheader','--parsable2','--format=JobID,State,ExitCode'])
+        states = {}
+        for line in output.splitlines():
+            fields = line.split('|')
+            if len(fields) < 3:
+                continue
+            #skips job steps like 123_4.batch and pending ranges like 123_[5-9]
+            taskID = fields[0].split('_')
+            if len(taskID) != 2 or not taskID[1].isdigit():
+                continue
+            state = fields[1].split(' ')[0]
+            returncode = int(fields[2].split(':')[0])
+            if state in SLURM_ACTIVE:
+                states[int(taskID[1])] = ('running',None)
+            elif state == 'COMPLETED':
+                states[int(taskID[1])] = ('finished',returncode)
+            else:
+                states[int(taskID[1])] = ('finished',returncode or 1)
+        return states
+
+    def cancelArray(self,arrayID):
+        subprocess.call(['scancel',arrayID])
+
+
+class LsfExecutor(ClusterExecutor):
+    '''runs the jobs of a stage as an lsf job array'''
+
+    taskVariable = 'LSB_JOBINDEX'
+
+    def submitArray(self,scriptFile,arrayName,nTasks):
+        jobName = '%s[1-%s]' % (arrayName,nTasks)
+        if self._limit:
+            jobName += '%%%s' % (self._limit)
+        cmd = ['bsub','-J',jobName,'-o','%s%s_%%I.log' % (self._folder,arrayName)] + self._submitArgs + ['sh',scriptFile]
+        output = subprocess.check_output(cmd)
+        #bsub prints Job <jobID> is submitted to queue <queue>.
+        match = re.search('Job <([0-9]+)>',output)
+        if not match:
+            raise OSError('bsub printed no job ID: %s' % (output.strip()))
+        return match.group(1)
+
+    def taskStates(self,arrayID):
+        output = subprocess.check_output(['bjobs','-a','-noheader','-o','jobindex stat exit_code',arrayID])
+        states = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) < 3 or not fields[0].isdigit():
+                continue
+            if fields[1] == 'DONE':
+                states[int(fields[0])] = ('finished',0)
+            elif fields[1] == 'EXIT':
+                if fields[2].isdigit():
+                    states[int(fields[0])] = ('finished',int(fields[2]) or 1)
+                else:
+                    states[int(fields[0])] = ('finished',1)
+            else:
+                states[int(fields[0])] = ('running',None)
+        return states
+
+    def cancelArray(self,arrayID):
+        subprocess.call(['bkill',arrayID])
+
+
+class FakeClusterExecutor(ClusterExecutor):
+    '''
+    a stand-in cluster for tests. the tasks of an array run as local processes
+    of the same array script, and are reported by array ID and task index
+    the way the real backends report them
+    '''
+
+    taskVariable = 'FAKE_TASK_ID'
+
+    def __init__(self,jobs = 0,jobFolder = '',submitArgs = '',pollInterval = 0.1):
+        ClusterExecutor.__init__(self,jobs,jobFolder,submitArgs,pollInterval)
+        self._tasks = {}
+
+    def submitArray(self,scriptFile,arrayName,nTasks):
+        arrayID = 'fake%s' % (len(self._tasks)+1)
+        self._tasks[arrayID] = [{'index':task,'script':scriptFile,'log':'%s%s_%s.log' % (self._folder,arrayName,task),
+                                 'process':None} for task in range(1,nTasks+1)]
+        return arrayID
+
+    def taskStates(self,arrayID):
+        tasks = self._tasks[arrayID]
+        #the queue hands out slots as tasks finish, like an array throttle
+        active = len([task for task in tasks if task['process'] != None and task['process'].poll() == None])
+        for task in tasks:
+            if task['process'] == None and (not self._limit or active < self._limit):
+                env = dict(os.environ)
+                env[self.taskVariable] = str(task['index'])
+                log = open(task['log'],'w')
+                task['process'] = subprocess.Popen(['sh',task['script']],env=env,stdout=log,stderr=subprocess.STDOUT)
+                log.close()
+                active += 1
+        states = {}
+        for task in tasks:
+            if task['process'] == None or task['process'].poll() == None:
+                states[task['index']] = ('running',None)
+            else:
+                states[task['index']] = ('finished',task['process'].returncode)
+        return states
+
+    def cancelArray(self,arrayID):
+        for task in self._tasks[arrayID]:
+            if task['process'] != None and task['process'].poll() == None:
+                task['process'].kill()
+
+
+EXECUTORS = {'local':JobScheduler,'slurm':SlurmExecutor,'lsf':LsfExecutor,'fake':FakeClusterExecutor}
+
+def makeExecutor(backend,jobs = 0,jobFolder = '',submitArgs = ''):
+    '''
+    returns the executor of a backend: local, slurm, lsf or fake. jobs bounds
+    how many jobs run at once, 0 for no bound on a cluster. cluster job
+    scripts and logs go into jobFolder and submitArgs are passed on to
+    sbatch or bsub
+    '''
+    if backend == 'local':
+        return JobScheduler(jobs or 1)
+    return EXECUTORS[backend](jobs,jobFolder,submitArgs)
+
+
+#==================================================================
+#=========================STAGE MANIFESTS==========================
+#==================================================================
+
+#each pipeline stage leaves a manifest with the digests of its inputs, its
+#parameters and the digests of its outputs. a resumed run skips a stage when
+#its inputs and parameters give the same key and its outputs are still as the
+#stage left them. bams are keyed by path, size and modification time as in the
+#coverage cache, since hashing a whole bam costs about as much as mapping it
+
+#bumped whenever the densities bamToGFF writes or the region map and super
+#calls made from them change, so a resumed run redoes stages run by older code
+MAPPING_FORMAT = 1
+
+def fileDigest(fileName):
+    '''
+    returns the sha1 of the contents of a file, or of the path, size and
+    modification time for a bam or bam index
+    '''
+    if fileName.split('.')[-1] == 'bam' or fileName.split('.')[-1] == 'bai':
+        fileStat = os.stat(fileName)
+        return hashlib.sha1(join([os.path.abspath(fileName),str(fileStat.st_size),repr(fileStat.st_mtime)],'\t')).hexdigest()
+    digest = hashlib.sha1()
+    fh = open(fileName,'rb')
+    chunk = fh.read(1048576)
+    while chunk:
+        digest.update(chunk)
+        chunk = fh.read(1048576)
+    fh.close()
+    return digest.hexdigest()
+
+
+class StageManifests:
+    '''the manifests of the pipeline stages run into one output folder'''
+
+    def __init__(self,manifestFolder,resume = False):
+        self._folder = formatFolder(manifestFolder,True)
+        self._resume = resume
+
+    def __manifestFile(self,stage):
+        return '%s%s.json' % (self._folder,stage)
+
+    def key(self,inputs,params):
+        '''
+        returns the key of a stage run on the contents of inputs with params
+        '''
+        keyFields = [fileDigest(inputFile) for inputFile in inputs] + [json.dumps(params,sort_keys=True)]
+        return hashlib.sha1(join(keyFields,'\t')).hexdigest()
+
+    def isFresh(self,stage,inputs,params):
+        '''
+        returns True when resuming and the stage has already run on the same
+        inputs and params and its outputs are unchanged
+        '''
+        if not self._resume or not os.path.exists(self.__manifestFile(stage)):
+            return False
+        try:
+            manifest = json.load(open(self.__manifestFile(stage)))
+            if manifest['key'] != self.key(inputs,params):
+                print('STAGE %s IS OUT OF DATE' % (stage))
+                return False
+            for output in manifest['outputs']:
+                if fileDigest(output) != manifest['outputs'][output]:
+                    print('STAGE %s OUTPUT %s HAS CHANGED' % (stage,output))
+                    return False
+        except (IOError,OSError):
+            print('STAGE %s IS MISSING AN INPUT OR OUTPUT' % (stage))
+            return False
+        except (ValueError,KeyError,TypeError,AttributeError):
+            #a manifest cut short by a full disk or a partial copy of the output folder
+            print('STAGE %s HAS A DAMAGED MANIFEST' % (stage))
+            return False
+        print('RESUMING: STAGE %s IS UP TO DATE' % (stage))
+        return True
+
+    def record(self,stage,inputs,params,outputs):
+        '''
+        writes the manifest of a stage that has just run
+        '''
+        manifest = {'stage':stage,'key':self.key(inputs,params),'params':params,
+                    'inputs':[[os.path.abspath(inputFile),fileDigest(inputFile)] for inputFile in inputs],
+                    'outputs':dict([(os.path.abspath(output),fileDigest(output)) for output in outputs]),
+                    'time':datetime.datetime.now().isoformat()}
+        tempFile = self.__manifestFile(stage) + '.tmp'
+        fh = open(tempFile,'w')
+        json.dump(manifest,fh,sort_keys=True,indent=1)
+        fh.close()
+        os.rename(tempFile,self.__manifestFile(stage))
+
+
 #==================================================================
 #========================MISC FUNCTIONS============================
 #==================================================================